@@ -30,6 +30,39 @@ NOPARENT = {
     'form': '_NOPARENT_',
     'dform': 'NOPARENT'}     # unify this location
 
+
+class PaddedSentence(object):
+    '''
+    read only view of sent followed by n PADs, for the feature extractors:
+    unlike sent[:] + [PAD] * n, it does not copy sent.
+    '''
+    __slots__ = ('sent', 'n')
+
+    def __init__(self, sent, n):
+        self.sent = sent
+        self.n = n
+
+    def __len__(self):
+        return len(self.sent) + self.n
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return (self.sent + [PAD] * self.n)[k]
+        size = len(self.sent)
+        if k < 0:
+            k += size + self.n
+        if 0 <= k < size:
+            return self.sent[k]
+        if size <= k < size + self.n:
+            return PAD
+        raise IndexError("sentence index out of range")
+
+    def __iter__(self):
+        for tok in self.sent:
+            yield tok
+        for k in xrange(self.n):
+            yield PAD
+
 # Data / structures #{{{
 
 SHIFT = 0
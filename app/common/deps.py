@@ -23,6 +23,19 @@ class DependenciesCollection:
         self._parents = {}
         self._childs = defaultdict(list)
 
+    def __deepcopy__(self, memo):
+        # the tokens are those of the sentence, which the copies of a
+        # configuration share (see Configuration.__deepcopy__): only the
+        # collection itself is copied
+        c = DependenciesCollection()
+        c.deps = set(self.deps)
+        c._left_child = dict(self._left_child)
+        c._right_child = dict(self._right_child)
+        c._parents = dict(self._parents)
+        for pid, children in self._childs.items():
+            c._childs[pid] = children[:]
+        return c
+
     def has_parent(self, child):
         return child['id'] in self._parents
 
@@ -17,6 +17,8 @@ Various feature extractors for arc-eager and arc-standard transition based parse
 Author: Yoav Goldberg
 """
 from common import *
+from features import templates
+from features.templates import TemplateFeatureExtractor
 import os
 
 # Features #{{{
@@ -50,8 +52,60 @@ class AppendingFeatureExtractor:  # {{{
             for f2 in fs2:
                 fs.append("%s^%s" % (f1, f2))
         return fs
+
+    def extract_pairs(self, stack, deps, sent, i):
+        """
+        the features of extract as (fs1, fs1, fs2, "^"), fs1 and the parts
+        of the conjunctions, for the models to conjoin (see ml.conjunctions)
+        """
+        fs1 = self.e1.extract(stack, deps, sent, i)
+        fs2 = self.e2.extract(stack, deps, sent, i)
+        return fs1, fs1, fs2, "^"
+    #}}}
+
+
+class WhitelistFeatureExtractor:  # {{{
+    """
+    the features of ext that are in whitelist (see read_whitelist): the
+    trainer never sees the others, so they get no weights, and a (hashed)
+    model does not look them up. the real valued features are kept by
+    their name.
+    """
+
+    def __init__(self, ext, whitelist):
+        self.e = ext
+        self.whitelist = whitelist
+        self.real_valued = getattr(ext, "real_valued", False)
+
+    def extract(self, stack, deps, sent, i):
+        whitelist = self.whitelist
+        fs = self.e.extract(stack, deps, sent, i)
+        if self.real_valued:
+            return [f for f in fs if (f[0] if type(f) is tuple else f) in whitelist]
+        return [f for f in fs if f in whitelist]
     #}}}
 
+
+def read_whitelist(fname):
+    """
+    the features of a whitelist file, one per line (see write_whitelist)
+    """
+    with open(fname) as fin:
+        return frozenset(line.rstrip("\n") for line in fin)
+
+
+def write_whitelist(counts, min_count, fname):
+    """
+    writes the features counted at least min_count times in counts (feature
+    -> count) to fname, one per line, the most frequent first.
+    return: the number of features written.
+    """
+    kept = sorted((-n, f) for f, n in counts.iteritems() if n >= min_count)
+    with open(fname, "w") as fout:
+        for n, f in kept:
+            fout.write("%s\n" % f)
+    return len(kept)
+
 #}}} end combinators
 
 
@@ -220,9 +274,7 @@ class WenbinFeatureExtractor:  # {{{
         # new features, which I think helps..
 
         if len(sent) < i + 2:
-            sent = sent[:]
-            sent.append(PAD)
-            sent.append(PAD)
+            sent = PaddedSentence(sent, 2)
         if len(stack) < 3:
             stack = [PAD, PAD, PAD] + stack
 
@@ -328,9 +380,7 @@ class WenbinFeatureExtractor_plus:  # {{{
         #features.append("toend_%s" % round(math.log(len(sent)+3-i)))
 
         if len(sent) < i + 2:
-            sent = sent[:]
-            sent.append(PAD)
-            sent.append(PAD)
+            sent = PaddedSentence(sent, 2)
         if len(stack) < 3:
             stack = [PAD, PAD, PAD] + stack
 
@@ -446,9 +496,7 @@ class Degree2FeatureExtractor:  # {{{
         #features.append("toend_%s" % round(math.log(len(sent)+3-i)))
 
         if len(sent) < i + 2:
-            sent = sent[:]
-            sent.append(PAD)
-            sent.append(PAD)
+            sent = PaddedSentence(sent, 2)
         if len(stack) < 3:
             stack = [PAD, PAD, PAD] + stack
 
@@ -527,10 +575,7 @@ class EagerWenbinFeatureExtractor:  # {{{
         import math
 
         if len(sent) < i + 3:
-            sent = sent[:]
-            sent.append(PAD)
-            sent.append(PAD)
-            sent.append(PAD)
+            sent = PaddedSentence(sent, 3)
         if len(stack) < 3:
             stack = [PAD, PAD, PAD] + stack
 
@@ -632,9 +677,7 @@ class EagerDegree2FeatureExtractor:  # {{{
         #features.append("toend_%s" % round(math.log(len(sent)+3-i)))
 
         if len(sent) < i + 3:
-            sent = sent[:]
-            sent.append(PAD)
-            sent.append(PAD)
+            sent = PaddedSentence(sent, 2)
         if len(stack) < 3:
             stack = [PAD, PAD, PAD] + stack
 
@@ -716,9 +759,7 @@ class EagerZhangFeatureExtractor:  # {{{
         #features.append("toend_%s" % round(math.log(len(sent)+3-i)))
 
         if len(sent) < i + 3:
-            sent = sent[:]
-            sent.append(PAD)
-            sent.append(PAD)
+            sent = PaddedSentence(sent, 2)
         if len(stack) < 3:
             stack = [PAD, PAD, PAD] + stack
 
@@ -796,11 +837,14 @@ class ExtendedEagerZhangFeatureExtractor:  # {{{
 
     extended with additional features,
     for the "cut trees" parsing
+
+    real_valued: level 4 gives the length of the current span as real
+    valued features, (f, v) pairs, instead of 7 "len>x" buckets.
     """
 
-    def __init__(self, level=1):
+    def __init__(self, level=1, real_valued=False):
         self.level = level
-        pass
+        self.real_valued = real_valued
 
     def extract(self, stack, deps, sent, i):
         features = []
@@ -809,9 +853,7 @@ class ExtendedEagerZhangFeatureExtractor:  # {{{
         #features.append("toend_%s" % round(math.log(len(sent)+3-i)))
 
         if len(sent) < i + 3:
-            sent = sent[:]
-            sent.append(PAD)
-            sent.append(PAD)
+            sent = PaddedSentence(sent, 2)
         if len(stack) < 3:
             stack = [PAD, PAD, PAD] + stack
 
@@ -930,11 +972,15 @@ class ExtendedEagerZhangFeatureExtractor:  # {{{
                 if deps.parent(_tok) is None:
                     lencurrent = sent[i]['id'] - _tok['id']
                     break
-            for x in (0, 1, 2, 3, 5, 7, 10):
-                if lencurrent > x:
-                    features.append("len>%s" % x)
-                else:
-                    features.append("len<=%s" % x)
+            if self.real_valued:
+                loglen = math.log(1 + max(lencurrent, 0))
+                features.append(("len", loglen))
+            else:
+                for x in (0, 1, 2, 3, 5, 7, 10):
+                    if lencurrent > x:
+                        features.append("len>%s" % x)
+                    else:
+                        features.append("len<=%s" % x)
 
             # sent[i]['__par']=-99
             # for t in sent[:i]:
@@ -967,9 +1013,7 @@ class EagerMaltFeatureExtractor:  # {{{
         #features.append("toend_%s" % round(math.log(len(sent)+3-i)))
 
         if len(sent) < i + 3:
-            sent = sent[:]
-            sent.append(PAD)
-            sent.append(PAD)
+            sent = PaddedSentence(sent, 2)
         if len(stack) < 3:
             stack = [PAD, PAD, PAD] + stack
 
@@ -1069,9 +1113,7 @@ class EagerMaltFeatureExtractor:  # {{{
         #features.append("toend_%s" % round(math.log(len(sent)+3-i)))
 
         if len(sent) < i + 3:
-            sent = sent[:]
-            sent.append(PAD)
-            sent.append(PAD)
+            sent = PaddedSentence(sent, 2)
         if len(stack) < 3:
             stack = [PAD, PAD, PAD] + stack
 
@@ -1172,10 +1214,7 @@ class EagerMaltEnglishFeatureExtractor:  # {{{
         #features.append("toend_%s" % round(math.log(len(sent)+3-i)))
 
         if len(sent) < i + 4:
-            sent = sent[:]
-            sent.append(PAD)
-            sent.append(PAD)
-            sent.append(PAD)
+            sent = PaddedSentence(sent, 3)
         if len(stack) < 3:
             stack = [PAD, PAD, PAD] + stack
 
@@ -1361,9 +1400,7 @@ class UnlexFeatureExtractor:  # {{{ 83.81 train 15-18 test 22
         features = []
 
         if len(sent) < i + 2:
-            sent = sent[:]
-            sent.append(PAD)
-            sent.append(PAD)
+            sent = PaddedSentence(sent, 2)
         if len(stack) < 3:
             stack = [PAD, PAD, PAD] + stack
 
@@ -1445,9 +1482,7 @@ class UnlexWenbinPlusFeatureExtractor:  # {{{ Good one!
         #features.append("toend_%s" % round(math.log(len(sent)+3-i)))
 
         if len(sent) < i + 2:
-            sent = sent[:]
-            sent.append(PAD)
-            sent.append(PAD)
+            sent = PaddedSentence(sent, 2)
         if len(stack) < 3:
             stack = [PAD, PAD, PAD] + stack
 
@@ -1575,9 +1610,7 @@ class BestSoFarFeatureExtractor:  # {{{ 87.71 train 15-18 test 22
         import math
 
         if len(sent) < i + 2:
-            sent = sent[:]
-            sent.append(PAD)
-            sent.append(PAD)
+            sent = PaddedSentence(sent, 2)
         if len(stack) < 3:
             stack = [PAD, PAD, PAD] + stack
 
@@ -1672,19 +1705,25 @@ class BestSoFarFeatureExtractor:  # {{{ 87.71 train 15-18 test 22
 #}}}
 
 
-__EXTRACTORS__['eager.zhang'] = EagerZhangFeatureExtractor()
-__EXTRACTORS__['eager.zhang.ext'] = ExtendedEagerZhangFeatureExtractor()
+# the pure template extractors are compiled from features/templates.py,
+# with the same features as the classes above (EagerZhangFeatureExtractor,
+# ExtendedEagerZhangFeatureExtractor(1), EagerMaltEnglishFeatureExtractor,
+# WenbinFeatureExtractor, WenbinFeatureExtractor_plus,
+# Degree2FeatureExtractor and UnlexFeatureExtractor)
+__EXTRACTORS__['eager.zhang'] = TemplateFeatureExtractor(templates.EAGER_ZHANG)
+__EXTRACTORS__['eager.zhang.ext'] = TemplateFeatureExtractor(templates.EAGER_ZHANG_EXT)
 __EXTRACTORS__['eager.zhang.ext2'] = ExtendedEagerZhangFeatureExtractor(2)
 __EXTRACTORS__['eager.zhang.ext3'] = ExtendedEagerZhangFeatureExtractor(3)
 __EXTRACTORS__['eager.zhang.ext4'] = ExtendedEagerZhangFeatureExtractor(4)
-__EXTRACTORS__['eager.malt.eng'] = EagerMaltEnglishFeatureExtractor(
-    allpairs=True)
+__EXTRACTORS__['eager.zhang.ext4r'] = ExtendedEagerZhangFeatureExtractor(4, real_valued=True)
+__EXTRACTORS__['eager.malt.eng'] = TemplateFeatureExtractor(
+    templates.EAGER_MALT_ENGLISH, pairs=True)
 
-__EXTRACTORS__['standard.wenbin'] = WenbinFeatureExtractor()  # Good one
-__EXTRACTORS__['standard.wenbinplus'] = WenbinFeatureExtractor_plus()  # Good one
-__EXTRACTORS__['standard.deg2'] = Degree2FeatureExtractor()
+__EXTRACTORS__['standard.wenbin'] = TemplateFeatureExtractor(templates.WENBIN)  # Good one
+__EXTRACTORS__['standard.wenbinplus'] = TemplateFeatureExtractor(templates.WENBIN_PLUS)  # Good one
+__EXTRACTORS__['standard.deg2'] = TemplateFeatureExtractor(templates.DEGREE2, pairs=True)
 __EXTRACTORS__['standard.unlex.wb'] = UnlexWenbinPlusFeatureExtractor()
-__EXTRACTORS__['standard.unlex'] = UnlexFeatureExtractor()
+__EXTRACTORS__['standard.unlex'] = TemplateFeatureExtractor(templates.UNLEX)
 
 
 def get(name):
@@ -0,0 +1,471 @@
+# Copyright 2010 Yoav Goldberg
+##
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+##
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Feature templates: the features of an extractor, declared one per line and
+compiled into an extract function.
+
+a template is "LABEL: ATOM ATOM+ATOM ...". its feature is LABEL, "_", and
+the values of the atoms, joined by "_" where they are separated by spaces
+and by nothing where they are joined by "+":
+   STwt: S0.w+S0.t                  "STwt_%s%s" % (S0 form, S0 tag)
+   STtSTLCtN0t: S0.t lc(S0).t N0.t  "STtSTLCtN0t_%s_%s_%s" % (...)
+an atom is NODE.ATTR, where NODE is
+   S0 S1 S2 ..      the stack, from its top (ST is S0)
+   N0 N1 N2 ..      the input, from the current word
+   N-1 N-2 ..       the words before the current one (PAD for the root)
+   par(X) lc(X) rc(X)
+                    the parent, leftmost and rightmost child of node X,
+                    None if there is none
+   prev(X)          the word before X in the sentence (PAD for the root)
+and ATTR is w (form), t (tag), ct (ctag) or any other token field. the
+attributes of a None node are None, the nodes out of the stack or of the
+sentence are PAD. # starts a comment.
+
+the templates are compiled once into python code: each node and attribute
+they use is looked up once per configuration, whatever the number of
+templates using it, the ones they do not use are not looked up at all, and
+a repeated template is only formatted once.
+"""
+import re
+
+from common import PAD
+
+ATTRS = {'w': 'form', 't': 'tag', 'ct': 'ctag'}
+FUNCS = ('par', 'lc', 'rc', 'prev')
+
+_FUNC = re.compile(r"^(\w+)\((.*)\)$")
+_BASE = re.compile(r"^(ST|S|N)(-?\d*)$")
+
+
+class TemplateError(ValueError):
+    pass
+
+
+class _Compiler:
+    '''
+    the code of an extract function: the lines computing the nodes and
+    attributes, each once, under the names given by node and attr.
+    '''
+
+    def __init__(self):
+        self.lines = []
+        self.names = {}
+
+    def _define(self, key, name, expr):
+        self.names[key] = name
+        self.lines.append("    %s = %s" % (name, expr))
+        return name
+
+    def node(self, spec):
+        '''
+        the variable holding node spec, and whether it may be None
+        '''
+        spec = spec.strip()
+        m = _FUNC.match(spec)
+        if m:
+            func, arg = m.groups()
+            if func not in FUNCS:
+                raise TemplateError("unknown function %s in %s" % (func, spec))
+            x, nullable = self.node(arg)
+            key = "%s(%s)" % (func, x)
+            if key in self.names:
+                return self.names[key], True
+            if func == 'prev':
+                expr = "PAD if %s['id'] == 0 or %s == PAD else sent[%s['id'] - 1]" % (x, x, x)
+            else:
+                expr = "deps.%s(%s)" % ({'par': 'parent', 'lc': 'left_child', 'rc': 'right_child'}[func], x)
+            if nullable:
+                expr = "%s if %s is not None else None" % (expr, x)
+            # prev of a token is a token, the others may be None
+            return self._define(key, "x%d" % len(self.names), expr), nullable or func != 'prev'
+        m = _BASE.match(spec)
+        if not m:
+            raise TemplateError("bad node %s" % spec)
+        kind, k = m.groups()
+        if kind == 'ST':
+            if k:
+                raise TemplateError("bad node %s, ST is S0" % spec)
+            kind, k = 'S', '0'
+        k = int(k or 0)
+        if kind == 'S' and k < 0:
+            raise TemplateError("bad node %s" % spec)
+        key = "%s%d" % (kind, k)
+        if key in self.names:
+            return self.names[key], False
+        if kind == 'S':
+            expr = "stack[-%d] if nstack > %d else PAD" % (k + 1, k)
+            name = "s%d" % k
+        elif k == 0:
+            expr = "sent[i] if i < nsent else PAD"
+            name = "n0"
+        elif k > 0:
+            expr = "sent[i + %d] if i + %d < nsent else PAD" % (k, k)
+            name = "n%d" % k
+        else:
+            expr = "sent[i - %d] if i - %d > 0 else PAD" % (-k, -k)
+            name = "nm%d" % -k
+        return self._define(key, name, expr), False
+
+    def attr(self, spec):
+        '''
+        the variable holding atom spec (NODE.ATTR)
+        '''
+        node, dot, attr = spec.rpartition('.')
+        if not dot or not node or not attr:
+            raise TemplateError("bad atom %s, expected NODE.ATTR" % spec)
+        x, nullable = self.node(node)
+        field = ATTRS.get(attr, attr)
+        key = "%s.%s" % (x, field)
+        if key in self.names:
+            return self.names[key]
+        expr = "%s[%r]" % (x, field)
+        if nullable:
+            expr = "%s if %s else None" % (expr, x)
+        return self._define(key, "a%d" % len(self.names), expr)
+
+
+def parse_templates(templates):
+    '''
+    the templates, one per line, as (label, groups) pairs: groups is the
+    list of the atoms separated by spaces, each a list of the atoms joined
+    by "+".
+    '''
+    parsed = []
+    for line in templates.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        label, colon, atoms = line.partition(':')
+        if not colon or not label.strip() or not atoms.split():
+            raise TemplateError("bad template %r, expected LABEL: ATOM ..." % line)
+        parsed.append((label.strip(), [group.split('+') for group in atoms.split()]))
+    return parsed
+
+
+def _token_node(groups):
+    '''
+    the key of the stack or input position a template only looks at the
+    w, t and ct of (see prepare in compile_templates), else None.
+    '''
+    nodes = set()
+    for group in groups:
+        for atom in group:
+            node, dot, attr = atom.rpartition('.')
+            m = _BASE.match(node.strip())
+            if not m or attr not in ATTRS:
+                return None
+            kind, k = m.groups()
+            nodes.add(("S" if kind == "ST" else kind, k or "0"))
+    if len(nodes) != 1:
+        return None
+    return "%s%s" % nodes.pop()
+
+
+def _extract_source(name, templates, pairs, tables=None):
+    '''
+    the source of function name for the templates, (format, atoms, node)
+    triples. pairs: the function returns the pairs of their features (see
+    compile_templates), or, if "parts", ([], fs, fs, "_") for their features
+    fs, as extract_pairs does. tables: the index in the tables of prepare
+    of each node, the formats of the templates looked up there and their
+    attributes.
+    '''
+    c = _Compiler()
+    if tables:
+        c.lines.append("    entry = prepared.get(id(sent))")
+        c.lines.append("    if entry is None or entry[0] is not sent:")
+        c.lines.append("        if len(prepared) > 64:")
+        c.lines.append("            prepared.clear()")
+        c.lines.append("        entry = prepared[id(sent)] = (sent, prepare(sent))")
+        c.lines.append("    tables = entry[1]")
+        c.lines.append("    if tables is None:")
+        c.lines.append("        return extract_plain(stack, deps, sent, i)")
+    # sent and stack lengths, only looked at for the nodes
+    c.lines.append("    nsent = len(sent)")
+    c.lines.append("    nstack = len(stack)")
+    formats = []
+    for fmt, atoms, node in templates:
+        if tables and node in tables:
+            k, fmts, attrs = tables[node]
+            x = c.node(node)[0]
+            key = "table(%s)" % x
+            g = c.names.get(key)
+            if g is None:
+                # formatted the first time the token is at this position
+                g = c._define(key, "g%d" % k, "tables[%d][%s['id']]" % (k, x))
+                c.lines.append("    if %s is None:" % g)
+                c.lines.append("        %s = tables[%d][%s['id']] = (%s,)" % (g, k, x, ", ".join(
+                    "%r %% (%s,)" % (f, ", ".join("%s[%r]" % (x, a) for a in attrs[f]))
+                    for f in fmts)))
+            formats.append("%s[%d]" % (g, fmts.index(fmt)))
+        else:
+            args = [c.attr(atom) for atom in atoms]
+            formats.append("(%r %% (%s,))" % (fmt, ", ".join(args)))
+    # the repeated templates are formatted once
+    repeated = {}
+    for f in set(formats):
+        if formats.count(f) > 1 and f.startswith("("):
+            repeated[f] = "f%d" % len(repeated)
+            c.lines.append("    %s = %s" % (repeated[f], f))
+    features = "[\n        %s]" % ",\n        ".join(repeated.get(f, f) for f in formats)
+    if pairs == "parts":
+        c.lines.append("    fs = %s" % features)
+        c.lines.append('    return [], fs, fs, "_"')
+    elif pairs:
+        c.lines.append("    fs = %s" % features)
+        c.lines.append('    return ["%s_%s" % (f1, f2) for f1 in fs for f2 in fs]')
+    else:
+        c.lines.append("    return %s" % features)
+    return "def %s(stack, deps, sent, i):\n%s\n" % (name, "\n".join(c.lines))
+
+
+def compile_templates(templates, pairs=False, codes=False, prepare=False):
+    '''
+    the source of extract(stack, deps, sent, i) for the templates (see
+    above). pairs: also returns all the pairs of features, "f1_f2", as
+    EagerMaltEnglishFeatureExtractor(allpairs=True) does, and adds
+    extract_pairs(stack, deps, sent, i), which returns the parts of these
+    pairs, ([], fs, fs, "_"), for the models to conjoin them (see
+    ml.conjunctions): hashed models do so without making the strings.
+    codes: the features are labeled by the number of their template
+    instead.
+
+    prepare: the templates on a single stack or input position (STwt: S0.w+S0.t)
+    are formatted once per sentence and token, the first time the token is
+    at that position, into tables made by prepare(sent) and indexed by token
+    id. the tables of the last sentences are kept in prepared, by sentence
+    (the parsers make a new list for each sentence they parse). when the
+    token ids are not their positions, extract_plain formats them at each
+    configuration instead. the lookups cost about as much as formatting a
+    template on one or two attributes, so the registered extractors do not
+    prepare: it pays for templates that are costlier to format.
+    '''
+    compiled = []
+    seen = {}
+    for label, groups in parse_templates(templates):
+        fmt = "_".join("%s" * len(group) for group in groups)
+        atoms = [atom.strip() for group in groups for atom in group]
+        key = (label, fmt, tuple(atoms))
+        if key not in seen:
+            seen[key] = ("%x" % len(seen) if codes else label) + "_" + fmt
+        compiled.append((seen[key], atoms, _token_node(groups) if prepare else None))
+    tables = {}
+    for fmt, atoms, node in compiled:
+        if node is not None:
+            k, fmts, attrs = tables.setdefault(node, (len(tables), [], {}))
+            if fmt not in fmts:
+                fmts.append(fmt)
+                attrs[fmt] = [ATTRS[atom.rpartition('.')[2]] for atom in atoms]
+    source = ""
+    if pairs:
+        source = "\n" + _extract_source("extract_pairs", compiled, "parts")
+    if not tables:
+        return _extract_source("extract", compiled, pairs) + source
+    prepare = ("def prepare(sent):\n"
+               "    for k, t in enumerate(sent):\n"
+               "        if t['id'] != k:\n"
+               "            return None\n"
+               "    # the last one for PAD (id -1)\n"
+               "    return tuple([None] * (len(sent) + 1) for _ in range(%d))\n" % len(tables))
+    return "%s\n%s\n%s%s" % (
+        prepare,
+        _extract_source("extract_plain", compiled, pairs),
+        _extract_source("extract", compiled, pairs, tables),
+        source)
+
+
+class TemplateFeatureExtractor:  # {{{
+    """
+    a feature extractor compiled from templates (see compile_templates)
+    """
+
+    def __init__(self, templates, pairs=False, codes=False, prepare=False):
+        self.templates = templates
+        self.pairs = pairs
+        self.codes = codes
+        self.prepare = prepare
+        self.source = compile_templates(templates, pairs, codes, prepare)
+        scope = {'PAD': PAD, 'prepared': {}}
+        exec(compile(self.source, "<templates>", "exec"), scope)
+        self.extract = scope['extract']
+        if pairs:
+            self.extract_pairs = scope['extract_pairs']
+
+    def __getstate__(self):
+        return (self.templates, self.pairs, self.codes, self.prepare)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+    #}}}
+
+
+# the templates of the registered extractors (see extractors.py)
+
+EAGER_ZHANG = """
+# arc-eager features from "Tale of two parsers", table 3
+# stack top
+STwt: S0.w+S0.t
+STw: S0.w
+STt: S0.t
+# current word
+N0wt: N0.w+N0.t
+N0t: N0.t
+N0w: N0.w
+# next word
+N1wt: N1.w+N1.t
+N1t: N1.t
+N1w: N1.w
+# ST and N0
+STwtN0wt: S0.w S0.t N0.w N0.t
+STwtN0w: S0.w S0.t N0.w
+STwN0wt: S0.w N0.w N0.t
+STwtN0t: S0.w S0.t N0.t
+STtN0wt: S0.t N0.w N0.t
+STwN0w: S0.w N0.w
+STtN0t: S0.t N0.t
+# pos bigram
+N0tN1t: N0.t N1.t
+# pos trigram
+N0tN1tN2t: N0.t N1.t N2.t
+STtN0tN1t: S0.t N0.t N1.t
+STPtSTtN0t: par(S0).t S0.t N0.t
+STtSTLCtN0t: S0.t lc(S0).t N0.t
+STtSTRCtN0t: S0.t rc(S0).t N0.t
+STtN0tN0LCt: S0.t N0.t lc(N0).t
+# N0 word
+N0wN1tN2t: N0.w N1.t N2.t
+STtN0wN1t: S0.t N0.w N1.t
+STPtSTtN0w: par(S0).t S0.t N0.w
+STtSTLCtN0w: S0.t lc(S0).t N0.w
+STtSTRCtN0w: S0.t rc(S0).t N0.w
+STtN0wN0LCt: S0.t N0.w lc(N0).t
+"""
+
+EAGER_ZHANG_EXT = EAGER_ZHANG + """
+# extended
+N-1tN0t: N-1.t N0.t
+N-2tN-1t: N-2.t N-1.t
+N-3tN-2t: N-3.t N-2.t
+N-1tN0tN0w: N-1.t N0.t N0.w
+N-1tN-1wN0w: N-1.t N-1.w N0.t
+"""
+
+EAGER_MALT_ENGLISH = """
+# English malt-parser features, based on eng.par, without the dep features
+ps: S0.t
+pi: N0.t
+pi1: N1.t
+pi2: N2.t
+pi3: N3.t
+ps1: S1.t
+ps000-1: lc(S0).t
+pi000-1: lc(N0).t
+cps: S0.ct
+cpi: N0.ct
+cps0-1: prev(S0).ct
+ls: S0.w
+li: N0.w
+li1: N1.w
+ls001: par(S0).w
+"""
+
+WENBIN_UNIGRAMS = """
+s: S0.w
+s1: S1.w
+w: N0.w
+Ts: S0.t
+Ts1: S1.t
+Tw: N0.t
+Tss: S0.t S0.w
+Ts1s1: S1.t S1.w
+Tww: N0.t N0.w
+"""
+
+WENBIN_BIGRAMS = """
+ss1: S0.w S1.w
+Tss1Ts1: S0.t S1.w S1.t
+sTss1: S0.w S0.t S1.w
+TsTs1: S0.t S1.t
+ss1Ts1: S0.w S1.w S1.t
+sTss1Ts1: S0.w S0.t S1.w S1.t
+TsTw: S0.t N0.t
+sTsTs1: S0.w S0.t S1.t
+ws1: N0.w S1.w
+ws: N0.w S0.w
+wTs1: N0.w S1.t
+wTs: N0.w S0.t
+"""
+
+WENBIN_TRIGRAMS = """
+TsTwTw1: S0.t N0.t N1.t
+sTwTw1: S0.w N0.t N1.t
+Ts1TsTw: S1.t S0.t N0.t
+Ts1sTw1: S1.t S0.w N0.t
+Ts2Ts1Ts: S2.t S1.t S0.t
+# modifier
+Ts1Tlcs1Ts: S1.t lc(S1).t S0.t
+Ts1TsTrcs: S1.t S0.t rc(S0).t
+Ts1sTlcs: S1.t S0.w lc(S0).t
+Ts1Trcs1Ts: S1.t rc(S1).t S0.t
+Ts1Tlcs1Ts: S1.t lc(S1).t S0.t
+Ts1TsTlcs: S1.t S0.t lc(S0).t
+Ts1Trcs1s: S1.t rc(S1).t S0.w
+"""
+
+WENBIN = WENBIN_UNIGRAMS + WENBIN_BIGRAMS + WENBIN_TRIGRAMS
+
+WENBIN_PLUS = WENBIN_UNIGRAMS + """
+# the pos of the two previous words
+Twm1: N-1.t
+Twm2: N-2.t
+Twm1: N-1.t N-1.w
+Twm2: N-2.t N-1.w
+""" + WENBIN_BIGRAMS + """
+TwTwm1: N0.t N-1.t
+Twm1Twm2: N-1.t N-2.t
+""" + WENBIN_TRIGRAMS
+
+DEGREE2 = """
+# all the pairs of these (pairs=True)
+s: S0.w
+s1: S1.w
+w: N0.w
+w1: N1.w
+Ts: S0.t
+Ts1: S1.t
+Tw: N0.t
+Tw1: N1.t
+Tlcs: lc(S0).t
+Tlcs1: lc(S1).t
+Trcs: rc(S0).t
+Trcs1: rc(S1).t
+"""
+
+UNLEX = """
+Ts: S0.t
+Ts1: S1.t
+Tw: N0.t
+TsTs1: S0.t S1.t
+TsTw: S0.t N0.t
+TsTwTw1: S0.t N0.t N1.t
+Ts1TsTw: S1.t S0.t N0.t
+Ts2Ts1Ts: S2.t S1.t S0.t
+# modifier
+Ts1Tlcs1Ts: S1.t lc(S1).t S0.t
+Ts1TsTrcs: S1.t S0.t rc(S0).t
+Ts1Trcs1Ts: S1.t rc(S1).t S0.t
+Ts1Tlcs1Ts: S1.t lc(S1).t S0.t
+Ts1TsTlcs: S1.t S0.t lc(S0).t
+"""
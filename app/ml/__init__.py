@@ -0,0 +1,34 @@
+"""
+linear classifiers for the parsers, with two interchangeable backends:
+
+   cython   ml.ml, compiled from ml.pyx (see README)
+   numpy    ml.npml, pure python + numpy, nothing to build
+
+both provide MulticlassModel, MultitronParameters, LinearModel,
+MulticlassLinearModel and the model file functions, and read and write
+the same model files.
+"""
+from __future__ import absolute_import
+
+import os
+
+BACKENDS = ["cython", "numpy"]
+
+
+def get_backend(name=None):
+    '''
+    the ml module of the given backend. name defaults to $ML_BACKEND, and
+    if that is not set either to cython when it is built, else numpy.
+    '''
+    name = name or os.environ.get("ML_BACKEND")
+    if name not in (None, "cython", "numpy"):
+        raise ValueError("unknown ml backend %s, possible values: %s" % (name, BACKENDS))
+    if name != "numpy":
+        try:
+            from ml import ml
+            return ml
+        except ImportError:
+            if name == "cython":
+                raise
+    from ml import npml
+    return npml
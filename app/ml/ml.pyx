@@ -20,8 +20,19 @@ Author: Yoav Goldberg (yoav.goldberg@gmail.com)
 
 import sys
 import math
+import os
+import struct
+import array
+import numpy as np
 
 from stdlib cimport *
+cimport cython
+from cpython cimport array
+from libc.math cimport exp, fabs, ldexp, INFINITY, NAN
+from libc.stdlib cimport strtod
+from libc.string cimport memcmp, memcpy, memset
+from libc.stdint cimport int8_t, uint8_t, uint16_t, uint32_t, uint64_t, int64_t
+from posix.mman cimport mmap, munmap, PROT_READ, MAP_SHARED, MAP_FAILED
 
 
 cdef class DoublesArr:
@@ -38,188 +49,1601 @@ cdef class DoublesArr:
    def __dealloc__(self):
       free(self.vals)
 
-cdef class MulticlassModel: 
+### Model files {{{
+#
+# text models are Megam-style: one feature per line, followed by one weight
+# per class (this is what MultitronParameters.dump writes).
+#
+# binary models are a versioned image meant to be mmap-ed read only, so that
+# all the processes loading the same model share its pages:
+#
+#    header   BINARY_HEADER, 64 bytes
+#    slots    nslots x (uint64 hash, int64 row), open addressing (load <= 3/4) with
+#             linear probing over the FNV-1a hash of the feature
+#    offsets  (nrows+1) x uint64, start of each feature in the keys blob
+#    keys     the feature strings, concatenated (padded to 8 bytes)
+#    weights  nrows x nclasses, row major, stored as dtype
+#
+# dtypes are f8/f4/f2 (IEEE double, single and half floats) and i8: one
+# float32 scale per row (padded to 8 bytes), followed by the weights as
+# int8, weight = q * scale.
+#
+# hashed models (see "feature hashing" in MultitronParameters) have no
+# slots, offsets or keys: the row of a feature is the low hash_bits bits of
+# its hash, and with FLAG_SIGNED the high bit of the hash gives its sign.
+#
+# everything is little endian.
+
+BINARY_MAGIC = b"TDPMODEL"
+BINARY_VERSION = 1
+# magic, version, flags, nclasses, dtype, nrows, nslots, keys_size, hash_bits
+BINARY_HEADER = "<8sIIIIQQQI12x"
+
+cdef enum:
+   FLAG_HASHED = 1
+   FLAG_SIGNED = 2
+
+cdef enum:
+   DTYPE_F8 = 0
+   DTYPE_F4 = 1
+   DTYPE_F2 = 2
+   DTYPE_I8 = 3
+
+DTYPES = {"f8": DTYPE_F8, "f4": DTYPE_F4, "f2": DTYPE_F2, "i8": DTYPE_I8}
+
+# hashed tables have at most 2**MAX_HASH_BITS rows
+MAX_HASH_BITS = 30
+
+cdef _check_hash_bits(hash_bits):
+   if not 0 <= hash_bits <= MAX_HASH_BITS:
+      raise ValueError("hash_bits must be between 0 and %s, got %s" % (MAX_HASH_BITS, hash_bits))
+
+cdef inline uint64_t _scales_size(uint64_t nrows) nogil:
+   return (nrows * sizeof(float) + 7) & ~7
+
+cdef uint64_t _weights_size(int dtype, uint64_t nrows, int nclasses):
+   cdef uint64_t n = nrows * nclasses
+   if dtype == DTYPE_F8: return 8 * n
+   if dtype == DTYPE_F4: return 4 * n
+   if dtype == DTYPE_F2: return 2 * n
+   return _scales_size(nrows) + n
+
+cdef inline double _half(uint16_t h) nogil:
+   cdef int e = (h >> 10) & 0x1f
+   cdef int m = h & 0x3ff
+   cdef double r
+   if e == 0:
+      r = ldexp(m, -24)
+   elif e == 31:
+      r = INFINITY if m == 0 else NAN
+   else:
+      r = ldexp(m + 1024, e - 25)
+   return -r if h & 0x8000 else r
+
+cdef packed struct Slot:
+   uint64_t hash
+   int64_t row
+
+cdef bint _valid_index(Slot *slots, uint64_t nslots, uint64_t *offsets,
+                       uint64_t nrows, uint64_t keys_size) nogil:
+   """
+   every slot is empty or points to a row, and the keys of the rows are
+   within the keys blob.
+   """
+   cdef uint64_t j
+   for j in range(nslots):
+      if slots[j].row >= <int64_t>nrows:
+         return False
+   for j in range(nrows):
+      if offsets[j] > offsets[j + 1]:
+         return False
+   return offsets[nrows] <= keys_size
+
+cdef inline uint64_t _fnv1a_from(uint64_t h, const char *s, Py_ssize_t n) nogil:
+   """
+   the hash h of a key, continued over the bytes s[:n]: the hash of the
+   key followed by s[:n].
+   """
+   cdef Py_ssize_t i
+   for i in range(n):
+      h = (h ^ <unsigned char>s[i]) * 1099511628211ULL
+   return h
+
+cdef inline uint64_t _fnv1a(const char *s, Py_ssize_t n) nogil:
+   return _fnv1a_from(14695981039346656037ULL, s, n)
+
+cdef inline bytes _as_bytes(f):
+   if isinstance(f, unicode):
+      return (<unicode>f).encode("utf8")
+   return f
+
+cdef inline uint64_t _feature_hash(f) except? 0:
+   cdef bytes b = _as_bytes(f)
+   return _fnv1a(b, len(b))
+
+cdef inline double _hash_sign(uint64_t h, bint signed) nogil:
+   if signed and (h >> 63):
+      return -1.0
+   return 1.0
+
+cdef inline Py_ssize_t _slot_find(Slot *slots, uint64_t mask, uint64_t *offsets,
+                                  const char *keys, uint64_t h, const char *s, Py_ssize_t n) nogil:
+   """
+   the row of the key s[:n], whose hash is h, in a slot table, or -1.
+   """
+   cdef uint64_t j = h & mask
+   cdef int64_t r
+   while True:
+      r = slots[j].row
+      if r < 0:
+         return -1
+      if (slots[j].hash == h
+            and offsets[r + 1] - offsets[r] == <uint64_t>n
+            and memcmp(keys + offsets[r], s, n) == 0):
+         return r
+      j = (j + 1) & mask
+
+cdef inline Py_ssize_t _slot_lookup(Slot *slots, uint64_t mask, uint64_t *offsets,
+                                    const char *keys, const char *s, Py_ssize_t n) nogil:
+   """
+   the row of the key s[:n] in a slot table, or -1.
+   """
+   return _slot_find(slots, mask, offsets, keys, _fnv1a(s, n), s, n)
+
+def feature_hash(f):
+   """
+   the (stable, 64bit) hash of a feature string used in binary models
+   and in feature hashing
+   """
+   return _feature_hash(f)
+
+def conjunctions(list left, list right, sep="_"):
+   """
+   the conjunctions of two feature lists: f1 + sep + f2 for each f1 of
+   left and f2 of right, in that order.
+   the pair_ids / update_pairs / do_pa_update_pairs methods take the two
+   lists instead, and look the conjunctions up without making them when
+   the features are hashed.
+   """
+   return [l + f2 for l in [f1 + sep for f1 in left] for f2 in right]
+
+cdef int _pair_hashes(list left, list right, sep, uint64_t *out) except -1:
+   """
+   out[i*len(right) + j] = the hash of conjunctions(left, right, sep)[i*len(right) + j],
+   the hash of left[i] + sep continued over the bytes of right[j]: no
+   conjunction string is made.
+   """
+   cdef bytes bsep = _as_bytes(sep), b
+   cdef list rights = [_as_bytes(f) for f in right]
+   cdef Py_ssize_t i, j, m = len(right)
+   cdef uint64_t h
+   for i in range(len(left)):
+      b = _as_bytes(left[i])
+      h = _fnv1a_from(_fnv1a(b, len(b)), bsep, len(bsep))
+      for j in range(m):
+         b = rights[j]
+         out[i*m + j] = _fnv1a_from(h, b, len(b))
+   return 0
+
+def read_text_model(fname):
+   """
+   reads a text model.
+   returns (features, weights, nclasses), where weights is an array('d')
+   holding one row of nclasses weights per feature.
+   """
+   cdef list features = []
+   cdef array.array weights = array.array('d')
+   cdef int nclasses = -1
+   for line in open(fname):
+      if not line.strip(): continue
+      f,ws = line.strip().split(None,1)
+      ws = [float(w) for w in ws.split()]
+      if nclasses < 0:
+         nclasses = len(ws)
+      elif len(ws) != nclasses:
+         raise ValueError("%s: feature %s has %s weights, expected %s" % (fname, f, len(ws), nclasses))
+      features.append(f)
+      weights.fromlist(ws)
+   if nclasses < 0:
+      raise ValueError("%s: empty model" % fname)
+   return features, weights, nclasses
+
+cdef _write_header(out, int flags, int nclasses, dtype, uint64_t nrows,
+                   uint64_t nslots=0, uint64_t keys_size=0, int hash_bits=0):
+   assert sys.byteorder == "little", "binary models are little endian"
+   if dtype not in DTYPES:
+      raise ValueError("unknown dtype %s, possible values: %s" % (dtype, DTYPES.keys()))
+   out.write(struct.pack(BINARY_HEADER, BINARY_MAGIC, BINARY_VERSION, flags,
+                         nclasses, DTYPES[dtype], nrows, nslots, keys_size, hash_bits))
+
+cdef _write_weights(out, array.array weights, int nclasses, dtype):
+   if dtype == "f8":
+      out.write(weights.tostring())
+   elif dtype == "f4":
+      out.write(array.array('f', weights).tostring())
+   else:
+      ws = np.frombuffer(weights, dtype=np.float64).reshape(-1, nclasses)
+      if dtype == "f2":
+         out.write(ws.astype("<f2").tobytes())
+         return
+      scales = (np.abs(ws).max(axis=1) / 127.0).astype("<f4")
+      q = np.rint(ws / np.where(scales > 0, scales, 1)[:, None])
+      out.write(scales.tobytes())
+      out.write(b"\0" * (_scales_size(len(scales)) - scales.nbytes))
+      out.write(np.clip(q, -127, 127).astype(np.int8).tobytes())
+
+def prune_model(list features, array.array weights, int nclasses, double threshold):
+   """
+   drops the features whose weights are all below threshold (in absolute
+   value). the **BIAS** feature is always kept.
+   returns (features, weights) of the kept features.
+   """
+   cdef list kept = []
+   cdef array.array ws = array.array('d')
+   cdef double *w
+   cdef Py_ssize_t r
+   cdef int c
+   for r in xrange(len(features)):
+      if features[r] is None:
+         # a free row (see MultitronParameters.limit_features)
+         continue
+      w = weights.data.as_doubles + r * nclasses
+      for c in xrange(nclasses):
+         if w[c] >= threshold or w[c] <= -threshold:
+            break
+      else:
+         if features[r] != '**BIAS**':
+            continue
+      kept.append(features[r])
+      array.extend_buffer(ws, <char *>w, nclasses)
+   return kept, ws
+
+def write_hashed_model(out, array.array weights, int nclasses, int hash_bits, bint signed, dtype="f8"):
+   """
+   writes a hashed binary model to the file object out.
+
+   weights: array('d') of (2**hash_bits)*nclasses weights, row major
+   """
+   _check_hash_bits(hash_bits)
+   assert len(weights) == (1 << hash_bits) * nclasses, "weights do not match hash_bits"
+   _write_header(out, FLAG_HASHED | (FLAG_SIGNED if signed else 0), nclasses, dtype,
+                 1 << hash_bits, 0, 0, hash_bits)
+   _write_weights(out, weights, nclasses, dtype)
+
+cdef class FeatureIndex:
+   """
+   feature -> row index, with the slot table of binary models: the
+   features are kept as one blob of bytes, which takes a fraction of the
+   memory of a dict of feature strings. rows are only ever added.
+   """
+   cdef Slot *slots
+   cdef uint64_t nslots
+   cdef uint64_t mask
+   cdef uint64_t *offsets
+   cdef char *keys
+   cdef uint64_t keys_capacity
+   cdef readonly Py_ssize_t nrows
+   cdef Py_ssize_t rows_capacity
+
+   def __cinit__(self):
+      self.slots = NULL
+      self.offsets = NULL
+      self.keys = NULL
+
+   def __init__(self, list features):
+      """
+      features: list of (distinct) feature strings, one per row
+      """
+      cdef bytes key
+      cdef Py_ssize_t r
+      self.nrows = 0
+      self._reserve(len(features), 0)
+      for r in range(len(features)):
+         key = _as_bytes(features[r])
+         if self._insert(key, len(key)) != r:
+            raise ValueError("duplicate feature %r" % features[r])
+
+   def __dealloc__(self):
+      free(self.slots)
+      free(self.offsets)
+      free(self.keys)
+
+   cdef int _reserve(self, Py_ssize_t nrows, uint64_t nkeys) except -1:
+      """
+      makes room for nrows rows with nkeys bytes of keys
+      """
+      cdef uint64_t nslots = max(16, self.nslots), j, k
+      cdef Slot *slots
+      cdef void *p
+      if nrows > self.rows_capacity or self.offsets == NULL:
+         nrows = max(nrows, 2 * self.rows_capacity)
+         p = realloc(self.offsets, (nrows + 1) * sizeof(uint64_t))
+         if p == NULL: raise MemoryError()
+         self.offsets = <uint64_t *>p
+         if self.rows_capacity == 0: self.offsets[0] = 0
+         self.rows_capacity = nrows
+      if nkeys > self.keys_capacity or self.keys == NULL:
+         nkeys = max(nkeys, 2 * self.keys_capacity, 64)
+         p = realloc(self.keys, nkeys)
+         if p == NULL: raise MemoryError()
+         self.keys = <char *>p
+         self.keys_capacity = nkeys
+      while 3 * nslots < 4 * <uint64_t>nrows: nslots *= 2
+      if nslots == self.nslots:
+         return 0
+      slots = <Slot *>malloc(nslots * sizeof(Slot))
+      if slots == NULL: raise MemoryError()
+      for j in range(nslots):
+         slots[j].hash = 0
+         slots[j].row = -1
+      for j in range(self.nslots):
+         if self.slots[j].row < 0: continue
+         k = self.slots[j].hash & (nslots - 1)
+         while slots[k].row != -1:
+            k = (k + 1) & (nslots - 1)
+         slots[k] = self.slots[j]
+      free(self.slots)
+      self.slots = slots
+      self.nslots = nslots
+      self.mask = nslots - 1
+      return 0
+
+   cdef _trim(self):
+      """
+      gives back the room reserved for more rows
+      """
+      cdef void *p
+      p = realloc(self.offsets, (self.nrows + 1) * sizeof(uint64_t))
+      if p != NULL:
+         self.offsets = <uint64_t *>p
+         self.rows_capacity = self.nrows
+      if self.offsets[self.nrows] > 0:
+         p = realloc(self.keys, self.offsets[self.nrows])
+         if p != NULL:
+            self.keys = <char *>p
+            self.keys_capacity = self.offsets[self.nrows]
+
+   cdef Py_ssize_t _insert(self, const char *s, Py_ssize_t n) except -1:
+      """
+      the row of the key s[:n], added as a new row if it is not there
+      """
+      cdef uint64_t h = _fnv1a(s, n)
+      cdef uint64_t j
+      cdef int64_t r
+      cdef Py_ssize_t row = self.nrows
+      if self.nrows == self.rows_capacity or 3 * self.nslots < 4 * <uint64_t>(self.nrows + 1):
+         self._reserve(self.nrows + 1, 0)
+      j = h & self.mask
+      while True:
+         r = self.slots[j].row
+         if r < 0:
+            break
+         if (self.slots[j].hash == h
+               and self.offsets[r + 1] - self.offsets[r] == <uint64_t>n
+               and memcmp(self.keys + self.offsets[r], s, n) == 0):
+            return r
+         j = (j + 1) & self.mask
+      if self.offsets[row] + n > self.keys_capacity:
+         self._reserve(0, self.offsets[row] + n)
+      memcpy(self.keys + self.offsets[row], s, n)
+      self.offsets[row + 1] = self.offsets[row] + n
+      self.slots[j].hash = h
+      self.slots[j].row = row
+      self.nrows += 1
+      return row
+
+   cdef bytes _key(self, Py_ssize_t r):
+      return self.keys[self.offsets[r]:self.offsets[r + 1]]
+
+   cdef Py_ssize_t lookup(self, f) except -2:
+      """
+      the row of feature f, or -1
+      """
+      cdef bytes b = _as_bytes(f)
+      return _slot_lookup(self.slots, self.mask, self.offsets, self.keys, b, len(b))
+
+   def __len__(self):
+      return self.nrows
+
+   def __contains__(self, f):
+      return self.lookup(f) >= 0
+
+   cdef _write(self, out, int nclasses, dtype):
+      """
+      writes the header, slots, offsets and keys of a binary model
+      """
+      cdef uint64_t size = self.offsets[self.nrows]
+      blob = self.keys[:size] + b"\0" * (-size % 8)
+      _write_header(out, 0, nclasses, dtype, self.nrows, self.nslots, len(blob))
+      out.write((<char *>self.slots)[:self.nslots * sizeof(Slot)])
+      out.write((<char *>self.offsets)[:(self.nrows + 1) * sizeof(uint64_t)])
+      out.write(blob)
+
+cdef class FeatureVocabulary(FeatureIndex):
+   """
+   interns feature strings to dense integer ids: 0, 1, ... in the order
+   they are first seen (e.g. at training time). once frozen, unknown
+   features get no id. dump writes the features in id order, and
+   FeatureVocabulary(features) reads them back.
+   """
+   cdef readonly bint frozen
+
+   def __init__(self, list features=None):
+      FeatureIndex.__init__(self, features or [])
+      self.frozen = False
+
+   cpdef array.array ids(self, list features):
+      """
+      the ids of the features, as an array('l'). unknown features are
+      added, or left out once the vocabulary is frozen.
+      """
+      cdef array.array ids = array.array('l')
+      cdef bytes key
+      cdef Py_ssize_t r, k = 0
+      array.resize(ids, len(features))
+      for f in features:
+         key = _as_bytes(f)
+         if self.frozen:
+            r = _slot_lookup(self.slots, self.mask, self.offsets, self.keys, key, len(key))
+            if r < 0: continue
+         else:
+            r = self._insert(key, len(key))
+         ids.data.as_longs[k] = r
+         k += 1
+      array.resize(ids, k)
+      return ids
+
+   def freeze(self):
+      self.frozen = True
+      self._trim()
+
+   def feature(self, Py_ssize_t i):
+      """
+      the feature of id i
+      """
+      if not 0 <= i < self.nrows:
+         raise IndexError("no feature id %s" % i)
+      return self._key(i)
+
+   def dump(self, out):
+      """
+      writes the features to out, one per line, in id order
+      """
+      cdef Py_ssize_t r
+      for r in range(0, self.nrows, 4096):
+         out.write("".join([self._key(k) + "\n" for k in range(r, min(r + 4096, self.nrows))]))
+
+cdef inline bint _isspace(char c) nogil:
+   return c == b' ' or c == b'\t' or c == b'\n' or c == b'\r' or c == b'\v' or c == b'\f'
+
+cdef Py_ssize_t _read_weight_line(FeatureIndex index, line, float *w) except -2:
+   """
+   reads a "feature weight" line of a text model into the index, and
+   returns its row (and the weight in w), or -1 for an empty line.
+   """
+   cdef bytes b = _as_bytes(line)
+   cdef const char *s = b
+   cdef Py_ssize_t n = len(b), k, e
+   cdef char *end
+   while n and _isspace(s[n - 1]): n -= 1
+   if n == 0:
+      return -1
+   k = n
+   while k and not _isspace(s[k - 1]): k -= 1
+   w[0] = strtod(s + k, &end)
+   e = k
+   while e and _isspace(s[e - 1]): e -= 1
+   if end != s + n or k == 0 or e == 0:
+      raise ValueError("bad model line %r" % line)
+   k = 0
+   while _isspace(s[k]): k += 1
+   return index._insert(s + k, e - k)
+
+def write_binary_model(out, list features, array.array weights, int nclasses, dtype="f8"):
+   """
+   writes a binary model to the file object out.
+
+   features: list of feature strings, one per row
+   weights:  array('d') of len(features)*nclasses weights, row major
+   dtype:    "f8", "f4", "f2" or "i8"
+   """
+   assert len(weights) == len(features) * nclasses, "weights do not match features"
+   FeatureIndex(features)._write(out, nclasses, dtype)
+   _write_weights(out, weights, nclasses, dtype)
+
+def convert_text_model(text_fname, bin_fname, dtype="f8", double prune=0.0):
+   """
+   converts a text model (e.g. the output of MultitronParameters.dump)
+   to a binary one, optionally pruning it (see prune_model).
+   returns (nfeatures, nkept, nclasses).
+   """
+   features, weights, nclasses = read_text_model(text_fname)
+   nfeatures = len(features)
+   if prune > 0:
+      features, weights = prune_model(features, weights, nclasses, prune)
+   with open(bin_fname, "wb") as out:
+      write_binary_model(out, features, weights, nclasses, dtype)
+   return nfeatures, len(features), nclasses
+
+def is_binary_model(fname):
+   with open(fname, "rb") as fh:
+      return fh.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+cdef class WeightTable:
+   """
+   read only feature -> row of per-class weights mapping, backing a
+   MulticlassModel.
+   """
+   cdef readonly int nclasses
+   cdef readonly Py_ssize_t nrows
+   cdef readonly bint hashed
+   cdef readonly bint hash_signed
+
+   cdef Py_ssize_t lookup(self, f, double *v) except -2:
+      """
+      the row of feature f, or -1 if it is not in the model.
+      the sign of f under signed hashing is folded into v.
+      """
+      return -1
+
+   cdef list features(self):
+      """
+      the feature of each row, None for hashed tables.
+      """
+      return None
+
+   cdef void add_row(self, double *scores, Py_ssize_t row, double v) nogil:
+      """
+      scores[c] += weight[row,c] * v
+      """
+      pass
+
+cdef class TextWeightTable(WeightTable):
+   cdef dict index
+   cdef array.array weights
+
+   def __init__(self, fname):
+      features, self.weights, self.nclasses = read_text_model(fname)
+      self.nrows = len(features)
+      self.index = dict(zip(features, xrange(self.nrows)))
+
+   cdef Py_ssize_t lookup(self, f, double *v) except -2:
+      return self.index.get(f, -1)
+
+   cdef list features(self):
+      cdef list features = [None] * self.nrows
+      for f,r in self.index.iteritems():
+         features[r] = f
+      return features
+
+   cdef void add_row(self, double *scores, Py_ssize_t row, double v) nogil:
+      cdef double *ws = self.weights.data.as_doubles + row * self.nclasses
+      cdef int i
+      for i in range(self.nclasses):
+         scores[i] += ws[i] * v
+
+cdef class MappedWeightTable(WeightTable):
+   cdef void *base
+   cdef size_t size
+   cdef Slot *slots
+   cdef uint64_t mask
+   cdef uint64_t *offsets
+   cdef const char *keys
+   cdef void *weights
+   cdef float *scales
+   cdef readonly int dtype
+
+   def __cinit__(self):
+      self.base = NULL
+
+   def __init__(self, fname):
+      cdef void *base
+      cdef size_t size, offset
+      cdef uint64_t nrows, nslots, keys_size
+      cdef int flags
+      cdef size_t hsize = struct.calcsize(BINARY_HEADER)
+      with open(fname, "rb") as fh:
+         header = fh.read(hsize)
+         if len(header) < hsize:
+            raise ValueError("%s: truncated binary model" % fname)
+         magic, version, flags, nclasses, dtype, nrows, nslots, keys_size, hash_bits = struct.unpack(BINARY_HEADER, header)
+         if magic != BINARY_MAGIC:
+            raise ValueError("%s is not a binary model" % fname)
+         if version != BINARY_VERSION:
+            raise ValueError("%s: unsupported binary model version %s" % (fname, version))
+         if dtype not in DTYPES.values():
+            raise ValueError("%s: unknown dtype %s" % (fname, dtype))
+         size = os.fstat(fh.fileno()).st_size
+         if flags & FLAG_HASHED:
+            if hash_bits > MAX_HASH_BITS or nrows != (1 << hash_bits):
+               raise ValueError("%s: bad hashed model" % fname)
+            offset = hsize
+         else:
+            # a power of two with at least one free slot, or _lookup never ends
+            if nslots == 0 or nslots & (nslots - 1) or nrows >= nslots:
+               raise ValueError("%s: bad slot table" % fname)
+            if nslots > size or keys_size > size:
+               raise ValueError("%s: truncated binary model" % fname)
+            offset = hsize + nslots * sizeof(Slot) + (nrows + 1) * sizeof(uint64_t) + keys_size
+         if nclasses == 0 or nrows > size or size < offset + _weights_size(dtype, nrows, nclasses):
+            raise ValueError("%s: truncated binary model" % fname)
+         base = mmap(NULL, size, PROT_READ, MAP_SHARED, fh.fileno(), 0)
+         if base == MAP_FAILED:
+            raise OSError("could not mmap %s" % fname)
+      self.base = base
+      self.size = size
+      self.nclasses = nclasses
+      self.nrows = nrows
+      self.dtype = dtype
+      self.hashed = flags & FLAG_HASHED
+      self.hash_signed = (flags & FLAG_SIGNED) != 0
+      if self.hashed:
+         self.mask = nrows - 1
+      else:
+         self.mask = nslots - 1
+         self.slots = <Slot *>(<char *>base + hsize)
+         self.offsets = <uint64_t *>(self.slots + nslots)
+         self.keys = <const char *>(self.offsets + nrows + 1)
+         if not _valid_index(self.slots, nslots, self.offsets, nrows, keys_size):
+            raise ValueError("%s: corrupt binary model" % fname)
+      self.weights = <char *>base + offset
+      if dtype == DTYPE_I8:
+         self.scales = <float *>self.weights
+         self.weights = <char *>self.weights + _scales_size(nrows)
+
+   def __dealloc__(self):
+      if self.base != NULL:
+         munmap(self.base, self.size)
+
+   cdef Py_ssize_t lookup(self, f, double *v) except -2:
+      cdef bytes b = _as_bytes(f)
+      cdef uint64_t h
+      if self.hashed:
+         h = _fnv1a(b, len(b))
+         v[0] *= _hash_sign(h, self.hash_signed)
+         return h & self.mask
+      return _slot_lookup(self.slots, self.mask, self.offsets, self.keys, b, len(b))
+
+   cdef list features(self):
+      cdef Py_ssize_t r
+      if self.hashed:
+         return None
+      return [self.keys[self.offsets[r]:self.offsets[r+1]] for r in range(self.nrows)]
+
+   cdef void add_row(self, double *scores, Py_ssize_t row, double v) nogil:
+      cdef double *wd
+      cdef float *wf
+      cdef uint16_t *wh
+      cdef int8_t *wq
+      cdef int i
+      if self.dtype == DTYPE_F8:
+         wd = <double *>self.weights + row * self.nclasses
+         for i in range(self.nclasses):
+            scores[i] += wd[i] * v
+      elif self.dtype == DTYPE_F4:
+         wf = <float *>self.weights + row * self.nclasses
+         for i in range(self.nclasses):
+            scores[i] += wf[i] * v
+      elif self.dtype == DTYPE_F2:
+         wh = <uint16_t *>self.weights + row * self.nclasses
+         for i in range(self.nclasses):
+            scores[i] += _half(wh[i]) * v
+      else:
+         wq = <int8_t *>self.weights + row * self.nclasses
+         v *= self.scales[row]
+         for i in range(self.nclasses):
+            scores[i] += wq[i] * v
+#}}}
+
+cdef enum:
+   # per call buffers up to these sizes live on the stack
+   STACK_CLASSES = 64
+   STACK_FEATURES = 256
+
+cdef enum:
+   # the kinds of features MulticlassModel scores
+   FEATURE_LIST = 0 # feature strings
+   REAL_LIST = 1    # (feature, value) pairs
+   ID_ARRAY = 2     # ids, see MulticlassModel.ids
+   ID_VALUES = 3    # (ids, values), see MulticlassModel.ids_r
+
+cdef inline object _real_feature(item, double *v):
+   """
+   the feature of item, a (feature, value) pair or a plain feature (value
+   1), with its value in v.
+   """
+   if type(item) is tuple:
+      v[0] = item[1]
+      return item[0]
+   v[0] = 1.0
+   return item
+
+cdef inline double *_scores_buffer(double *stack_buf, int nclasses) except NULL:
+   """
+   a scores buffer: stack_buf (STACK_CLASSES long) if it is big enough.
+   """
+   cdef double *scores = stack_buf
+   if nclasses > STACK_CLASSES:
+      scores = <double *>malloc(sizeof(double)*nclasses)
+      if scores == NULL:
+         raise MemoryError()
+   return scores
+
+cdef WeightTable _open_table(fname):
+   if is_binary_model(fname):
+      return MappedWeightTable(fname)
+   return TextWeightTable(fname)
+
+cdef object _domain_prefix(domain):
+   """
+   the prefix of the features of domain in a namespaced union of models
+   """
+   return "%s::" % domain
 
-   cdef dict W
-   cdef DoublesArr biases # specific type?
+cdef class MulticlassModel: 
+   """
+   a trained multiclass model, read only once loaded: the predict and
+   get_scores methods keep their scores in per call buffers and add up
+   the weights without the GIL, so threads can share one model.
+
+   ids(features) turns a feature list into the ids of the model's frozen
+   vocabulary (the rows of its weight table). predict_ids, get_scores_ids
+   and predict_masked_ids score such an array again and again without
+   looking the features up.
+
+   the _r methods take real valued features: (feature, value) pairs,
+   mixed with plain features (value 1). ids_r gives their ids and values
+   as two parallel arrays, which the *_ids methods take as well.
+
+   domain(name) gives the model of one domain of a namespaced union of
+   models (modeltool.py --merge --domains).
+   """
+
+   cdef WeightTable table
+   cdef double* biases
    cdef int nclas
-   cdef double* scores
    cdef int probs_output
+   cdef object prefix # of the features of the domain, see domain
 
    cdef load(self,fname):
       sys.stderr.write("loading model %s" % fname)
-      for line in file(fname):
-         f,ws = line.strip().split(None,1)
-         self.W[f]=DoublesArr([float(w) for w in ws.split()])
-      try:
-         self.biases = self.W['**BIAS**']
-      except KeyError:
-         self.biases = self.W.itervalues().next()
-         for i in xrange(self.biases.n):
-            self.biases.vals[i]=0
+      self.table = _open_table(fname)
+      self.nclas = self.table.nclasses
+      self._load_biases()
 
-      self.nclas = self.biases.n
+   cdef _load_biases(self):
+      cdef int i
+      cdef Py_ssize_t r
+      cdef double v = 1.0
+      self.biases=<double *>malloc(sizeof(double)*self.nclas)
+      for i in xrange(self.nclas):
+         self.biases[i]=0
+      if not self.table.hashed:
+         r = self._lookup('**BIAS**', &v)
+         if r >= 0:
+            self.table.add_row(self.biases, r, v)
+
+   cdef inline Py_ssize_t _lookup(self, f, double *v) except -2:
+      if self.prefix is not None:
+         f = self.prefix + f
+      return self.table.lookup(f, v)
+
+   def domain(self, name):
+      """
+      the model of domain name in a namespaced union of models: it shares
+      the weights of this model, and looks the features up under name.
+      """
+      cdef MulticlassModel view = MulticlassModel.__new__(MulticlassModel)
+      if self.table.hashed:
+         raise ValueError("hashed models have no domains")
+      view.table = self.table
+      view.nclas = self.nclas
+      view.probs_output = self.probs_output
+      view.prefix = _domain_prefix(name)
+      view._load_biases()
+      return view
 
-      self.scores=<double *>malloc(sizeof(double)*self.nclas)
+   def __cinit__(self):
+      self.biases = NULL
 
    def __init__(self, fname, probs_output=False):
-      self.W = {}
       self.probs_output=probs_output
       self.load(fname)
       sys.stderr.write(" done\n")
 
    def __dealloc__(self):
-      free(self.scores)
+      free(self.biases)
 
-   cpdef object predict(self,list features):
-      cdef int i
-      cdef double w
-      cdef DoublesArr ws
-      for i in xrange(self.nclas):
-         self.scores[i]=self.biases.vals[i]
+   cdef int _scores(self, list features, bint real, double *scores, bint probs) except -2:
+      """
+      scores = the scores (or probabilities) of features, whose values are
+      1, or given as (f,v) pairs if real (see _real_feature).
+      the rows are looked up with the GIL, then added up without it.
+      return: the best class, as in _score_rows.
+      """
+      cdef Py_ssize_t rows_buf[STACK_FEATURES]
+      cdef double vals_buf[STACK_FEATURES]
+      cdef Py_ssize_t *rows = rows_buf
+      cdef double *vals = vals_buf
+      cdef Py_ssize_t n = len(features), k = 0, r
+      cdef WeightTable table = self.table
+      cdef double v
+      cdef int besti
+      if n > STACK_FEATURES:
+         rows = <Py_ssize_t *>malloc(n*sizeof(Py_ssize_t))
+         vals = <double *>malloc(n*sizeof(double))
+      try:
+         if rows == NULL or vals == NULL:
+            raise MemoryError()
+         for item in features:
+            if real:
+               f = _real_feature(item, &v)
+            else:
+               f, v = item, 1.0
+            r = self._lookup(f, &v)
+            if r >= 0:
+               rows[k] = r
+               vals[k] = v
+               k += 1
+         with nogil:
+            besti = self._score_rows(table, scores, rows, vals, 0, k, probs)
+      finally:
+         if rows != rows_buf:
+            free(rows)
+            free(vals)
+      return besti
+
+   cpdef array.array ids(self, list features):
+      """
+      the ids of the features the model knows, as an array('l'): their
+      rows in the weight table, or ~row for the features that signed
+      hashing turns negative. the other features are left out.
+      """
+      cdef array.array ids = array.array('l')
+      cdef Py_ssize_t r, k = 0
+      cdef double v
+      array.resize(ids, len(features))
       for f in features:
-         try:
-            i=0
-            ws = self.W[f]
-            for i in xrange(self.nclas):
-               self.scores[i]+=ws.vals[i]
-         except KeyError: pass
-      cdef double tot = 0
-      if self.probs_output:
-         for i in xrange(self.nclas): 
-            self.scores[i]=math.exp(self.scores[i])
-            tot+=self.scores[i]
-      res=[]
-      cdef int besti=0
-      cdef double best=0
-      for i in xrange(self.nclas):
-         if self.scores[i] > best:
-            best = self.scores[i]
-            besti = i
-         if self.probs_output:
-            res.append(self.scores[i]/tot)
-         else:
-            res.append(self.scores[i])
-      return besti,res
-
-   cpdef object predict_r(self,list features): #@@TODO fix
-      cdef int i
-      cdef double w
+         v = 1.0
+         r = self._lookup(f, &v)
+         if r >= 0:
+            ids.data.as_longs[k] = r if v > 0 else ~r
+            k += 1
+      array.resize(ids, k)
+      return ids
+
+   cpdef tuple ids_r(self, list features):
+      """
+      like ids, for real valued features: (ids, values), an array('l') of
+      rows and an array('d') of the matching values, in which the sign of
+      signed hashing is folded.
+      """
+      cdef array.array ids = array.array('l')
+      cdef array.array values = array.array('d')
+      cdef Py_ssize_t r, k = 0
       cdef double v
-      for i in xrange(self.nclas):
-         self.scores[i]=self.biases.vals[i]
-      for f,v in features:
-         try:
-            i=0
-            ws = self.W[f]
-            for i in xrange(self.nclas):
-               self.scores[i]+=ws.vals[i]*v
-         except KeyError: pass
-      cdef double tot = 0
-      if self.probs_output:
-         for i in xrange(self.nclas): 
-            self.scores[i]=math.exp(self.scores[i])
-            tot+=self.scores[i]
-      res=[]
-      cdef int besti=0
-      cdef double best=0
-      for i in xrange(self.nclas):
-         if self.scores[i] > best:
-            best = self.scores[i]
-            besti = i
-         if self.probs_output:
-            res.append(self.scores[i]/tot)
-         else:
-            res.append(self.scores[i])
-      return besti,res
+      array.resize(ids, len(features))
+      array.resize(values, len(features))
+      for item in features:
+         f = _real_feature(item, &v)
+         r = self._lookup(f, &v)
+         if r >= 0:
+            ids.data.as_longs[k] = r
+            values.data.as_doubles[k] = v
+            k += 1
+      array.resize(ids, k)
+      array.resize(values, k)
+      return ids, values
+
+   cpdef array.array pair_ids(self, list features, list left, list right, sep="_"):
+      """
+      ids(features + conjunctions(left, right, sep)), without making the
+      conjunction strings when the model is binary: the rows of a hashed
+      model come from the hashes of the parts (see _pair_hashes), the keys
+      of a slot table are put together in a buffer. text models look the
+      strings up.
+      """
+      cdef MappedWeightTable table
+      cdef array.array ids
+      cdef list lefts, rights
+      cdef bytes b
+      cdef Py_ssize_t i, j, r, k, m = len(right), npairs = len(left) * len(right)
+      cdef Py_ssize_t nl, size = 0
+      cdef uint64_t h
+      cdef uint64_t *hashes = NULL
+      cdef char *key = NULL
+      if not isinstance(self.table, MappedWeightTable):
+         return self.ids(features + conjunctions(left, right, sep))
+      table = self.table
+      ids = self.ids(features)
+      k = len(ids)
+      array.resize(ids, k + npairs)
+      try:
+         if table.hashed:
+            hashes = <uint64_t *>malloc((npairs + 1)*sizeof(uint64_t))
+            if hashes == NULL:
+               raise MemoryError()
+            _pair_hashes(left, right, sep, hashes)
+            for i in xrange(npairs):
+               r = hashes[i] & table.mask
+               ids.data.as_longs[k] = r if _hash_sign(hashes[i], table.hash_signed) > 0 else ~r
+               k += 1
+            return ids
+         # the key of a pair: [prefix] left + sep, then right copied after it
+         lefts = [_as_bytes(("" if self.prefix is None else self.prefix) + f + sep) for f in left]
+         rights = [_as_bytes(f) for f in right]
+         for b in lefts:
+            size = max(size, len(b))
+         nl = size
+         size = 0
+         for b in rights:
+            size = max(size, len(b))
+         key = <char *>malloc(nl + size + 1)
+         if key == NULL:
+            raise MemoryError()
+         for i in xrange(len(lefts)):
+            b = lefts[i]
+            nl = len(b)
+            memcpy(key, <char *>b, nl)
+            h = _fnv1a(key, nl)
+            for j in xrange(m):
+               b = rights[j]
+               memcpy(key + nl, <char *>b, len(b))
+               r = _slot_find(table.slots, table.mask, table.offsets, table.keys,
+                              _fnv1a_from(h, b, len(b)), key, nl + len(b))
+               if r >= 0:
+                  ids.data.as_longs[k] = r
+                  k += 1
+         array.resize(ids, k)
+         return ids
+      finally:
+         free(hashes)
+         free(key)
+
+   cdef int _fill_scores(self, features, int kind, double *scores, bint probs) except -2:
+      """
+      _scores for the given kind of features (FEATURE_LIST, REAL_LIST,
+      ID_ARRAY or ID_VALUES). ids are scored without the GIL, with no lookup.
+      """
+      cdef array.array ids, values
+      cdef double *vals = NULL
+      cdef Py_ssize_t n
+      cdef int besti
+      if kind == FEATURE_LIST or kind == REAL_LIST:
+         return self._scores(features, kind == REAL_LIST, scores, probs)
+      if kind == ID_VALUES:
+         ids, values = features
+         if len(values) != len(ids):
+            raise ValueError("%s ids but %s values" % (len(ids), len(values)))
+         vals = values.data.as_doubles
+      else:
+         ids = features
+      n = len(ids)
+      with nogil:
+         besti = self._score_ids(self.table, scores, ids.data.as_longs, vals, n, probs)
+      return besti
+
+   cdef object _predict(self, features, int kind):
+      cdef double buf[STACK_CLASSES]
+      cdef double *scores = _scores_buffer(buf, self.nclas)
+      cdef int i, besti
+      try:
+         besti = self._fill_scores(features, kind, scores, self.probs_output)
+         return besti, [scores[i] for i in range(self.nclas)]
+      finally:
+         if scores != buf:
+            free(scores)
+
+   cdef list _get_scores(self, features, int kind):
+      cdef double buf[STACK_CLASSES]
+      cdef double *scores = _scores_buffer(buf, self.nclas)
+      cdef int i
+      try:
+         self._fill_scores(features, kind, scores, False)
+         return [scores[i] for i in range(self.nclas)]
+      finally:
+         if scores != buf:
+            free(scores)
+
+   cpdef object predict(self,list features):
+      return self._predict(features, FEATURE_LIST)
+
+   cpdef object predict_r(self,list features):
+      """
+      like predict but with real values features (see get_scores_r)
+      """
+      return self._predict(features, REAL_LIST)
+
+   cpdef object predict_ids(self, array.array ids, array.array values=None):
+      """
+      like predict, for the ids of the features (see ids), and their
+      values if they are real valued (see ids_r)
+      """
+      if values is None:
+         return self._predict(ids, ID_ARRAY)
+      return self._predict((ids, values), ID_VALUES)
 
    cpdef object get_scores(self,list features):
-      cdef int i
-      cdef DoublesArr ws
-      cdef list res
-      for i in xrange(self.nclas):
-         self.scores[i]=self.biases.vals[i]
-      for f in features:
-         try:
-            ws = self.W[f]
-            for i in xrange(ws.n):
-               self.scores[i]+=ws.vals[i]
-         except KeyError: pass
-      res=[]
-      for i in xrange(self.nclas):
-         res.append(self.scores[i])
-      return res
+      return self._get_scores(features, FEATURE_LIST)
 
-   cpdef list get_scores_r(self,list features): #@@TODO FIX
+   cpdef list get_scores_r(self,list features):
       """
       like get_scores but with real values features
-         each feature is a pair (f,v), where v is the value.
+         each feature is a pair (f,v), where v is the value, or a plain
+         feature, whose value is 1.
+      """
+      return self._get_scores(features, REAL_LIST)
+
+   cpdef list get_scores_ids(self, array.array ids, array.array values=None):
       """
+      like get_scores, for the ids of the features (see ids), and their
+      values if they are real valued (see ids_r)
+      """
+      if values is None:
+         return self._get_scores(ids, ID_ARRAY)
+      return self._get_scores((ids, values), ID_VALUES)
+
+   cpdef tuple predict_masked(self, list features, long mask):
+      """
+      the best class among the allowed ones: class c is allowed if bit c
+      of mask is set.
+      return: (best, margin), where margin is the score difference to the
+      second best allowed class (inf if there is none). best is -1 if no
+      class is allowed.
+      """
+      return self._predict_masked(features, FEATURE_LIST, mask)
+
+   cpdef tuple predict_masked_r(self, list features, long mask):
+      """
+      like predict_masked but with real values features (see get_scores_r)
+      """
+      return self._predict_masked(features, REAL_LIST, mask)
+
+   cpdef tuple predict_masked_ids(self, array.array ids, long mask, array.array values=None):
+      """
+      like predict_masked, for the ids of the features (see ids), and their
+      values if they are real valued (see ids_r)
+      """
+      if values is None:
+         return self._predict_masked(ids, ID_ARRAY, mask)
+      return self._predict_masked((ids, values), ID_VALUES, mask)
+
+   cdef tuple _predict_masked(self, features, int kind, long mask):
+      cdef double buf[STACK_CLASSES]
+      cdef double *scores = _scores_buffer(buf, self.nclas)
       cdef int i
-      cdef double w
+      cdef int besti = -1
+      cdef double best = -INFINITY, second = -INFINITY
+      try:
+         self._fill_scores(features, kind, scores, False)
+         for i in xrange(self.nclas):
+            if not (mask >> i) & 1:
+               continue
+            if besti < 0 or scores[i] > best:
+               second = best
+               best = scores[i]
+               besti = i
+            elif scores[i] > second:
+               second = scores[i]
+      finally:
+         if scores != buf:
+            free(scores)
+      if besti < 0:
+         return -1, 0.0
+      return besti, best - second
+
+   def predict_batch(self, list batch, probs=None):
+      """
+      scores a batch of feature lists in one call.
+      the features are looked up first, the scoring itself runs without
+      the GIL.
+      return: (best, scores), an int array with the best class of each
+      item and a (len(batch), nclasses) array with its scores, or its
+      probabilities if probs (defaults to the model's probs_output).
+      the best classes are the ones predict would return: without probs,
+      that is class 0 unless some class scores above 0.
+      """
+      cdef bint do_probs = self.probs_output if probs is None else probs
+      cdef Py_ssize_t n = len(batch), nf = 0, b, k
+      cdef Py_ssize_t r
       cdef double v
-      cdef list res
-      for i in xrange(self.nclas):
-         self.scores[i]=self.biases.vals[i]
-      for f,v in features:
-         try:
-            ws = self.W[f]
-            for i in xrange(ws.n):
-               self.scores[i]+=ws.vals[i]*v
-         except KeyError: pass
-      res=[]
-      for i in xrange(self.nclas):
-         res.append(self.scores[i])
-      return res
+      for features in batch:
+         nf += len(features)
+      scores = np.empty((n, self.nclas), dtype=np.float64)
+      best = np.empty(n, dtype=np.intp)
+      cdef double[:, ::1] S = scores
+      cdef Py_ssize_t[::1] B = best
+      cdef WeightTable table = self.table
+      cdef Py_ssize_t *rows = <Py_ssize_t *>malloc((nf + 1)*sizeof(Py_ssize_t))
+      cdef double *vals = <double *>malloc((nf + 1)*sizeof(double))
+      cdef Py_ssize_t *ends = <Py_ssize_t *>malloc((n + 1)*sizeof(Py_ssize_t))
+      try:
+         if rows == NULL or vals == NULL or ends == NULL:
+            raise MemoryError()
+         k = 0
+         for b in xrange(n):
+            for f in batch[b]:
+               v = 1.0
+               r = self._lookup(f, &v)
+               if r >= 0:
+                  rows[k] = r
+                  vals[k] = v
+                  k += 1
+            ends[b] = k
+         with nogil:
+            k = 0
+            for b in range(n):
+               B[b] = self._score_rows(table, &S[b, 0], rows, vals, k, ends[b], do_probs)
+               k = ends[b]
+      finally:
+         free(rows)
+         free(vals)
+         free(ends)
+      return best, scores
+
+   cdef Py_ssize_t _score_rows(self, WeightTable table, double *scores,
+                               Py_ssize_t *rows, double *vals,
+                               Py_ssize_t start, Py_ssize_t end, bint probs) nogil:
+      """
+      scores = biases + the given rows, optionally softmax-ed.
+      return: the best class.
+      """
+      cdef int i
+      cdef Py_ssize_t k
+      for i in range(self.nclas):
+         scores[i] = self.biases[i]
+      for k in range(start, end):
+         table.add_row(scores, rows[k], vals[k])
+      return self._best(scores, probs)
+
+   cdef int _score_ids(self, WeightTable table, double *scores,
+                       long *ids, double *vals, Py_ssize_t n, bint probs) nogil:
+      """
+      as _score_rows, for ids (see ids) and their values (all 1 if vals
+      is NULL)
+      """
+      cdef int i
+      cdef Py_ssize_t k
+      cdef double v = 1.0
+      for i in range(self.nclas):
+         scores[i] = self.biases[i]
+      for k in range(n):
+         if vals != NULL:
+            v = vals[k]
+         if ids[k] >= 0:
+            table.add_row(scores, ids[k], v)
+         else:
+            table.add_row(scores, ~ids[k], -v)
+      return self._best(scores, probs)
+
+   cdef int _best(self, double *scores, bint probs) nogil:
+      """
+      the best class of scores, which are then softmax-ed if probs.
+      """
+      cdef int i, besti = 0
+      cdef double tot = 0, best
+      # as in predict: the probabilities are all above 0, the scores may not be
+      best = -INFINITY if probs else 0
+      for i in range(self.nclas):
+         if scores[i] > best:
+            best = scores[i]
+            besti = i
+      if probs:
+         best = scores[besti]
+         for i in range(self.nclas):
+            scores[i] = exp(scores[i] - best)
+            tot += scores[i]
+         for i in range(self.nclas):
+            scores[i] /= tot
+      return besti
    #}}}
 
 ### Model trainers {{{
 
-cdef class MulticlassParamData:
+cdef enum:
+   UPDATE_PERCEPTRON = 0
+   UPDATE_PA = 1
+   UPDATE_PA_I = 2
+   UPDATE_PA_II = 3
+
+PA_VARIANTS = {"pa": UPDATE_PA, "pa1": UPDATE_PA_I, "pa2": UPDATE_PA_II}
+
+cdef inline double _update_size(double loss, double norm, int variant, double C) nogil:
+   """
+   tau of an update (see MultitronParameters._fused_update), 0 for none.
+   """
+   cdef double tau
+   if variant == UPDATE_PERCEPTRON:
+      return 1.0
+   if variant == UPDATE_PA_II:
+      return loss / (norm + 0.5/C)
+   if norm == 0:
+      return 0
+   tau = loss / norm
+   if variant == UPDATE_PA_I and tau>C: tau=C
+   return tau
+
+cdef enum:
+   # how _row_index treats a feature without a row
+   FIND_ROW = 0   # no row
+   ADMIT_ROW = 1  # a new row, if the admission policy lets the feature in
+   CREATE_ROW = 2 # a new row
+
+cdef enum:
+   # count-min sketch of the features waiting for admission
+   SKETCH_DEPTH = 4
+   SKETCH_WIDTH = 1 << 20
+   SKETCH_MAX = 255
+
+cdef struct ParamRow:
+   # the parameters of one feature, one entry per class
+   double *acc
+   double *w
+   int *lastUpd
+   double sign
+
+cdef class MultitronParameters:
+   """
+   multiclass averaged perceptron / passive-aggressive parameters.
+
+   the parameters live in three contiguous arenas (acc, w, lastUpd) of
+   nrows x nclasses entries, which grow as new features are seen. W maps
+   each feature to its row.
+
+   update and do_pa_update add up the scores and apply the update without
+   the GIL, so several training threads can share the parameters
+   ("hogwild": concurrent updates may overwrite each other). with hogwild
+   set, the arenas that growth replaces are kept until free_retired is
+   called, as other threads may still be using them.
+
+   with hash_bits > 0 the parameters are kept in "feature hashing" mode:
+   instead of one entry per feature string, every feature is folded into a
+   fixed table of 2**hash_bits rows by its hash (see feature_hash), so the
+   memory is bounded no matter how many features are seen. with hash_signed=True
+   one bit of the hash also gives each feature a +1/-1 sign, which makes
+   collisions cancel out on average. hashed parameters are dumped as hashed
+   binary models.
+
+   limit_features and truncate bound the number of rows of the (unhashed)
+   parameters: a feature can be made to wait for admission, the least
+   useful rows evicted, or the rows an L1 penalty zeroes dropped. the rows
+   they free are reused by the next new features.
+   """
    cdef:
+      readonly int nclasses
+      int now
+      dict W
+
+      readonly Py_ssize_t nrows
+      Py_ssize_t capacity
       double *acc
       double *w
       int *lastUpd
-   def __cinit__(self, int nclasses):
-      cdef int i
-      self.lastUpd = <int *>malloc(nclasses*sizeof(int))
-      self.acc     = <double *>malloc(nclasses*sizeof(double))
-      self.w       = <double *>malloc(nclasses*sizeof(double))
-      for i in range(nclasses):
-         self.lastUpd[i]=0
-         self.acc[i]=0
-         self.w[i]=0
+
+      readonly int hash_bits
+      readonly bint hash_signed
+      uint64_t hmask
+
+      public bint hogwild
+      list retired # addresses of the arenas replaced by _grow
+
+      readonly int admit_after
+      readonly Py_ssize_t max_rows
+      uint8_t *sketch # SKETCH_DEPTH x SKETCH_WIDTH sightings counters
+      list free_rows # rows no feature uses, see _evict and truncate
+   
+   def __cinit__(self, nclasses, int hash_bits=0, bint hash_signed=False):
+      _check_hash_bits(hash_bits)
+      self.nclasses = nclasses
+      self.hogwild = False
+      self.retired = []
+      self.free_rows = []
+      self.sketch = NULL
+      self.acc = NULL
+      self.w = NULL
+      self.lastUpd = NULL
+      self.nrows = 0
+      self.capacity = 0
+      if hash_bits > 0:
+         self._grow(<Py_ssize_t>1 << hash_bits)
+         self.nrows = self.capacity
 
    def __dealloc__(self):
-      free(self.lastUpd)
+      self.free_retired()
+      free(self.sketch)
       free(self.acc)
       free(self.w)
+      free(self.lastUpd)
 
-cdef class MultitronParameters:
-   cdef:
-      int nclasses
-      int now
-      dict W
+   cpdef free_retired(self):
+      """
+      frees the arenas replaced while hogwild was set. only call it when
+      no other thread is updating the parameters.
+      """
+      cdef size_t a
+      for a in self.retired:
+         free(<void *>a)
+      self.retired = []
 
-      double* scores # (re)used in calculating prediction
-   
-   def __cinit__(self, nclasses):
-      self.scores = <double *>malloc(nclasses*sizeof(double))
+   cdef int _grow(self, Py_ssize_t capacity) except -1:
+      """
+      resizes the arenas to capacity rows.
+      the first allocation is zeroed, rows added later are zeroed by
+      _new_row, so the untouched tail of the arenas costs no memory.
+      """
+      cdef size_t n = capacity * self.nclasses
+      cdef size_t used = self.nrows * self.nclasses
+      cdef double *acc
+      cdef double *w
+      cdef int *lastUpd
+      if self.capacity == 0:
+         acc = <double *>calloc(n, sizeof(double))
+         w = <double *>calloc(n, sizeof(double))
+         lastUpd = <int *>calloc(n, sizeof(int))
+      elif self.hogwild:
+         # copy, and keep the old arenas: updates still running on them
+         # without the GIL are lost, but do not write to freed memory.
+         acc = <double *>malloc(n*sizeof(double))
+         w = <double *>malloc(n*sizeof(double))
+         lastUpd = <int *>malloc(n*sizeof(int))
+         if acc == NULL or w == NULL or lastUpd == NULL:
+            free(acc)
+            free(w)
+            free(lastUpd)
+            raise MemoryError("cannot grow parameters to %s rows" % capacity)
+         memcpy(acc, self.acc, used*sizeof(double))
+         memcpy(w, self.w, used*sizeof(double))
+         memcpy(lastUpd, self.lastUpd, used*sizeof(int))
+         self.retired.extend([<size_t>self.acc, <size_t>self.w, <size_t>self.lastUpd])
+      else:
+         acc = <double *>realloc(self.acc, n*sizeof(double))
+         w = <double *>realloc(self.w, n*sizeof(double))
+         lastUpd = <int *>realloc(self.lastUpd, n*sizeof(int))
+      if acc != NULL: self.acc = acc
+      if w != NULL: self.w = w
+      if lastUpd != NULL: self.lastUpd = lastUpd
+      if acc == NULL or w == NULL or lastUpd == NULL:
+         raise MemoryError("cannot grow parameters to %s rows" % capacity)
+      self.capacity = capacity
+      return 0
+
+   cdef Py_ssize_t _new_row(self) except -1:
+      cdef Py_ssize_t r
+      if self.free_rows:
+         r = self.free_rows.pop()
+      else:
+         if self.nrows == self.capacity:
+            self._grow(max(1024, 2*self.capacity))
+         r = self.nrows
+         self.nrows += 1
+      memset(self.acc + r*self.nclasses, 0, self.nclasses*sizeof(double))
+      memset(self.w + r*self.nclasses, 0, self.nclasses*sizeof(double))
+      memset(self.lastUpd + r*self.nclasses, 0, self.nclasses*sizeof(int))
+      return r
+
+   def __len__(self):
+      """
+      the number of features with a row (all the rows, when hashed).
+      """
+      if self.hash_bits:
+         return self.nrows
+      return len(self.W)
+
+   def limit_features(self, int admit_after=0, Py_ssize_t max_rows=0):
+      """
+      sets the admission policy of the new features:
+         admit_after  a feature gets a row once it took part in this many
+                      updates (add, update, ...), counted in a count-min
+                      sketch. 0 or 1 admits the features at once.
+         max_rows     when there are more rows than this, the tenth of them
+                      with the smallest averaged weights (sum of absolute
+                      values over the classes) is evicted. 0 for no limit.
+      add_params ignores the policy, but its rows count for max_rows.
+      hashed parameters have a fixed number of rows, and no policy.
+      """
+      if not 0 <= admit_after <= SKETCH_MAX:
+         raise ValueError("admit_after must be between 0 and %s, got %s" % (SKETCH_MAX, admit_after))
+      if max_rows < 0:
+         raise ValueError("max_rows must be positive, got %s" % max_rows)
+      if self.hash_bits and (admit_after > 1 or max_rows > 0):
+         raise ValueError("hashed parameters take no feature limits")
+      if admit_after > 1 and self.sketch == NULL:
+         self.sketch = <uint8_t *>calloc(SKETCH_DEPTH*SKETCH_WIDTH, sizeof(uint8_t))
+         if self.sketch == NULL:
+            raise MemoryError()
+      self.admit_after = admit_after
+      self.max_rows = max_rows
+
+   def warm_start(self, fname):
+      """
+      starts the training from the weights of the model in fname (text or
+      binary): they become the weights of fresh parameters, as if they
+      had been there from the start, so they also count in the average.
+      a hashed model needs parameters with the same hashing.
+      """
+      self._warm_start(_open_table(fname), fname)
+
+   cdef _warm_start(self, WeightTable table, fname):
+      cdef list features
+      cdef Py_ssize_t r, row
+      cdef double sign
+      if self.now or len(self.W):
+         raise ValueError("warm_start needs fresh parameters")
+      if table.nclasses != self.nclasses:
+         raise ValueError("%s has %s classes, expected %s" % (fname, table.nclasses, self.nclasses))
+      if table.hashed != (self.hash_bits > 0) or (table.hashed and (
+            table.nrows != self.nrows or table.hash_signed != self.hash_signed)):
+         raise ValueError("%s: the feature hashing of the model and of the parameters differ" % fname)
+      features = table.features()
+      for r in xrange(table.nrows):
+         if features is None:
+            row = r
+         elif features[r] is None:
+            continue # repeated in a text model, the last one counts
+         else:
+            row = self._row_index(features[r], &sign, CREATE_ROW)
+         table.add_row(self.w + row*self.nclasses, r, 1.0)
+
+   cdef bint _admit(self, f) except -1:
+      """
+      counts one more sighting of f.
+      returns True once f was seen admit_after times.
+      """
+      cdef uint64_t h = _feature_hash(f)
+      cdef uint32_t h1 = <uint32_t>h, h2 = <uint32_t>(h >> 32) | 1
+      cdef uint8_t *count
+      cdef int i, seen = SKETCH_MAX
+      for i in range(SKETCH_DEPTH):
+         count = self.sketch + i*SKETCH_WIDTH + ((h1 + <uint32_t>i*h2) & (SKETCH_WIDTH-1))
+         if count[0] < SKETCH_MAX:
+            count[0] += 1
+         if count[0] < seen:
+            seen = count[0]
+      return seen >= self.admit_after
+
+   cdef _evict(self, Py_ssize_t n):
+      """
+      frees the rows of the n features with the smallest averaged weights.
+      """
+      cdef list features = list(self.W)
+      cdef array.array useful = array.array('d')
+      cdef Py_ssize_t k, r
+      cdef int c
+      cdef double u
+      array.resize(useful, len(features))
+      for k in xrange(len(features)):
+         r = self.W[features[k]] * self.nclasses
+         u = 0
+         for c in range(self.nclasses):
+            u += fabs(self.acc[r+c] + (self.now-self.lastUpd[r+c])*self.w[r+c])
+         useful.data.as_doubles[k] = u
+      for k in np.argpartition(np.frombuffer(useful), n-1)[:n]:
+         self.free_rows.append(self.W.pop(features[k]))
+
+   def truncate(self, double l1):
+      """
+      L1 truncation: moves every weight l1 towards zero (without crossing
+      it), and frees the rows of the features whose weights all end up
+      zero. their share of the averaged weights is dropped with them.
+      returns the number of features dropped.
+      """
+      cdef Py_ssize_t r
+      cdef list dropped = []
+      if self.hash_bits:
+         for r in xrange(self.nrows):
+            self._truncate_row(r, l1)
+         return 0
+      for f,r in self.W.iteritems():
+         if self._truncate_row(r, l1):
+            dropped.append(f)
+      for f in dropped:
+         self.free_rows.append(self.W.pop(f))
+      return len(dropped)
+
+   cdef bint _truncate_row(self, Py_ssize_t r, double l1):
+      """
+      returns True if the weights of row r are all zero after truncation.
+      """
+      cdef Py_ssize_t i
+      cdef bint zero = True
+      for i in range(r*self.nclasses, (r+1)*self.nclasses):
+         self.acc[i]+=(self.now-self.lastUpd[i])*self.w[i]
+         self.lastUpd[i]=self.now
+         if self.w[i] > l1:
+            self.w[i] -= l1
+            zero = False
+         elif self.w[i] < -l1:
+            self.w[i] += l1
+            zero = False
+         else:
+            self.w[i] = 0
+      return zero
+
+   def __reduce__(self):
+      cdef size_t n = self.nrows * self.nclasses
+      return (_restore_params,
+              (self.nclasses, self.hash_bits, self.hash_signed, self.now, self.W,
+               (<char *>self.acc)[:n*sizeof(double)],
+               (<char *>self.w)[:n*sizeof(double)],
+               (<char *>self.lastUpd)[:n*sizeof(int)],
+               self.admit_after, self.max_rows))
+
+   cdef _restore(self, int now, dict W, bytes acc, bytes w, bytes lastUpd):
+      cdef Py_ssize_t nrows = len(w) // (self.nclasses*sizeof(double))
+      if not self.hash_bits and nrows > 0:
+         self._grow(nrows)
+      assert nrows == self.capacity, "parameters do not match their shape"
+      memcpy(self.acc, <char *>acc, len(acc))
+      memcpy(self.w, <char *>w, len(w))
+      memcpy(self.lastUpd, <char *>lastUpd, len(lastUpd))
+      self.nrows = nrows
+      self.now = now
+      self.W = W
+      if not self.hash_bits and len(W) < nrows:
+         used = set(W.itervalues())
+         self.free_rows = [r for r in xrange(nrows) if r not in used]
 
    cpdef getW(self, clas): 
       d={}
-      cdef MulticlassParamData p
-      for f,p in self.W.iteritems():
-         d[f] = p.w[clas]
+      cdef Py_ssize_t r
+      if self.hash_bits:
+         for r in xrange(self.nrows):
+            if self.w[r*self.nclasses+clas] != 0:
+               d[r] = self.w[r*self.nclasses+clas]
+         return d
+      for f,r in self.W.iteritems():
+         d[f] = self.w[r*self.nclasses+clas]
       return d
 
-   def __init__(self, nclasses):
+   def __init__(self, nclasses, int hash_bits=0, bint hash_signed=False):
       self.nclasses = nclasses
       self.now = 0
       self.W = {}
+      self.hash_bits = hash_bits
+      self.hash_signed = hash_signed
+      self.hmask = (<uint64_t>1 << hash_bits) - 1
+
+   cdef Py_ssize_t _row_index(self, f, double *sign, int create) except -2:
+      """
+      the row of feature f, and its sign.
+      create (FIND_ROW, ADMIT_ROW or CREATE_ROW) says what to do when f has
+      no parameters: returns -1, unless a row is created.
+      """
+      cdef uint64_t h
+      if self.hash_bits:
+         h = _feature_hash(f)
+         sign[0] = _hash_sign(h, self.hash_signed)
+         return h & self.hmask
+      sign[0] = 1.0
+      o = self.W.get(f)
+      if o is None:
+         if create == FIND_ROW: return -1
+         if create == ADMIT_ROW and self.admit_after > 1 and not self._admit(f):
+            return -1
+         o = self._new_row()
+         self.W[f] = o
+      return o
+
+   cdef bint _row(self, f, ParamRow *p, int create) except -1:
+      """
+      points p to the parameters of feature f.
+      returns False if f has no parameters (see _row_index).
+
+      note: p is only valid until the next call that creates a row,
+      which may grow (and move) the arenas.
+      """
+      cdef Py_ssize_t r = self._row_index(f, &p.sign, create)
+      if r < 0: return False
+      r *= self.nclasses
+      p.acc = self.acc + r
+      p.w = self.w + r
+      p.lastUpd = self.lastUpd + r
+      return True
 
    cdef _tick(self):
       self.now=self.now+1
+      if self.max_rows and len(self.W) > self.max_rows:
+         self._evict(len(self.W) - self.max_rows + self.max_rows // 10)
 
    def tick(self): self._tick()
 
@@ -227,110 +1651,110 @@ cdef class MultitronParameters:
       """
       note: DOES NOT support averaging
       """
-      cdef MulticlassParamData p
-      cdef int c
-      for p in self.W.values():
-         for c in xrange(self.nclasses):
-            p.w[c]*=scalar
+      cdef Py_ssize_t i
+      for i in xrange(self.nrows * self.nclasses):
+         self.w[i]*=scalar
 
    cpdef add(self, list features, int clas, double amount):
-      cdef MulticlassParamData p
+      cdef ParamRow p
       for f in features:
-         try:
-            p = self.W[f]
-         except KeyError:
-            p = MulticlassParamData(self.nclasses)
-            self.W[f] = p
-
+         if not self._row(f, &p, ADMIT_ROW): continue
          p.acc[clas]+=(self.now-p.lastUpd[clas])*p.w[clas]
-         p.w[clas]+=amount
+         p.w[clas]+=amount*p.sign
          p.lastUpd[clas]=self.now
 
    cpdef add_r(self, list features, int clas, double amount):
       """
       like "add", but with real values features: 
-         each feature is a pair (f,v), where v is the value.
+         each feature is a pair (f,v), where v is the value, or a plain
+         feature, whose value is 1.
       """
-      cdef MulticlassParamData p
+      cdef ParamRow p
       cdef double v
-      cdef str f
-      for f,v in features:
-         try:
-            p = self.W[f]
-         except KeyError:
-            p = MulticlassParamData(self.nclasses)
-            self.W[f] = p
-
+      for item in features:
+         f = _real_feature(item, &v)
+         if not self._row(f, &p, ADMIT_ROW): continue
          p.acc[clas]+=(self.now-p.lastUpd[clas])*p.w[clas]
-         p.w[clas]+=amount*v
+         p.w[clas]+=amount*v*p.sign
          p.lastUpd[clas]=self.now
 
    cpdef set(self, list features, int clas, double amount):
       """
       like "add", but replaces instead of adding
       """
-      cdef MulticlassParamData p
-      cdef double v
-      cdef str f
+      cdef ParamRow p
       for f in features:
-         try:
-            p = self.W[f]
-         except KeyError:
-            p = MulticlassParamData(self.nclasses)
-            self.W[f] = p
-
+         if not self._row(f, &p, ADMIT_ROW): continue
          p.acc[clas]+=(self.now-p.lastUpd[clas])*p.w[clas]
-         p.w[clas]+=amount
+         p.w[clas]+=amount*p.sign
          p.lastUpd[clas]=self.now
 
-   cpdef add_params(self, MultitronParameters other, double factor):
+   cpdef add_params(self, MultitronParameters other, double factor, domain=None):
       """
       like "add", but with data from another MultitronParameters object.
       they must both share the number of classes
       add each value * factor
+      with a domain, the features of other are added as the features of
+      that domain (see MulticlassModel.domain), for a namespaced union.
       """
-      cdef MulticlassParamData p
-      cdef MulticlassParamData op
-      cdef double v
-      cdef str f
+      cdef ParamRow p
+      cdef double *ow
       cdef int clas
+      cdef Py_ssize_t i, r
+      prefix = None if domain is None else _domain_prefix(domain)
       assert(self.nclasses==other.nclasses),"incompatible number of classes in add_params"
-      for f,op in other.W.items():
-         try:
-            p = self.W[f]
-         except KeyError:
-            p = MulticlassParamData(self.nclasses)
-            self.W[f] = p
-
+      assert(self.hash_bits==other.hash_bits and self.hash_signed==other.hash_signed),"incompatible hashing in add_params"
+      if self.hash_bits and prefix is not None:
+         raise ValueError("hashed parameters have no domains")
+      if self.hash_bits:
+         for i in xrange(self.nrows * self.nclasses):
+            if other.w[i]==0: continue
+            self.acc[i]+=(self.now-self.lastUpd[i])*self.w[i]
+            self.w[i]+=(other.w[i]*factor)
+            self.lastUpd[i]=self.now
+         return
+      for f,r in other.W.items():
+         if prefix is not None:
+            f = prefix + f
+         self._row(f, &p, CREATE_ROW)
+         ow = other.w + r*self.nclasses
          for clas in xrange(self.nclasses):
-            if op.w[clas]<0.0000001: continue
+            if ow[clas]==0: continue
             p.acc[clas]+=(self.now-p.lastUpd[clas])*p.w[clas]
-            #print p.w[clas], op.w[clas]
-            p.w[clas]+=(op.w[clas]*factor)
+            #print p.w[clas], ow[clas]
+            p.w[clas]+=(ow[clas]*factor)
             p.lastUpd[clas]=self.now
 
-   cpdef do_pa_update(self, list feats, int gold_cls, double C=1.0):
-      cdef double go_scr
-      cdef double gu_scr
-      cdef double loss
-      cdef double norm
-      cdef double tau
-      cdef int prediction
-      cdef dict scores
+   cpdef do_pa_update(self, list feats, int gold_cls, double C=1.0, variant="pa1"):
+      """
+      does a prediction, and a passive-aggressive update with
+      aggressiveness C. variant is one of PA_VARIANTS: pa (no C),
+      pa1 (tau capped at C) or pa2 (tau shrunk by 1/2C).
+      return: the predicted class before the update.
+      """
+      if variant not in PA_VARIANTS:
+         raise ValueError("unknown PA variant %s, possible values: %s" % (variant, sorted(PA_VARIANTS)))
       self._tick()
-      prediction = self._predict_best_class(feats)
-      if prediction==gold_cls: return prediction
-      scores = self.get_scores(feats)
-      go_scr = scores[gold_cls]
-      gu_scr = scores[prediction]
+      return self._fused_update(feats, gold_cls, PA_VARIANTS[variant], C)
 
-      loss = gu_scr - go_scr + 1
-      norm = len(feats)+len(feats)
-      tau = loss / norm
-      if tau>C: tau=C
-      self.add(feats,prediction,-tau)
-      self.add(feats,gold_cls,+tau)
-      return prediction
+   def do_pa_update_pairs(self, list feats, list left, list right, sep, int gold_cls, double C=1.0, variant="pa1"):
+      """
+      like do_pa_update(feats + conjunctions(left, right, sep)), see
+      update_pairs
+      """
+      if variant not in PA_VARIANTS:
+         raise ValueError("unknown PA variant %s, possible values: %s" % (variant, sorted(PA_VARIANTS)))
+      self._tick()
+      return self._fused_update(feats, gold_cls, PA_VARIANTS[variant], C, False, (left, right, sep))
+
+   cpdef do_pa_update_r(self, list feats, int gold_cls, double C=1.0, variant="pa1"):
+      """
+      like do_pa_update, with real values features (see add_r)
+      """
+      if variant not in PA_VARIANTS:
+         raise ValueError("unknown PA variant %s, possible values: %s" % (variant, sorted(PA_VARIANTS)))
+      self._tick()
+      return self._fused_update(feats, gold_cls, PA_VARIANTS[variant], C, True)
 
    cpdef pa_update(self, object gu_feats, object go_feats, int gu_cls, int go_cls,double C=1.0):
       cdef double go_scr
@@ -348,45 +1772,39 @@ cdef class MultitronParameters:
       self.add(go_feats,go_cls,+tau)
 
    cpdef get_scores(self, features):
-      cdef MulticlassParamData p
+      return self._get_scores(features, False)
+
+   cdef dict _get_scores(self, features, bint real):
+      cdef ParamRow p
       cdef int i
-      cdef double w
-      for i in xrange(self.nclasses):
-         self.scores[i]=0
-      for f in features:
-         try:
-            p = self.W[f]
-            for c in xrange(self.nclasses):
-               self.scores[c] += p.w[c]
-         except KeyError: pass
-      cdef double tot = 0
-      res={}
-      for i in xrange(self.nclasses):
-         res[i] = self.scores[i]
-      return res
+      cdef int c
+      cdef double v
+      cdef double buf[STACK_CLASSES]
+      cdef double *scores = _scores_buffer(buf, self.nclasses)
+      try:
+         for i in xrange(self.nclasses):
+            scores[i]=0
+         for item in features:
+            if real:
+               f = _real_feature(item, &v)
+            else:
+               f, v = item, 1.0
+            if self._row(f, &p, FIND_ROW):
+               for c in xrange(self.nclasses):
+                  scores[c] += p.w[c]*v*p.sign
+         res={}
+         for i in xrange(self.nclasses):
+            res[i] = scores[i]
+         return res
+      finally:
+         if scores != buf:
+            free(scores)
 
    cpdef get_scores_r(self, features):
       """
-      like get_scores but with real values features
-         each feature is a pair (f,v), where v is the value.
+      like get_scores but with real values features (see add_r)
       """
-      cdef MulticlassParamData p
-      cdef int i
-      cdef double w
-      cdef double v
-      for i in xrange(self.nclasses):
-         self.scores[i]=0
-      for f,v in features:
-         try:
-            p = self.W[f]
-            for c in xrange(self.nclasses):
-               self.scores[c] += p.w[c]*v
-         except KeyError: pass
-      cdef double tot = 0
-      res={}
-      for i in xrange(self.nclasses):
-         res[i] = self.scores[i]
-      return res
+      return self._get_scores(features, True)
 
    def update(self, correct_class, features):
       """
@@ -394,10 +1812,16 @@ cdef class MultitronParameters:
       return: the predicted class before the update.
       """
       self._tick()
-      prediction = self._predict_best_class(features)
-      if prediction != correct_class:
-         self._update(correct_class, prediction, features)
-      return prediction
+      return self._fused_update(features, correct_class, UPDATE_PERCEPTRON, 1.0)
+
+   def update_pairs(self, correct_class, list features, list left, list right, sep="_"):
+      """
+      like update(features + conjunctions(left, right, sep)). hashed
+      parameters find the rows of the conjunctions from the hashes of their
+      parts (see _pair_hashes), without making their strings.
+      """
+      self._tick()
+      return self._fused_update(features, correct_class, UPDATE_PERCEPTRON, 1.0, False, (left, right, sep))
 
    cpdef predict_best_class_r(self, list features):
       scores = self.get_scores_r(features)
@@ -406,114 +1830,244 @@ cdef class MultitronParameters:
       return max(scores)[1]
 
    def update_r(self, correct_class, features):
+      """
+      like update, with real values features (see add_r)
+      """
       self._tick()
-      prediction = self.predict_best_class_r(features)
-      if prediction != correct_class:
-         self._update_r(correct_class, prediction, features)
-      return prediction
+      return self._fused_update(features, correct_class, UPDATE_PERCEPTRON, 1.0, True)
 
-   cdef int _predict_best_class(self, list features):
-      cdef int i
-      cdef MulticlassParamData p
-      for i in range(self.nclasses):
-         self.scores[i]=0
-      for f in features:
-         #print "lookup", f
-         try:
-            p = self.W[f]
-            for c in xrange(self.nclasses):
-               self.scores[c] += p.w[c]
-         except KeyError: 
-            #print "feature",f,"not found"
-            pass
-      # return best_i
-      cdef int best_i = 0
-      cdef double best = self.scores[0]
-      for i in xrange(1,self.nclasses):
-         if best < self.scores[i]:
-            best_i = i
-            best = self.scores[i]
-      return best_i
-
-   cdef _update(self, int goodClass, int badClass, list features):
-      cdef MulticlassParamData p
-      for f in features:
-         try:
-            p = self.W[f]
-         except KeyError:
-            p = MulticlassParamData(self.nclasses)
-            self.W[f] = p
-
-         p.acc[badClass]+=(self.now-p.lastUpd[badClass])*p.w[badClass]
-         p.acc[goodClass]+=(self.now-p.lastUpd[goodClass])*p.w[goodClass]
-         p.w[badClass]-=1.0
-         p.w[goodClass]+=1.0
-         p.lastUpd[badClass]=self.now
-         p.lastUpd[goodClass]=self.now
-
-   cdef _update_r(self, int goodClass, int badClass, list features):
-      cdef MulticlassParamData p
-      for f,v in features:
-         try:
-            p = self.W[f]
-         except KeyError:
-            p = MulticlassParamData(self.nclasses)
-            self.W[f] = p
-
-         p.acc[badClass]+=(self.now-p.lastUpd[badClass])*p.w[badClass]
-         p.acc[goodClass]+=(self.now-p.lastUpd[goodClass])*p.w[goodClass]
-         p.w[badClass]-=v
-         p.w[goodClass]+=v
-         p.lastUpd[badClass]=self.now
-         p.lastUpd[goodClass]=self.now
+   cdef int _fused_update(self, list features, int gold, int variant, double C, bint real=False,
+                          tuple pairs=None) except -1:
+      """
+      scores the features once and, if the best class is not gold, moves
+      their weights from the best class to gold by tau:
+         perceptron   1
+         pa           loss / norm
+         pa1          min(C, loss / norm)
+         pa2          loss / (norm + 1/2C)
+      where loss = score(best) - score(gold) + 1 and norm = 2*len(features).
+      if real, the features have values (see _real_feature): the weights
+      move by tau*value, and norm = 2*sum(value**2).
+      pairs, (left, right, sep), adds conjunctions(left, right, sep) to the
+      features, whose rows come from _pair_hashes when hashing.
+      the features are looked up with the GIL, the scores and the update
+      are done without it.
+      return: the best class before the update.
+      """
+      if pairs is not None and not self.hash_bits:
+         features = features + conjunctions(*pairs)
+         pairs = None
+      cdef Py_ssize_t nf = len(features), k
+      cdef Py_ssize_t n = nf if pairs is None else nf + len(pairs[0]) * len(pairs[1])
+      cdef Py_ssize_t *rows = <Py_ssize_t *>malloc((n+1)*sizeof(Py_ssize_t))
+      # signs[k]: the sign of feature k, times its value if real
+      cdef double *signs = <double *>malloc(2*(n+1)*sizeof(double))
+      cdef double *vals = signs + n + 1
+      cdef double buf[STACK_CLASSES]
+      cdef double *scores = buf
+      cdef double tau = 0, norm = n + n
+      cdef uint64_t *hashes = NULL
+      cdef int best
+      try:
+         if rows == NULL or signs == NULL:
+            raise MemoryError()
+         scores = _scores_buffer(buf, self.nclasses)
+         if real:
+            norm = 0
+            for k in xrange(n):
+               f = _real_feature(features[k], &vals[k])
+               rows[k] = self._row_index(f, &signs[k], FIND_ROW)
+               signs[k] *= vals[k]
+               norm += vals[k]*vals[k]
+            norm += norm
+         else:
+            for k in xrange(nf):
+               rows[k] = self._row_index(features[k], &signs[k], FIND_ROW)
+            if pairs is not None:
+               hashes = <uint64_t *>malloc((n - nf + 1)*sizeof(uint64_t))
+               if hashes == NULL:
+                  raise MemoryError()
+               _pair_hashes(pairs[0], pairs[1], pairs[2], hashes)
+               for k in xrange(nf, n):
+                  rows[k] = hashes[k - nf] & self.hmask
+                  signs[k] = _hash_sign(hashes[k - nf], self.hash_signed)
+         with nogil:
+            best = self._score_rows(rows, signs, n, scores)
+            if best != gold:
+               tau = _update_size(scores[best] - scores[gold] + 1, norm, variant, C)
+         if tau == 0: return best
+
+         for k in xrange(n):
+            if rows[k] < 0:
+               f = _real_feature(features[k], &vals[k]) if real else features[k]
+               rows[k] = self._row_index(f, &signs[k], ADMIT_ROW)
+               if real:
+                  signs[k] *= vals[k]
+         with nogil:
+            for k in range(n):
+               if rows[k] < 0: continue # not admitted yet
+               self._add_entry(rows[k]*self.nclasses+best, -tau*signs[k])
+               self._add_entry(rows[k]*self.nclasses+gold, tau*signs[k])
+         return best
+      finally:
+         free(rows)
+         free(signs)
+         free(hashes)
+         if scores != buf:
+            free(scores)
+
+   cdef int _score_rows(self, Py_ssize_t *rows, double *signs, Py_ssize_t n,
+                        double *scores) nogil:
+      """
+      scores = the sum of the given rows (-1: no row), times their signs
+      (and values).
+      return: the best class, the first one on ties.
+      """
+      cdef Py_ssize_t k
+      cdef double *w
+      cdef int c, best = 0
+      for c in range(self.nclasses):
+         scores[c]=0
+      for k in range(n):
+         if rows[k] >= 0:
+            w = self.w + rows[k]*self.nclasses
+            for c in range(self.nclasses):
+               scores[c] += w[c]*signs[k]
+      for c in range(1,self.nclasses):
+         if scores[best] < scores[c]:
+            best = c
+      return best
+
+   cdef inline void _add_entry(self, Py_ssize_t i, double amount) nogil:
+      self.acc[i]+=(self.now-self.lastUpd[i])*self.w[i]
+      self.w[i]+=amount
+      self.lastUpd[i]=self.now
+
+   cdef array.array _weights(self, bint averaged):
+      cdef Py_ssize_t i, n = self.nrows * self.nclasses
+      cdef array.array ws = array.array('d')
+      array.resize(ws, n)
+      for i in xrange(n):
+         if averaged:
+            ws.data.as_doubles[i] = (self.acc[i]+((self.now-self.lastUpd[i])*self.w[i])) / self.now
+         else:
+            ws.data.as_doubles[i] = self.w[i]
+      return ws
 
    def finalize(self):
-      cdef MulticlassParamData p
+      cdef Py_ssize_t i
       # average
-      for f in self.W.keys():
-         for c in xrange(self.nclasses):
-            p = self.W[f]
-            p.acc[c]+=(self.now-p.lastUpd[c])*p.w[c]
-            p.w[c] = p.acc[c] / self.now
+      for i in xrange(self.nrows * self.nclasses):
+         self.acc[i]+=(self.now-self.lastUpd[i])*self.w[i]
+         self.w[i] = self.acc[i] / self.now
 
    def dump(self, out=sys.stdout):
-      cdef MulticlassParamData p
-      for f in self.W.keys():
-         out.write("%s" % f)
-         for c in xrange(self.nclasses):
-            p = self.W[f]
-            out.write(" %s" % p.w[c])
-         out.write("\n")
+      if self.hash_bits:
+         write_hashed_model(out, self._weights(False), self.nclasses, self.hash_bits, self.hash_signed)
+         return
+      self._dump_text(out, self.w, "%s" + " %s" * self.nclasses + "\n")
+
+   cdef _dump_text(self, out, double *w, str fmt):
+      """
+      writes fmt % (feature, weights of the feature...) for each feature,
+      a few thousand lines per write.
+      """
+      cdef Py_ssize_t r, c
+      cdef list lines = []
+      cdef list row
+      for f,r in self.W.iteritems():
+         row = [f]
+         for c in range(self.nclasses):
+            row.append(w[r*self.nclasses+c])
+         lines.append(fmt % tuple(row))
+         if len(lines) == 4096:
+            out.write("".join(lines))
+            lines = []
+      out.write("".join(lines))
+
+   def dump_binary(self, out, dtype="f8", double prune=0.0, bint averaged=False):
+      """
+      writes the current weights (call finalize first), or their average
+      so far, as a binary model, dropping the features whose weights are
+      all below prune. hashed parameters are never pruned.
+      """
+      if self.hash_bits:
+         write_hashed_model(out, self._weights(averaged), self.nclasses, self.hash_bits, self.hash_signed, dtype)
+         return
+      features = [None] * self.nrows
+      for f,r in self.W.iteritems():
+         features[r] = f
+      weights = self._weights(averaged)
+      if prune > 0 or self.free_rows:
+         features, weights = prune_model(features, weights, self.nclasses, prune)
+      write_binary_model(out, features, weights, self.nclasses, dtype)
 
    def dump_fin(self,out=sys.stdout):
-      cdef MulticlassParamData p
+      if self.hash_bits:
+         write_hashed_model(out, self._weights(True), self.nclasses, self.hash_bits, self.hash_signed)
+         return
       # write the average
-      for f in self.W.keys():
-         out.write("%s" % f)
-         for c in xrange(self.nclasses):
-            p = self.W[f]
-            out.write(" %s " % ((p.acc[c]+((self.now-p.lastUpd[c])*p.w[c])) / self.now))
-         out.write("\n")
+      cdef array.array ws = self._weights(True)
+      self._dump_text(out, ws.data.as_doubles, "%s" + " %s " * self.nclasses + "\n")
+
+def load_params(fname):
+   """
+   new MultitronParameters with the classes and the hashing of the model
+   in fname, warm started from it (see warm_start).
+   """
+   cdef WeightTable table = _open_table(fname)
+   cdef int hash_bits = 0
+   cdef MultitronParameters params
+   if table.hashed:
+      while (<Py_ssize_t>1 << hash_bits) < table.nrows:
+         hash_bits += 1
+   params = MultitronParameters(table.nclasses, hash_bits, table.hash_signed)
+   params._warm_start(table, fname)
+   return params
+
+@cython.binding(True)
+def _restore_params(nclasses, hash_bits, hash_signed, now, W, acc, w, lastUpd,
+                    admit_after=0, max_rows=0):
+   """
+   unpickles MultitronParameters (the admission sketch starts over)
+   """
+   cdef MultitronParameters params = MultitronParameters(nclasses, hash_bits, hash_signed)
+   params._restore(now, W, acc, w, lastUpd)
+   params.limit_features(admit_after, max_rows)
+   return params
+
+# ml.pyx is imported as ml.ml, pickle needs to find it there
+_restore_params.__module__ = __name__
 
 ##################
-cdef class ParamData:
-   cdef:
-      double acc
-      double w
-      int lastUpd
-   def __init__(self):
-      self.acc=0
-      self.w=0
-      self.lastUpd=0
-
 cdef class PerceptronParameters:
+   """
+   averaged perceptron parameters of a single linear model.
+   W maps each feature to its entry in the acc, w and lastUpd arrays.
+   """
    cdef:
       int now
-      dict W
+      FeatureIndex W
+      Py_ssize_t nparams, capacity
+      double *acc
+      double *w
+      int *lastUpd
+
+   def __cinit__(self):
+      self.nparams = 0
+      self.capacity = 0
+      self.acc = NULL
+      self.w = NULL
+      self.lastUpd = NULL
 
    def __init__(self):
       self.now = 0
-      self.W = {}
+      self.W = FeatureIndex([])
+
+   def __dealloc__(self):
+      free(self.acc)
+      free(self.w)
+      free(self.lastUpd)
 
    def tick(self):
       self.now+=1
@@ -522,76 +2076,88 @@ cdef class PerceptronParameters:
       return self._score(features)
 
    cdef _score(self, features):
-      cdef ParamData p
       cdef double score=0
+      cdef Py_ssize_t r
       for f in features:
-         try:
-            p = self.W[f]
-            score += p.w
-         except KeyError: 
-            pass
+         r = self.W.lookup(f)
+         if r >= 0:
+            score += self.w[r]
       return score
 
+   cdef int _grow(self) except -1:
+      cdef Py_ssize_t capacity = max(1024, 2*self.capacity)
+      cdef double *acc = <double *>realloc(self.acc, capacity*sizeof(double))
+      cdef double *w
+      cdef int *lastUpd
+      if acc != NULL: self.acc = acc
+      w = <double *>realloc(self.w, capacity*sizeof(double))
+      if w != NULL: self.w = w
+      lastUpd = <int *>realloc(self.lastUpd, capacity*sizeof(int))
+      if lastUpd != NULL: self.lastUpd = lastUpd
+      if acc == NULL or w == NULL or lastUpd == NULL:
+         raise MemoryError("cannot grow parameters to %s features" % capacity)
+      self.capacity = capacity
+      return 0
+
    cpdef updateFeatures(self, features, double amount):
-      cdef ParamData p
-      cdef str f
+      cdef Py_ssize_t r
+      cdef bytes b
       for f in features:
-         try:
-            p = self.W[f]
-         except KeyError:
-            p = ParamData()
-            self.W[f] = p
-         p.acc+=(self.now-p.lastUpd)*p.w
-         p.w+=amount
-         p.lastUpd=self.now
+         b = _as_bytes(f)
+         r = self.W._insert(b, len(b))
+         if self.W.nrows > self.nparams:
+            # a new feature
+            if r == self.capacity:
+               self._grow()
+            self.acc[r] = 0
+            self.w[r] = 0
+            self.lastUpd[r] = 0
+            self.nparams += 1
+         self.acc[r]+=(self.now-self.lastUpd[r])*self.w[r]
+         self.w[r]+=amount
+         self.lastUpd[r]=self.now
 
    def finalize(self):
-      cdef ParamData p
+      cdef Py_ssize_t r
       # average
-      for f in self.W.keys():
-         p = self.W[f]
-         p.acc+=(self.now-p.lastUpd)*p.w
-         p.w = p.acc / self.now
+      for r in xrange(self.W.nrows):
+         self.acc[r]+=(self.now-self.lastUpd[r])*self.w[r]
+         self.w[r] = self.acc[r] / self.now
 
    def dump(self, out=sys.stdout):
-      cdef ParamData p
-      for f,p in self.W.iteritems():
-         out.write("%s" % f)
-         out.write(" %s" % p.w)
-         out.write("\n")
+      cdef Py_ssize_t r
+      for r in xrange(self.W.nrows):
+         out.write("%s %s\n" % (self.W._key(r), self.w[r]))
 
    def dump_fin(self, out=sys.stdout):
-      cdef ParamData p
-      for f,p in self.W.iteritems():
-         out.write("%s" % f)
-         out.write(" %s " % ((p.acc+((self.now-p.lastUpd)*p.w)) / self.now))
-         out.write("\n")
-
-cdef class _float:
-   cdef:
-      float val
+      cdef Py_ssize_t r
+      for r in xrange(self.W.nrows):
+         out.write("%s %s \n" % (self.W._key(r), (self.acc[r]+((self.now-self.lastUpd[r])*self.w[r])) / self.now))
 
-cdef _float makef(float f):
-   cdef _float mf = _float.__new__(_float)
-   mf.val = f
-   return mf
-   
 cdef class LinearModel:
+   """
+   a read only linear model: one (single precision) weight per feature,
+   looked up through a FeatureIndex.
+   """
    cdef:
-      dict W
-
-   def __init__(self):
-      self.W = {}
+      FeatureIndex index
+      array.array weights
 
    def __cinit__(self):
-      self.W = {}
+      self.index = FeatureIndex([])
+      self.weights = array.array('f')
 
    cpdef _load(self, fh):
+      cdef Py_ssize_t r
+      cdef float w
       for line in fh:
-         if not line.strip(): break
-         f,w = line.strip().split()
-         #self.W[f]=float(w)
-         self.W[f]=makef(float(w))
+         r = _read_weight_line(self.index, line, &w)
+         if r < 0: break
+         if r < len(self.weights):
+            self.weights.data.as_floats[r] = w
+         else:
+            self.weights.append(w)
+      self.index._trim()
       return self
    
    @classmethod
@@ -614,15 +2180,12 @@ cdef class LinearModel:
 
    cdef double _score(self, list features):
       cdef double score=0
-      cdef str f
-      cdef _float v
+      cdef Py_ssize_t r
+      cdef float *w = self.weights.data.as_floats
       for f in features:
-         try:
-            v = self.W[f]
-            score += v.val
-            #score += self.W[f]
-         except KeyError: 
-            pass
+         r = self.index.lookup(f)
+         if r >= 0:
+            score += w[r]
       return score
 
 #}}}
@@ -685,38 +2248,88 @@ cdef class MultipleVectorsMulticlassParams(MultipleVectorsMulticlassModel):
          out.write("\n")
 
 cdef class MulticlassLinearModel(MultipleVectorsMulticlassModel):
+   """
+   one linear model per class, sharing a single FeatureIndex. the weights
+   are stored by feature, sparsely: the entries of row r are
+   starts[r]..starts[r+1]-1, each a class (ascending) and its weight.
+   """
    cdef:
-      list linearmodels  # TODO specific type?
       int _nclasses
+      FeatureIndex index
+      array.array starts   # 'l', nrows+1
+      array.array classes  # 'i'
+      array.array weights  # 'f'
 
-   def __init__(self):
-      self.linearmodels=[]
-
-   def _addmodel(self, m):
-      self.linearmodels.append(m)
-      self._nclasses = len(self.linearmodels)
+   def __cinit__(self):
+      self._nclasses = 0
+      self.index = FeatureIndex([])
+      self.starts = array.array('l', [0])
+      self.classes = array.array('i')
+      self.weights = array.array('f')
 
    cpdef int nclasses(self):
       return self._nclasses
 
    @classmethod
    def from_file(cls, fname):
-      o=cls()
+      cdef MulticlassLinearModel o = cls()
+      cdef array.array rows = array.array('l')
+      cdef array.array classes = array.array('i')
+      cdef array.array weights = array.array('f')
+      cdef array.array starts
+      cdef Py_ssize_t r, k, n
+      cdef float w
+      cdef int c
       fh=file(fname)
       nclasses=int(fh.next())
-      for i in xrange(nclasses):
-         model=LinearModel.from_fh(fh)
-         o._addmodel(model)
+      # read the (row, class, weight) entries in file order,
+      for c in xrange(nclasses):
+         for line in fh:
+            r = _read_weight_line(o.index, line, &w)
+            if r < 0: break
+            rows.append(r)
+            classes.append(c)
+            weights.append(w)
+      # then bucket them by row, keeping the classes in order.
+      n = len(rows)
+      starts = array.array('l', [0]) * (o.index.nrows + 1)
+      for k in xrange(n):
+         starts.data.as_longs[rows.data.as_longs[k] + 1] += 1
+      for r in xrange(o.index.nrows):
+         starts.data.as_longs[r + 1] += starts.data.as_longs[r]
+      o.classes = array.array('i', [0]) * n
+      o.weights = array.array('f', [0]) * n
+      for k in xrange(n):
+         r = rows.data.as_longs[k]
+         o.classes.data.as_ints[starts.data.as_longs[r]] = classes.data.as_ints[k]
+         o.weights.data.as_floats[starts.data.as_longs[r]] = weights.data.as_floats[k]
+         starts.data.as_longs[r] += 1
+      # starts[r] is now the end of row r
+      for r in xrange(o.index.nrows, 0, -1):
+         starts.data.as_longs[r] = starts.data.as_longs[r - 1]
+      starts.data.as_longs[0] = 0
+      o.starts = starts
+      o.index._trim()
+      o._nclasses = nclasses
       return o
 
+   cdef double _score(self, list features, int clas):
+      cdef double score=0
+      cdef Py_ssize_t r, k
+      cdef long *starts = self.starts.data.as_longs
+      cdef int *classes = self.classes.data.as_ints
+      for f in features:
+         r = self.index.lookup(f)
+         if r < 0: continue
+         for k in xrange(starts[r], starts[r + 1]):
+            if classes[k] == clas:
+               score += self.weights.data.as_floats[k]
+               break
+      return score
+
    cpdef get_scores(self, list features):
       cdef dict scores={}
       cdef int i
-      cdef LinearModel lm
-      cdef list feats
       for i in xrange(self._nclasses):
-         lm = self.linearmodels[i]
-         feats = features[i]
-         scores[i]=lm._score(feats)
+         scores[i]=self._score(features[i], i)
       return scores
-
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# Copyright 2010 Yoav Goldberg
+##
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+##
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+"""
+model file utilities.
+
+converting a text model (as written by MultitronParameters.dump) to the
+binary, mmap-able format. ml.MulticlassModel loads both formats:
+   modeltool.py --convert --model=eager.model --output=eager.model.bin
+
+the binary model can be compressed by pruning the features whose weights
+are all small, and by storing the weights as f4/f2/i8. --eval_data reports
+the accuracy of both models on a dev file:
+   modeltool.py --convert --model=eager.model --prune=0.01 --dtype=i8 \
+      --eval_data=en-ud-dev.conllu
+
+merging several models into one binary model, either by interpolating
+their weights (MultitronParameters.add_params):
+   modeltool.py --merge=en.model,en-web.model --merge_weights=0.7,0.3 \
+      --output=en-mix.model.bin
+or as a namespaced union, each model being served by
+MulticlassModel(output).domain(name):
+   modeltool.py --merge=en.model,zh.model --domains=en,zh --output=multi.model.bin
+"""
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+curdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(curdir, os.path.pardir))
+
+from absl import app
+from absl import flags
+from absl import logging
+
+from ml import get_backend, BACKENDS
+from pio import io
+from features import extractors
+from transitionparser.deciders import MLActionDecider
+from transitionparser.parsers import ArcEagerParser, ArcStandardParser2
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('model', None, 'Input model file.')  # nopep8
+flags.DEFINE_enum('ml_backend', None, BACKENDS, 'ml backend, defaults to $ML_BACKEND or cython if it is built, else numpy.')  # nopep8
+flags.DEFINE_string('output', None, 'Output model file, defaults to the input model with a .bin suffix.')  # nopep8
+
+'''
+Convert
+'''
+flags.DEFINE_boolean('convert', False, 'Convert a text model to the binary format.')  # nopep8
+flags.DEFINE_enum('dtype', 'f8', ['f8', 'f4', 'f2', 'i8'], 'Weight type of the binary model.')  # nopep8
+flags.DEFINE_float('prune', 0.0, 'Drop the features whose weights are all below this (absolute) value.')  # nopep8
+
+'''
+Merge
+'''
+flags.DEFINE_list('merge', None, 'Merge these models into --output, a binary model of --dtype: the interpolation of their weights, or their union with --domains.')  # nopep8
+flags.DEFINE_list('merge_weights', None, 'Interpolation weights of the --merge models, uniform by default.')  # nopep8
+flags.DEFINE_list('domains', None, 'Domain name of each --merge model: merge them as a namespaced union, served by MulticlassModel.domain(name).')  # nopep8
+
+'''
+Evaluate
+'''
+flags.DEFINE_string('eval_data', None, 'Report the accuracy of the input and the output models on this conll file.')  # nopep8
+flags.DEFINE_enum('parser', 'eager', ['eager', 'standard'], 'Parser the model was trained for.')  # nopep8
+flags.DEFINE_string('feature_extarctor', 'eager.zhang', 'Feature Extarctor the model was trained with.')  # nopep8
+
+
+def convert():
+    '''
+    Convert a text model to the binary format
+    '''
+    output = FLAGS.output or FLAGS.model + ".bin"
+    logging.info("convert [%s] -> [%s] ...", FLAGS.model, output)
+    nfeatures, nkept, nclasses = ml.convert_text_model(FLAGS.model, output, FLAGS.dtype, FLAGS.prune)
+    logging.info("features: %s (%s pruned), classes: %s", nkept, nfeatures - nkept, nclasses)
+    logging.info("size: %s -> %s bytes", os.path.getsize(FLAGS.model), os.path.getsize(output))
+    if FLAGS.eval_data:
+        before = evaluate(FLAGS.model)
+        after = evaluate(output)
+        logging.info("accuracy: %s -> %s (%+f)", before, after, after - before)
+
+
+def merge():
+    '''
+    Merge several models into one binary model
+    '''
+    fnames = FLAGS.merge
+    domains = FLAGS.domains or [None] * len(fnames)
+    weights = [1.0 / len(fnames)] * len(fnames)
+    if not FLAGS.output:
+        raise app.UsageError("--merge needs --output")
+    if FLAGS.domains and (len(set(FLAGS.domains)) != len(fnames) or FLAGS.merge_weights):
+        raise app.UsageError("--domains needs one distinct domain per --merge model, and no --merge_weights")
+    if FLAGS.merge_weights:
+        if len(FLAGS.merge_weights) != len(fnames):
+            raise app.UsageError("--merge_weights needs one weight per --merge model")
+        weights = [float(w) for w in FLAGS.merge_weights]
+    merged = None
+    for fname, weight, domain in zip(fnames, weights, domains):
+        logging.info("merge [%s] %s ...", fname, domain or weight)
+        params = ml.load_params(fname)
+        if merged is None:
+            merged = ml.MultitronParameters(params.nclasses, params.hash_bits, params.hash_signed)
+        if (params.nclasses, params.hash_bits, params.hash_signed) != (merged.nclasses, merged.hash_bits, merged.hash_signed):
+            raise ValueError("%s: the classes or the feature hashing differ from %s" % (fname, fnames[0]))
+        if domain is None:
+            merged.add_params(params, weight)
+        else:
+            merged.add_params(params, 1.0, domain)
+    with open(FLAGS.output, "wb") as fout:
+        merged.dump_binary(fout, FLAGS.dtype, FLAGS.prune)
+    logging.info("features: %s, size: %s bytes", len(merged), os.path.getsize(FLAGS.output))
+    if FLAGS.eval_data:
+        for fname, domain in zip(fnames, domains):
+            logging.info("accuracy [%s]: %s, merged: %s", fname, evaluate(fname), evaluate(FLAGS.output, domain))
+
+
+def evaluate(model, domain=None):
+    '''
+    Attachment accuracy of the model (or of one of its domains) on --eval_data
+    '''
+    featExt = extractors.get(FLAGS.feature_extarctor)
+    Parser = ArcEagerParser if FLAGS.parser == 'eager' else ArcStandardParser2
+    m = ml.MulticlassModel(model)
+    if domain is not None:
+        m = m.domain(domain)
+    p = Parser(MLActionDecider(m, featExt))
+    good = 0.0
+    total = 0.0
+    for sent in io.transform_conll_sents(FLAGS.eval_data):
+        sent = p.parse(sent).annotate_allow_none(sent)
+        for tok in sent:
+            total += 1
+            if tok['parent'] == tok['pparent']:
+                good += 1
+    return good / total
+
+
+def main(argv):
+    global ml
+    ml = get_backend(FLAGS.ml_backend)
+    if FLAGS.merge:
+        merge()
+        return
+    if not FLAGS.model:
+        raise app.UsageError("--model is required")
+    if FLAGS.convert:
+        convert()
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -0,0 +1,1257 @@
+# Copyright 2010 Yoav Goldberg
+##
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+##
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+"""
+numpy implementation of the ml module (see ml.pyx), for when the cython
+extension cannot be built.
+
+same classes and model files as ml.pyx: the weights are numpy matrices
+(nrows x nclasses) indexed by a feature -> row dict, and the scoring of a
+feature list is a single gather + sum.
+"""
+from __future__ import division
+
+import sys
+import struct
+
+import numpy as np
+
+if sys.version_info[0] >= 3:
+    unicode = str
+    xrange = range
+
+### Model files {{{
+# see the format description in ml.pyx
+
+BINARY_MAGIC = b"TDPMODEL"
+BINARY_VERSION = 1
+# magic, version, flags, nclasses, dtype, nrows, nslots, keys_size, hash_bits
+BINARY_HEADER = "<8sIIIIQQQI12x"
+
+FLAG_HASHED = 1
+FLAG_SIGNED = 2
+
+DTYPES = {"f8": 0, "f4": 1, "f2": 2, "i8": 3}
+_NP_DTYPES = {0: "<f8", 1: "<f4", 2: "<f2", 3: "i1"}
+
+# hashed tables have at most 2**MAX_HASH_BITS rows
+MAX_HASH_BITS = 30
+
+_FNV_OFFSET = 14695981039346656037
+_FNV_PRIME = 1099511628211
+_MASK64 = (1 << 64) - 1
+
+
+def _as_bytes(f):
+    if isinstance(f, unicode):
+        return f.encode("utf8")
+    return f
+
+
+def feature_hash(f):
+    """
+    the (stable, 64bit) hash of a feature string used in binary models
+    and in feature hashing
+    """
+    h = _FNV_OFFSET
+    for c in bytearray(_as_bytes(f)):
+        h = ((h ^ c) * _FNV_PRIME) & _MASK64
+    return h
+
+
+def conjunctions(left, right, sep="_"):
+    """
+    the conjunctions of two feature lists: f1 + sep + f2 for each f1 of
+    left and f2 of right, in that order (see ml.pyx: this backend makes
+    their strings for pair_ids / update_pairs / do_pa_update_pairs).
+    """
+    return [l + f2 for l in [f1 + sep for f1 in left] for f2 in right]
+
+
+# feature -> feature_hash, cleared when it grows past _HASHES_SIZE
+_HASHES = {}
+_HASHES_SIZE = 1 << 20
+
+
+def _feature_hashes(features):
+    """
+    feature_hash of each of the features, as an uint64 array
+    """
+    missing = [f for f in features if f not in _HASHES]
+    if missing:
+        if len(_HASHES) + len(missing) > _HASHES_SIZE:
+            _HASHES.clear()
+            missing = features
+        _HASHES.update(zip(missing, _compute_hashes(missing).tolist()))
+    return np.array([_HASHES[f] for f in features], dtype=np.uint64)
+
+
+def _compute_hashes(features):
+    keys = [_as_bytes(f) for f in features]
+    lens = np.array([len(k) for k in keys], dtype=np.intp)
+    width = lens.max() if len(keys) else 0
+    data = np.frombuffer(b"".join(k.ljust(width, b"\0") for k in keys), dtype=np.uint8)
+    data = data.reshape(len(keys), width).astype(np.uint64)
+    h = np.full(len(keys), _FNV_OFFSET, dtype=np.uint64)
+    prime = np.uint64(_FNV_PRIME)
+    for j in xrange(width):
+        # multiplication wraps around modulo 2**64, as in C
+        h = np.where(lens > j, (h ^ data[:, j]) * prime, h)
+    return h
+
+
+def _hash_sign(h, signed):
+    if signed and (h >> 63):
+        return -1.0
+    return 1.0
+
+
+def _check_hash_bits(hash_bits):
+    if not 0 <= hash_bits <= MAX_HASH_BITS:
+        raise ValueError("hash_bits must be between 0 and %s, got %s" % (MAX_HASH_BITS, hash_bits))
+
+
+def _scales_size(nrows):
+    return (nrows * 4 + 7) & ~7
+
+
+def read_text_model(fname):
+    """
+    reads a text model.
+    returns (features, weights, nclasses), where weights is a
+    len(features) x nclasses matrix.
+    """
+    features = []
+    weights = []
+    nclasses = -1
+    for line in open(fname):
+        if not line.strip():
+            continue
+        f, ws = line.strip().split(None, 1)
+        ws = [float(w) for w in ws.split()]
+        if nclasses < 0:
+            nclasses = len(ws)
+        elif len(ws) != nclasses:
+            raise ValueError("%s: feature %s has %s weights, expected %s" % (fname, f, len(ws), nclasses))
+        features.append(f)
+        weights.append(ws)
+    if nclasses < 0:
+        raise ValueError("%s: empty model" % fname)
+    return features, np.array(weights, dtype=np.float64), nclasses
+
+
+def prune_model(features, weights, nclasses, threshold):
+    """
+    drops the features whose weights are all below threshold (in absolute
+    value). the **BIAS** feature is always kept.
+    returns (features, weights) of the kept features.
+    """
+    weights = np.asarray(weights, dtype=np.float64).reshape(-1, nclasses)
+    keep = (np.abs(weights) >= threshold).any(axis=1)
+    keep |= np.array([f == '**BIAS**' for f in features], dtype=bool)
+    # free rows (see MultitronParameters.limit_features)
+    keep &= np.array([f is not None for f in features], dtype=bool)
+    return [f for f, k in zip(features, keep) if k], weights[keep]
+
+
+def _write_header(out, flags, nclasses, dtype, nrows, nslots=0, keys_size=0, hash_bits=0):
+    if dtype not in DTYPES:
+        raise ValueError("unknown dtype %s, possible values: %s" % (dtype, list(DTYPES.keys())))
+    out.write(struct.pack(BINARY_HEADER, BINARY_MAGIC, BINARY_VERSION, flags,
+                          nclasses, DTYPES[dtype], nrows, nslots, keys_size, hash_bits))
+
+
+def _write_weights(out, weights, nclasses, dtype):
+    ws = np.asarray(weights, dtype=np.float64).reshape(-1, nclasses)
+    if dtype != "i8":
+        out.write(ws.astype(_NP_DTYPES[DTYPES[dtype]]).tobytes())
+        return
+    scales = (np.abs(ws).max(axis=1) / 127.0).astype("<f4")
+    q = np.rint(ws / np.where(scales > 0, scales, 1)[:, None])
+    out.write(scales.tobytes())
+    out.write(b"\0" * (_scales_size(len(scales)) - scales.nbytes))
+    out.write(np.clip(q, -127, 127).astype(np.int8).tobytes())
+
+
+def write_hashed_model(out, weights, nclasses, hash_bits, signed, dtype="f8"):
+    """
+    writes a hashed binary model to the file object out.
+
+    weights: (2**hash_bits) x nclasses weights
+    """
+    _check_hash_bits(hash_bits)
+    assert np.size(weights) == (1 << hash_bits) * nclasses, "weights do not match hash_bits"
+    _write_header(out, FLAG_HASHED | (FLAG_SIGNED if signed else 0), nclasses, dtype,
+                  1 << hash_bits, 0, 0, hash_bits)
+    _write_weights(out, weights, nclasses, dtype)
+
+
+def write_binary_model(out, features, weights, nclasses, dtype="f8"):
+    """
+    writes a binary model to the file object out.
+
+    features: list of feature strings, one per row
+    weights:  len(features) x nclasses weights
+    dtype:    "f8", "f4", "f2" or "i8"
+    """
+    nrows = len(features)
+    assert np.size(weights) == nrows * nclasses, "weights do not match features"
+    nslots = 16
+    while 3 * nslots < 4 * nrows:
+        nslots *= 2
+    mask = nslots - 1
+    slots = np.zeros(nslots, dtype=[("hash", "<u8"), ("row", "<i8")])
+    slots["row"] = -1
+    keys = [_as_bytes(f) for f in features]
+    offsets = np.zeros(nrows + 1, dtype="<u8")
+    offsets[1:] = np.cumsum([len(k) for k in keys])
+    for r, key in enumerate(keys):
+        h = feature_hash(key)
+        j = h & mask
+        while slots["row"][j] != -1:
+            j = (j + 1) & mask
+        slots[j] = (h, r)
+    blob = b"".join(keys)
+    blob += b"\0" * (-len(blob) % 8)
+    _write_header(out, 0, nclasses, dtype, nrows, nslots, len(blob))
+    out.write(slots.tobytes())
+    out.write(offsets.tobytes())
+    out.write(blob)
+    _write_weights(out, weights, nclasses, dtype)
+
+
+def convert_text_model(text_fname, bin_fname, dtype="f8", prune=0.0):
+    """
+    converts a text model (e.g. the output of MultitronParameters.dump)
+    to a binary one, optionally pruning it (see prune_model).
+    returns (nfeatures, nkept, nclasses).
+    """
+    features, weights, nclasses = read_text_model(text_fname)
+    nfeatures = len(features)
+    if prune > 0:
+        features, weights = prune_model(features, weights, nclasses, prune)
+    with open(bin_fname, "wb") as out:
+        write_binary_model(out, features, weights, nclasses, dtype)
+    return nfeatures, len(features), nclasses
+
+
+class FeatureVocabulary(object):
+    """
+    interns feature strings to dense integer ids (see ml.pyx)
+    """
+
+    def __init__(self, features=None):
+        self.frozen = False
+        self.index = {}
+        self._features = []
+        for f in features or []:
+            if _as_bytes(f) in self.index:
+                raise ValueError("duplicate feature %r" % f)
+            self.ids([f])
+
+    def ids(self, features):
+        """
+        the ids of the features, as an int array. unknown features are
+        added, or left out once the vocabulary is frozen.
+        """
+        index = self.index
+        ids = []
+        for f in features:
+            key = _as_bytes(f)
+            i = index.get(key)
+            if i is None:
+                if self.frozen:
+                    continue
+                i = index[key] = len(self._features)
+                self._features.append(key)
+            ids.append(i)
+        return np.array(ids, dtype=np.intp)
+
+    def freeze(self):
+        self.frozen = True
+
+    def feature(self, i):
+        """
+        the feature of id i
+        """
+        if not 0 <= i < len(self._features):
+            raise IndexError("no feature id %s" % i)
+        return self._features[i]
+
+    def dump(self, out):
+        """
+        writes the features to out, one per line, in id order
+        """
+        for r in xrange(0, len(self._features), 4096):
+            out.write("".join([f + b"\n" for f in self._features[r:r + 4096]]))
+
+    def __len__(self):
+        return len(self._features)
+
+    def __contains__(self, f):
+        return _as_bytes(f) in self.index
+
+
+def is_binary_model(fname):
+    with open(fname, "rb") as fh:
+        return fh.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+class _TextTable(object):
+    hashed = False
+    hash_signed = False
+
+    def __init__(self, fname):
+        features, self.weights, self.nclasses = read_text_model(fname)
+        self.nrows = len(features)
+        self.index = dict(zip(features, xrange(self.nrows)))
+
+    def lookup(self, features, values=None):
+        """
+        rows and values of the features that are in the model
+        """
+        index = self.index
+        if values is None:
+            rows = [index[f] for f in features if f in index]
+            return rows, None
+        found = [(index[f], v) for f, v in zip(features, values) if f in index]
+        return [r for r, v in found], [v for r, v in found]
+
+    def rows(self, rows):
+        return self.weights[rows]
+
+
+class _MappedTable(object):
+
+    def __init__(self, fname):
+        hsize = struct.calcsize(BINARY_HEADER)
+        with open(fname, "rb") as fh:
+            header = fh.read(hsize)
+        if len(header) < hsize:
+            raise ValueError("%s: truncated binary model" % fname)
+        magic, version, flags, nclasses, dtype, nrows, nslots, keys_size, hash_bits = struct.unpack(BINARY_HEADER, header)
+        if magic != BINARY_MAGIC:
+            raise ValueError("%s is not a binary model" % fname)
+        if version != BINARY_VERSION:
+            raise ValueError("%s: unsupported binary model version %s" % (fname, version))
+        if dtype not in _NP_DTYPES:
+            raise ValueError("%s: unknown dtype %s" % (fname, dtype))
+        self.nclasses = nclasses
+        self.nrows = nrows
+        self.hashed = bool(flags & FLAG_HASHED)
+        self.hash_signed = bool(flags & FLAG_SIGNED)
+        data = np.memmap(fname, dtype=np.uint8, mode="r")
+        if self.hashed:
+            if hash_bits > MAX_HASH_BITS or nrows != (1 << hash_bits):
+                raise ValueError("%s: bad hashed model" % fname)
+            self.mask = nrows - 1
+            offset = hsize
+        else:
+            if nslots == 0 or nslots & (nslots - 1) or nrows >= nslots:
+                raise ValueError("%s: bad slot table" % fname)
+            offset = hsize + nslots * 16
+            if len(data) < offset + (nrows + 1) * 8 + keys_size:
+                raise ValueError("%s: truncated binary model" % fname)
+            offsets = data[offset:offset + (nrows + 1) * 8].view("<u8")
+            if (np.diff(offsets.astype(np.int64)) < 0).any() or offsets[nrows] > keys_size:
+                raise ValueError("%s: corrupt binary model" % fname)
+            offset += (nrows + 1) * 8
+            keys = data[offset:offset + keys_size].tobytes()
+            offset += keys_size
+            self.index = dict((keys[offsets[r]:offsets[r + 1]], r) for r in xrange(nrows))
+        self.scales = None
+        if dtype == DTYPES["i8"]:
+            self.scales = data[offset:offset + nrows * 4].view("<f4")
+            offset += _scales_size(nrows)
+        size = nrows * nclasses * np.dtype(_NP_DTYPES[dtype]).itemsize
+        if len(data) < offset + size:
+            raise ValueError("%s: truncated binary model" % fname)
+        self.weights = data[offset:offset + size].view(_NP_DTYPES[dtype]).reshape(nrows, nclasses)
+
+    def lookup(self, features, values=None):
+        if values is None:
+            values = [1.0] * len(features)
+            signed = self.hashed and self.hash_signed
+        else:
+            signed = True
+        if self.hashed:
+            hs = _feature_hashes(features)
+            rows = (hs & np.uint64(self.mask)).astype(np.intp)
+            vals = np.array(values, dtype=np.float64)
+            if self.hash_signed:
+                vals *= np.where(hs >> np.uint64(63), -1.0, 1.0)
+            return rows, (vals if signed else None)
+        rows = []
+        vals = []
+        for f, v in zip(features, values):
+            r = self.index.get(_as_bytes(f))
+            if r is not None:
+                rows.append(r)
+                vals.append(v)
+        return rows, (vals if signed else None)
+
+    def rows(self, rows):
+        ws = self.weights[rows].astype(np.float64)
+        if self.scales is not None:
+            ws *= self.scales[rows][:, None]
+        return ws
+#}}}
+
+
+def _open_table(fname):
+    return _MappedTable(fname) if is_binary_model(fname) else _TextTable(fname)
+
+
+def _domain_prefix(domain):
+    """
+    the prefix of the features of domain in a namespaced union of models
+    """
+    return "%s::" % domain
+
+
+def _split_real(features):
+    """
+    (features, values) of a list of (feature, value) pairs mixed with plain
+    features, whose value is 1.
+    """
+    fs = []
+    values = []
+    for item in features:
+        if type(item) is tuple:
+            fs.append(item[0])
+            values.append(item[1])
+        else:
+            fs.append(item)
+            values.append(1.0)
+    return fs, np.array(values, dtype=np.float64)
+
+
+class MulticlassModel(object):
+
+    prefix = None  # of the features of the domain, see domain
+
+    def __init__(self, fname, probs_output=False):
+        self.probs_output = probs_output
+        sys.stderr.write("loading model %s" % fname)
+        self.table = _open_table(fname)
+        self.nclas = self.table.nclasses
+        self._load_biases()
+        sys.stderr.write(" done\n")
+
+    def _load_biases(self):
+        self.biases = np.zeros(self.nclas)
+        if not self.table.hashed:
+            rows, _ = self._lookup(['**BIAS**'])
+            if rows:
+                self.biases += self.table.rows(rows)[0]
+
+    def _lookup(self, features, values=None):
+        if self.prefix is not None:
+            features = [self.prefix + f for f in features]
+        return self.table.lookup(features, values)
+
+    def domain(self, name):
+        """
+        the model of domain name in a namespaced union of models (see
+        ml.pyx)
+        """
+        if self.table.hashed:
+            raise ValueError("hashed models have no domains")
+        view = MulticlassModel.__new__(MulticlassModel)
+        view.table = self.table
+        view.nclas = self.nclas
+        view.probs_output = self.probs_output
+        view.prefix = _domain_prefix(name)
+        view._load_biases()
+        return view
+
+    def _scores(self, features, values=None):
+        rows, vals = self._lookup(features, values)
+        ws = self.table.rows(rows)
+        if vals is None:
+            return self.biases + ws.sum(axis=0)
+        return self.biases + np.dot(np.asarray(vals, dtype=np.float64), ws)
+
+    def ids(self, features):
+        """
+        the ids of the features the model knows (see ml.pyx): their rows,
+        or ~row for the features that signed hashing turns negative.
+        """
+        rows, vals = self._lookup(features)
+        rows = np.asarray(rows, dtype=np.intp)
+        if vals is not None:
+            rows = np.where(np.asarray(vals) < 0, ~rows, rows)
+        return rows
+
+    def pair_ids(self, features, left, right, sep="_"):
+        """
+        ids(features + conjunctions(left, right, sep))
+        """
+        return self.ids(features + conjunctions(left, right, sep))
+
+    def ids_r(self, features):
+        """
+        like ids, for real valued features: (ids, values), the rows and the
+        matching values, in which the sign of signed hashing is folded.
+        """
+        features, values = _split_real(features)
+        rows, vals = self._lookup(features, values)
+        return np.asarray(rows, dtype=np.intp), np.asarray(vals, dtype=np.float64)
+
+    def _scores_ids(self, ids, values=None):
+        ids = np.asarray(ids, dtype=np.intp)
+        if values is not None:
+            if len(values) != len(ids):
+                raise ValueError("%s ids but %s values" % (len(ids), len(values)))
+            values = np.where(ids < 0, -1.0, 1.0) * np.asarray(values, dtype=np.float64)
+            return self.biases + np.dot(values, self.table.rows(np.where(ids < 0, ~ids, ids)))
+        if not self.table.hash_signed:
+            return self.biases + self.table.rows(ids).sum(axis=0)
+        signs = np.where(ids < 0, -1.0, 1.0)
+        return self.biases + np.dot(signs, self.table.rows(np.where(ids < 0, ~ids, ids)))
+
+    def _predict(self, scores):
+        if self.probs_output:
+            scores = np.exp(scores - scores.max())
+        # like ml.pyx, the best class is 0 unless some class scores above 0
+        best = max(scores.max(), 0)
+        besti = int(np.argmax(scores)) if best > 0 else 0
+        if self.probs_output:
+            scores = scores / scores.sum()
+        return besti, scores.tolist()
+
+    def predict(self, features):
+        return self._predict(self._scores(features))
+
+    def predict_r(self, features):
+        """
+        like predict but with real values features (see get_scores_r)
+        """
+        return self._predict(self._scores(*_split_real(features)))
+
+    def predict_ids(self, ids, values=None):
+        """
+        like predict, for the ids of the features (see ids), and their
+        values if they are real valued (see ids_r)
+        """
+        return self._predict(self._scores_ids(ids, values))
+
+    def get_scores(self, features):
+        return self._scores(features).tolist()
+
+    def get_scores_ids(self, ids, values=None):
+        """
+        like get_scores, for the ids of the features (see ids), and their
+        values if they are real valued (see ids_r)
+        """
+        return self._scores_ids(ids, values).tolist()
+
+    def get_scores_r(self, features):
+        """
+        like get_scores but with real values features
+           each feature is a pair (f,v), where v is the value, or a plain
+           feature, whose value is 1.
+        """
+        return self._scores(*_split_real(features)).tolist()
+
+    def predict_masked(self, features, mask):
+        """
+        the best class among the allowed ones: class c is allowed if bit c
+        of mask is set.
+        return: (best, margin), where margin is the score difference to the
+        second best allowed class (inf if there is none). best is -1 if no
+        class is allowed.
+        """
+        return self._predict_masked(self._scores(features), mask)
+
+    def predict_masked_r(self, features, mask):
+        """
+        like predict_masked but with real values features (see get_scores_r)
+        """
+        return self._predict_masked(self._scores(*_split_real(features)), mask)
+
+    def predict_masked_ids(self, ids, mask, values=None):
+        """
+        like predict_masked, for the ids of the features (see ids), and their
+        values if they are real valued (see ids_r)
+        """
+        return self._predict_masked(self._scores_ids(ids, values), mask)
+
+    def _predict_masked(self, scores, mask):
+        allowed = [c for c in xrange(self.nclas) if (mask >> c) & 1]
+        if not allowed:
+            return -1, 0.0
+        scores = scores[allowed]
+        k = int(np.argmax(scores))
+        best = scores[k]
+        scores[k] = -np.inf
+        return allowed[k], float(best - scores.max())
+
+    def predict_batch(self, batch, probs=None):
+        """
+        scores a batch of feature lists in one call.
+        return: (best, scores), an int array with the best class of each
+        item and a (len(batch), nclasses) array with its scores, or its
+        probabilities if probs (defaults to the model's probs_output).
+        the best classes are the ones predict would return: without probs,
+        that is class 0 unless some class scores above 0.
+        """
+        if probs is None:
+            probs = self.probs_output
+        rows = []
+        vals = []
+        items = []
+        for b, features in enumerate(batch):
+            r, v = self._lookup(features)
+            rows.extend(r)
+            vals.extend(v if v is not None else [1.0] * len(r))
+            items.extend([b] * len(r))
+        ws = self.table.rows(rows) * np.array(vals)[:, None]
+        scores = np.tile(self.biases, (len(batch), 1))
+        np.add.at(scores, np.array(items, dtype=np.intp), ws)
+        best = np.argmax(scores, axis=1) if len(batch) else np.zeros(0, dtype=np.intp)
+        if not probs and len(batch):
+            best[scores.max(axis=1) <= 0] = 0
+        if probs and len(batch):
+            scores = np.exp(scores - scores.max(axis=1)[:, None])
+            scores /= scores.sum(axis=1)[:, None]
+        return best, scores
+
+
+### Model trainers {{{
+
+_UPDATE_PERCEPTRON = 0
+_UPDATE_PA = 1
+_UPDATE_PA_I = 2
+_UPDATE_PA_II = 3
+
+PA_VARIANTS = {"pa": _UPDATE_PA, "pa1": _UPDATE_PA_I, "pa2": _UPDATE_PA_II}
+
+# how _rows treats the features without a row
+_FIND_ROW = 0
+_ADMIT_ROW = 1
+_CREATE_ROW = 2
+
+# count-min sketch of the features waiting for admission
+_SKETCH_DEPTH = 4
+_SKETCH_WIDTH = 1 << 20
+_SKETCH_MAX = 255
+
+
+class MultitronParameters(object):
+    """
+    multiclass averaged perceptron / passive-aggressive parameters.
+
+    acc, w and lastUpd are nrows x nclasses matrices; W maps each feature
+    to its row. with hash_bits > 0 the features are folded into 2**hash_bits
+    rows by their hash instead (see ml.pyx).
+
+    limit_features and truncate bound the number of rows, the rows they
+    free (free_rows) are reused by the next new features.
+    """
+
+    def __init__(self, nclasses, hash_bits=0, hash_signed=False):
+        _check_hash_bits(hash_bits)
+        self.nclasses = nclasses
+        self.now = 0
+        self.W = {}
+        self.hash_bits = hash_bits
+        self.hash_signed = hash_signed
+        self.hmask = (1 << hash_bits) - 1
+        self.nrows = 0
+        self.hogwild = False
+        self.admit_after = 0
+        self.max_rows = 0
+        self.sketch = None
+        self.free_rows = []
+        self._alloc(1 << hash_bits if hash_bits else 1024)
+        if hash_bits:
+            self.nrows = 1 << hash_bits
+
+    def free_retired(self):
+        """
+        for ml.pyx compatibility: the old matrices are freed by python once
+        no thread uses them.
+        """
+        pass
+
+    def _alloc(self, capacity):
+        acc = np.zeros((capacity, self.nclasses))
+        w = np.zeros((capacity, self.nclasses))
+        lastUpd = np.zeros((capacity, self.nclasses), dtype=np.int64)
+        if self.nrows:
+            acc[:self.nrows] = self.acc[:self.nrows]
+            w[:self.nrows] = self.w[:self.nrows]
+            lastUpd[:self.nrows] = self.lastUpd[:self.nrows]
+        self.acc, self.w, self.lastUpd = acc, w, lastUpd
+
+    def __len__(self):
+        """
+        the number of features with a row (all the rows, when hashed).
+        """
+        if self.hash_bits:
+            return self.nrows
+        return len(self.W)
+
+    def limit_features(self, admit_after=0, max_rows=0):
+        """
+        sets the admission policy of the new features (see ml.pyx):
+        a feature gets a row once it took part in admit_after updates, and
+        past max_rows rows the tenth with the smallest averaged weights is
+        evicted.
+        """
+        if not 0 <= admit_after <= _SKETCH_MAX:
+            raise ValueError("admit_after must be between 0 and %s, got %s" % (_SKETCH_MAX, admit_after))
+        if max_rows < 0:
+            raise ValueError("max_rows must be positive, got %s" % max_rows)
+        if self.hash_bits and (admit_after > 1 or max_rows > 0):
+            raise ValueError("hashed parameters take no feature limits")
+        if admit_after > 1 and self.sketch is None:
+            self.sketch = np.zeros((_SKETCH_DEPTH, _SKETCH_WIDTH), dtype=np.uint8)
+        self.admit_after = admit_after
+        self.max_rows = max_rows
+
+    def warm_start(self, fname):
+        """
+        starts the training from the weights of the model in fname (text or
+        binary), see ml.pyx.
+        """
+        self._warm_start(_open_table(fname), fname)
+
+    def _warm_start(self, table, fname):
+        if self.now or len(self.W):
+            raise ValueError("warm_start needs fresh parameters")
+        if table.nclasses != self.nclasses:
+            raise ValueError("%s has %s classes, expected %s" % (fname, table.nclasses, self.nclasses))
+        if table.hashed != (self.hash_bits > 0) or (table.hashed and (
+                table.nrows != self.nrows or table.hash_signed != self.hash_signed)):
+            raise ValueError("%s: the feature hashing of the model and of the parameters differ" % fname)
+        if table.hashed:
+            self.w[:table.nrows] = table.rows(np.arange(table.nrows))
+            return
+        features = sorted(table.index, key=table.index.get)
+        rows, _ = self._rows(features, _CREATE_ROW)
+        self.w[rows] = table.rows([table.index[f] for f in features])
+
+    def _admit(self, f):
+        """
+        counts one more sighting of f.
+        returns True once f was seen admit_after times.
+        """
+        h = int(_feature_hashes([f])[0])
+        h1, h2 = h & 0xffffffff, (h >> 32) | 1
+        cols = [(h1 + i * h2) & (_SKETCH_WIDTH - 1) for i in xrange(_SKETCH_DEPTH)]
+        counts = self.sketch[np.arange(_SKETCH_DEPTH), cols]
+        counts[counts < _SKETCH_MAX] += 1
+        self.sketch[np.arange(_SKETCH_DEPTH), cols] = counts
+        return counts.min() >= self.admit_after
+
+    def _new_row(self):
+        if self.free_rows:
+            r = self.free_rows.pop()
+            self.acc[r] = 0
+            self.w[r] = 0
+            self.lastUpd[r] = 0
+            return r
+        if self.nrows == len(self.w):
+            self._alloc(2 * len(self.w))
+        self.nrows += 1
+        return self.nrows - 1
+
+    def _evict(self, n):
+        """
+        frees the rows of the n features with the smallest averaged weights.
+        """
+        features = list(self.W)
+        rows = np.array([self.W[f] for f in features], dtype=np.intp)
+        useful = np.abs(self.acc[rows] + (self.now - self.lastUpd[rows]) * self.w[rows]).sum(axis=1)
+        for k in np.argpartition(useful, n - 1)[:n]:
+            self.free_rows.append(self.W.pop(features[k]))
+
+    def truncate(self, l1):
+        """
+        L1 truncation: moves every weight l1 towards zero, and frees the
+        rows of the features whose weights all end up zero.
+        returns the number of features dropped.
+        """
+        n = self.nrows
+        self.acc[:n] += (self.now - self.lastUpd[:n]) * self.w[:n]
+        self.lastUpd[:n] = self.now
+        self.w[:n] = np.sign(self.w[:n]) * np.maximum(np.abs(self.w[:n]) - l1, 0)
+        if self.hash_bits:
+            return 0
+        dropped = [f for f, r in self.W.items() if not self.w[r].any()]
+        for f in dropped:
+            self.free_rows.append(self.W.pop(f))
+        return len(dropped)
+
+    def _rows(self, features, create):
+        """
+        rows (and signs, for signed hashing) of the features.
+        create (_FIND_ROW, _ADMIT_ROW or _CREATE_ROW) says what to do with
+        the features that have no row: they are skipped, unless a row is
+        created, but the ones not admitted yet get row -1.
+        """
+        if self.hash_bits:
+            hs = _feature_hashes(features)
+            rows = (hs & np.uint64(self.hmask)).astype(np.intp)
+            signs = None
+            if self.hash_signed:
+                signs = np.where(hs >> np.uint64(63), -1.0, 1.0)
+            return rows, signs
+        W = self.W
+        if create == _FIND_ROW:
+            return np.array([W[f] for f in features if f in W], dtype=np.intp), None
+        admit = create == _ADMIT_ROW and self.admit_after > 1
+        rows = []
+        for f in features:
+            r = W.get(f)
+            if r is None:
+                if admit and not self._admit(f):
+                    rows.append(-1)
+                    continue
+                r = W[f] = self._new_row()
+            rows.append(r)
+        return np.array(rows, dtype=np.intp), None
+
+    def _add_rows(self, rows, clas, amounts):
+        """
+        w[rows, clas] += amounts, keeping the running average.
+        """
+        if self.admit_after > 1:
+            # the features not admitted yet
+            keep = rows >= 0
+            rows = rows[keep]
+            if np.ndim(amounts):
+                amounts = amounts[keep]
+        u = np.unique(rows)
+        self.acc[u, clas] += (self.now - self.lastUpd[u, clas]) * self.w[u, clas]
+        self.lastUpd[u, clas] = self.now
+        np.add.at(self.w[:, clas], rows, amounts)
+
+    def _score_rows(self, rows, signs, values=None):
+        ws = self.w[rows]
+        if signs is not None:
+            ws = ws * signs[:, None]
+        if values is not None:
+            ws = ws * values[:, None]
+        return ws.sum(axis=0) if len(rows) else np.zeros(self.nclasses)
+
+    def getW(self, clas):
+        if self.hash_bits:
+            nz = np.nonzero(self.w[:, clas])[0]
+            return dict(zip(nz.tolist(), self.w[nz, clas].tolist()))
+        return dict((f, self.w[r, clas]) for f, r in self.W.items())
+
+    def tick(self):
+        self.now = self.now + 1
+        if self.max_rows and len(self.W) > self.max_rows:
+            self._evict(len(self.W) - self.max_rows + self.max_rows // 10)
+
+    def scalar_multiply(self, scalar):
+        """
+        note: DOES NOT support averaging
+        """
+        self.w[:self.nrows] *= scalar
+
+    def add(self, features, clas, amount):
+        rows, signs = self._rows(features, _ADMIT_ROW)
+        self._add_rows(rows, clas, amount if signs is None else amount * signs)
+
+    def add_r(self, features, clas, amount):
+        """
+        like "add", but with real values features:
+           each feature is a pair (f,v), where v is the value, or a plain
+           feature, whose value is 1.
+        """
+        features, values = _split_real(features)
+        rows, signs = self._rows(features, _ADMIT_ROW)
+        amounts = amount * values
+        self._add_rows(rows, clas, amounts if signs is None else amounts * signs)
+
+    def set(self, features, clas, amount):
+        """
+        like "add", but replaces instead of adding
+        """
+        self.add(features, clas, amount)
+
+    def add_params(self, other, factor, domain=None):
+        """
+        like "add", but with data from another MultitronParameters object.
+        they must both share the number of classes
+        add each value * factor
+        with a domain, the features of other are added as the features of
+        that domain (see MulticlassModel.domain), for a namespaced union.
+        """
+        assert(self.nclasses == other.nclasses), "incompatible number of classes in add_params"
+        assert(self.hash_bits == other.hash_bits and self.hash_signed == other.hash_signed), "incompatible hashing in add_params"
+        if self.hash_bits and domain is not None:
+            raise ValueError("hashed parameters have no domains")
+        if self.hash_bits:
+            rows = np.arange(self.nrows)
+        elif domain is not None:
+            prefix = _domain_prefix(domain)
+            rows, _ = self._rows([prefix + f for f in other.W.keys()], _CREATE_ROW)
+        else:
+            rows, _ = self._rows(list(other.W.keys()), _CREATE_ROW)
+        orows = np.array(list(other.W.values()) if not self.hash_bits else rows, dtype=np.intp)
+        ow = other.w[orows]
+        for clas in xrange(self.nclasses):
+            keep = ow[:, clas] != 0
+            self._add_rows(rows[keep], clas, ow[keep, clas] * factor)
+
+    def do_pa_update(self, feats, gold_cls, C=1.0, variant="pa1"):
+        """
+        does a prediction, and a passive-aggressive update with
+        aggressiveness C. variant is one of PA_VARIANTS: pa (no C),
+        pa1 (tau capped at C) or pa2 (tau shrunk by 1/2C).
+        return: the predicted class before the update.
+        """
+        if variant not in PA_VARIANTS:
+            raise ValueError("unknown PA variant %s, possible values: %s" % (variant, sorted(PA_VARIANTS)))
+        self.tick()
+        return self._fused_update(feats, gold_cls, PA_VARIANTS[variant], C)
+
+    def do_pa_update_pairs(self, feats, left, right, sep, gold_cls, C=1.0, variant="pa1"):
+        """
+        like do_pa_update(feats + conjunctions(left, right, sep))
+        """
+        return self.do_pa_update(feats + conjunctions(left, right, sep), gold_cls, C, variant)
+
+    def do_pa_update_r(self, feats, gold_cls, C=1.0, variant="pa1"):
+        """
+        like do_pa_update, with real values features (see add_r)
+        """
+        if variant not in PA_VARIANTS:
+            raise ValueError("unknown PA variant %s, possible values: %s" % (variant, sorted(PA_VARIANTS)))
+        self.tick()
+        feats, values = _split_real(feats)
+        return self._fused_update(feats, gold_cls, PA_VARIANTS[variant], C, values)
+
+    def pa_update(self, gu_feats, go_feats, gu_cls, go_cls, C=1.0):
+        go_scr = self.get_scores(go_feats)[go_cls]
+        gu_scr = self.get_scores(gu_feats)[gu_cls]
+        loss = gu_scr - go_scr + 1
+        norm = len(go_feats) + len(gu_feats)
+        tau = loss / norm
+        if tau > C:
+            tau = C
+        self.add(gu_feats, gu_cls, -tau)
+        self.add(go_feats, go_cls, +tau)
+
+    def get_scores(self, features):
+        rows, signs = self._rows(features, _FIND_ROW)
+        return dict(enumerate(self._score_rows(rows, signs).tolist()))
+
+    def get_scores_r(self, features):
+        """
+        like get_scores but with real values features (see add_r)
+        """
+        return dict(enumerate(self._scores_r(*_split_real(features)).tolist()))
+
+    def _scores_r(self, features, values):
+        if not self.hash_bits:
+            W = self.W
+            found = [k for k, f in enumerate(features) if f in W]
+            features = [features[k] for k in found]
+            values = values[found]
+        rows, signs = self._rows(features, _FIND_ROW)
+        return self._score_rows(rows, signs, values)
+
+    def update(self, correct_class, features):
+        """
+        does a prediction, and a parameter update.
+        return: the predicted class before the update.
+        """
+        self.tick()
+        return self._fused_update(features, correct_class, _UPDATE_PERCEPTRON, 1.0)
+
+    def update_pairs(self, correct_class, features, left, right, sep="_"):
+        """
+        like update(features + conjunctions(left, right, sep))
+        """
+        return self.update(correct_class, features + conjunctions(left, right, sep))
+
+    def predict_best_class_r(self, features):
+        scores = self.get_scores_r(features)
+        scores = [(s, c) for c, s in scores.items()]
+        return max(scores)[1]
+
+    def update_r(self, correct_class, features):
+        """
+        like update, with real values features (see add_r)
+        """
+        self.tick()
+        features, values = _split_real(features)
+        return self._fused_update(features, correct_class, _UPDATE_PERCEPTRON, 1.0, values)
+
+    def _fused_update(self, features, gold, variant, C, values=None):
+        """
+        scores the features once and, if the best class is not gold, moves
+        their weights from the best class to gold (see ml.pyx), times their
+        values if given.
+        return: the best class before the update.
+        """
+        if values is None:
+            rows, signs = self._rows(features, _FIND_ROW)
+            scores = self._score_rows(rows, signs)
+            norm = len(features) + len(features)
+        else:
+            scores = self._scores_r(features, values)
+            norm = 0.0
+            for v in values.tolist():
+                norm += v * v
+            norm += norm
+        best = int(np.argmax(scores))
+        if best == gold:
+            return best
+        if variant == _UPDATE_PERCEPTRON:
+            tau = 1.0
+        else:
+            loss = scores[best] - scores[gold] + 1
+            if variant == _UPDATE_PA_II:
+                tau = loss / (norm + 0.5 / C)
+            elif norm == 0:
+                return best
+            else:
+                tau = loss / norm
+                if variant == _UPDATE_PA_I and tau > C:
+                    tau = C
+        rows, signs = self._rows(features, _ADMIT_ROW)
+        amounts = np.full(len(rows), tau)
+        if values is not None:
+            amounts *= values
+        if signs is not None:
+            amounts *= signs
+        self._add_rows(rows, best, -amounts)
+        self._add_rows(rows, gold, amounts)
+        return best
+
+    def _weights(self, averaged):
+        n = self.nrows
+        if not averaged:
+            return self.w[:n]
+        return (self.acc[:n] + (self.now - self.lastUpd[:n]) * self.w[:n]) / self.now
+
+    def finalize(self):
+        # average
+        n = self.nrows
+        self.acc[:n] += (self.now - self.lastUpd[:n]) * self.w[:n]
+        self.w[:n] = self.acc[:n] / self.now
+
+    def _dump_text(self, out, ws, fmt):
+        lines = []
+        for f, r in self.W.items():
+            lines.append(fmt % ((f,) + tuple(ws[r].tolist())))
+            if len(lines) == 4096:
+                out.write("".join(lines))
+                lines = []
+        out.write("".join(lines))
+
+    def dump(self, out=sys.stdout):
+        if self.hash_bits:
+            write_hashed_model(out, self._weights(False), self.nclasses, self.hash_bits, self.hash_signed)
+            return
+        self._dump_text(out, self.w, "%s" + " %s" * self.nclasses + "\n")
+
+    def dump_binary(self, out, dtype="f8", prune=0.0, averaged=False):
+        """
+        writes the current weights (call finalize first), or their average
+        so far, as a binary model, dropping the features whose weights are
+        all below prune. hashed parameters are never pruned.
+        """
+        if self.hash_bits:
+            write_hashed_model(out, self._weights(averaged), self.nclasses, self.hash_bits, self.hash_signed, dtype)
+            return
+        features = [None] * self.nrows
+        for f, r in self.W.items():
+            features[r] = f
+        weights = self._weights(averaged)
+        if prune > 0 or self.free_rows:
+            features, weights = prune_model(features, weights, self.nclasses, prune)
+        write_binary_model(out, features, weights, self.nclasses, dtype)
+
+    def dump_fin(self, out=sys.stdout):
+        if self.hash_bits:
+            write_hashed_model(out, self._weights(True), self.nclasses, self.hash_bits, self.hash_signed)
+            return
+        # write the average
+        self._dump_text(out, self._weights(True), "%s" + " %s " * self.nclasses + "\n")
+
+
+def load_params(fname):
+    """
+    new MultitronParameters with the classes and the hashing of the model
+    in fname, warm started from it (see warm_start).
+    """
+    table = _open_table(fname)
+    hash_bits = 0
+    if table.hashed:
+        while (1 << hash_bits) < table.nrows:
+            hash_bits += 1
+    params = MultitronParameters(table.nclasses, hash_bits, table.hash_signed)
+    params._warm_start(table, fname)
+    return params
+#}}}
+
+
+class PerceptronParameters(object):
+
+    def __init__(self):
+        self.now = 0
+        self.W = {}
+        self.acc = np.zeros(1024)
+        self.w = np.zeros(1024)
+        self.lastUpd = np.zeros(1024, dtype=np.int64)
+
+    def tick(self):
+        self.now += 1
+
+    def score(self, features):
+        W = self.W
+        return float(self.w[[W[f] for f in features if f in W]].sum())
+
+    _score = score
+
+    def updateFeatures(self, features, amount):
+        W = self.W
+        rows = []
+        for f in features:
+            r = W.get(f)
+            if r is None:
+                r = W[f] = len(W)
+                if r == len(self.w):
+                    self.acc = np.concatenate([self.acc, np.zeros(r)])
+                    self.w = np.concatenate([self.w, np.zeros(r)])
+                    self.lastUpd = np.concatenate([self.lastUpd, np.zeros(r, dtype=np.int64)])
+            rows.append(r)
+        u = np.unique(rows)
+        self.acc[u] += (self.now - self.lastUpd[u]) * self.w[u]
+        self.lastUpd[u] = self.now
+        np.add.at(self.w, rows, amount)
+
+    def finalize(self):
+        # average
+        n = len(self.W)
+        self.acc[:n] += (self.now - self.lastUpd[:n]) * self.w[:n]
+        self.w[:n] = self.acc[:n] / self.now
+
+    def dump(self, out=sys.stdout):
+        for f, r in self.W.items():
+            out.write("%s %s\n" % (f, self.w[r].item()))
+
+    def dump_fin(self, out=sys.stdout):
+        for f, r in self.W.items():
+            out.write("%s %s \n" % (f, ((self.acc[r] + ((self.now - self.lastUpd[r]) * self.w[r])) / self.now).item()))
+
+
+class LinearModel(object):
+
+    def __init__(self):
+        self.W = {}
+        self.w = np.zeros(0, dtype=np.float32)
+
+    def _load(self, fh):
+        ws = []
+        for line in fh:
+            if not line.strip():
+                break
+            f, w = line.strip().split()
+            self.W[f] = len(ws)
+            ws.append(float(w))
+        self.w = np.array(ws, dtype=np.float32)
+        return self
+
+    @classmethod
+    def from_file(cls, fname):
+        sys.stderr.write("loading model %s" % fname)
+        o = cls()
+        o._load(open(fname))
+        sys.stderr.write(" done\n")
+        return o
+
+    @classmethod
+    def from_fh(cls, fh):
+        o = cls()
+        o._load(fh)
+        return o
+
+    def score(self, features):
+        W = self.W
+        return float(self.w[[W[f] for f in features if f in W]].sum(dtype=np.float64))
+
+    _score = score
+
+
+class MultipleVectorsMulticlassModel(object):
+
+    def get_scores(self, features):
+        """
+        just an "interface"
+
+        features: a list of feature vectors, one per class
+        """
+        raise NotImplementedError()
+
+
+class MultipleVectorsMulticlassParams(MultipleVectorsMulticlassModel):
+
+    def __init__(self, nclasses):
+        self.nclasses = nclasses
+        self.params = [PerceptronParameters() for x in xrange(nclasses)]
+
+    def add(self, features, clas, amount):
+        self.params[clas].updateFeatures(features[clas], amount)
+
+    def tick(self):
+        [p.tick() for p in self.params]
+
+    def get_scores(self, features):
+        return dict((i, p.score(features[i])) for i, p in enumerate(self.params))
+
+    def dump(self, out=sys.stdout):
+        out.write("%s\n" % self.nclasses)
+        for p in self.params:
+            p.dump(out)
+            out.write("\n")
+
+    def dump_fin(self, out=sys.stdout):
+        out.write("%s\n" % self.nclasses)
+        for p in self.params:
+            p.dump_fin(out)
+            out.write("\n")
+
+
+class MulticlassLinearModel(MultipleVectorsMulticlassModel):
+
+    def __init__(self):
+        self.linearmodels = []
+
+    def _addmodel(self, m):
+        self.linearmodels.append(m)
+
+    def nclasses(self):
+        return len(self.linearmodels)
+
+    @classmethod
+    def from_file(cls, fname):
+        o = cls()
+        fh = open(fname)
+        nclasses = int(next(fh))
+        for i in xrange(nclasses):
+            o._addmodel(LinearModel.from_fh(fh))
+        return o
+
+    def get_scores(self, features):
+        return dict((i, lm.score(features[i])) for i, lm in enumerate(self.linearmodels))
@@ -1,10 +1,11 @@
 from distutils.core import setup
 from distutils.extension import Extension
 from Cython.Distutils import build_ext
+import numpy
 
 setup(
     cmdclass={'build_ext': build_ext},
     ext_modules=[
-        Extension("ml", ["ml.pyx"]),
+        Extension("ml", ["ml.pyx"], include_dirs=[numpy.get_include()]),
     ]
 )
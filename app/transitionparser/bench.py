@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# Copyright 2010 Yoav Goldberg
+##
+# This is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+##
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+##
+# You should have received a copy of the GNU General Public License
+# along with this software.  If not, see <http://www.gnu.org/licenses/>.
+"""
+benchmarks for the ml module.
+
+the oracle transitions of the data are extracted once (timed on their own,
+in transitions per second), the other timings cover only the ml code:
+training updates, then predictions with the resulting model. --ml_backend compares the cython and numpy backends:
+   bench.py --train_data=../../data/UD_English-EWT/en-ud-dev.conllu --ml_backend=numpy
+
+the model is then shared by --parse_threads threads parsing --parse_data.
+last, --scaling_lengths times the oracle parse of longer and longer
+sentences (the sentences of the data, joined), per token, and the rollout
+trainers (MLTrainerActionDecider2/3) train on the first --rollout_sents
+sentences, with and without their memo, timed per epoch.
+"""
+from __future__ import print_function
+from __future__ import division
+
+import os
+import sys
+import gc
+import time
+import resource
+import tempfile
+import threading
+curdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(curdir, os.path.pardir))
+
+if sys.version_info[0] < 3:
+    reload(sys)
+    sys.setdefaultencoding("utf-8")
+
+from absl import app
+from absl import flags
+from absl import logging
+
+from ml import get_backend, BACKENDS
+from pio import io
+from transitionparser.oracles import *
+from transitionparser.parsers import *
+from transitionparser.deciders import MLActionDecider, MLTrainerActionDecider2, MLTrainerActionDecider3
+from features import extractors
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('train_data', os.path.join(curdir, os.path.pardir, os.path.pardir, "data", "UD_English-EWT", "en-ud-dev.conllu"), 'Benchmark data.')  # nopep8
+flags.DEFINE_string('feature_extarctor', 'eager.zhang', 'Feature Extarctor')  # nopep8
+flags.DEFINE_integer('epoch', 3, 'Train Epoch.')  # nopep8
+flags.DEFINE_integer('hash_bits', 0, 'Feature hashing: fold the features into 2**hash_bits rows, 0 to disable.', lower_bound=0, upper_bound=30)  # nopep8
+flags.DEFINE_boolean('hash_signed', False, 'Feature hashing: use signed hashing.')  # nopep8
+flags.DEFINE_enum('update', 'perceptron', ['perceptron', 'pa', 'pa1', 'pa2'], 'Training update: perceptron, or one of the passive-aggressive variants.')  # nopep8
+flags.DEFINE_float('pa_C', 1.0, 'Aggressiveness of the passive-aggressive updates.')  # nopep8
+flags.DEFINE_integer('batch_size', 64, 'Batch size of predict_batch.')  # nopep8
+flags.DEFINE_string('parse_data', os.path.join(curdir, os.path.pardir, os.path.pardir, "data", "UD_English-EWT", "en-ud-test.conllu"), 'Parse benchmark data.')  # nopep8
+flags.DEFINE_list('parse_threads', ['1', '2', '4'], 'Thread counts of the parse benchmark.')  # nopep8
+flags.DEFINE_list('scaling_lengths', ['25', '50', '100', '200', '400', '800'], 'Sentence lengths of the scaling benchmark, empty to skip it.')  # nopep8
+flags.DEFINE_integer('rollout_sents', 100, 'Sentences of the rollout trainers benchmark, 0 to skip it.', lower_bound=0)  # nopep8
+flags.DEFINE_enum('ml_backend', None, BACKENDS, 'ml backend, defaults to $ML_BACKEND or cython if it is built, else numpy.')  # nopep8
+
+
+class CollectingActionDecider:
+    '''
+    follows the oracle, collecting (action, features) pairs.
+    '''
+
+    def __init__(self, decider, featExt):
+        self.decider = decider
+        self.fs = featExt
+        self.events = []
+        self.elapsed = 0.0
+
+    def next_action(self, stack, deps, sent, i):
+        action = self.decider.next_action(stack, deps, sent, i)
+        start = time.time()
+        features = self.fs.extract(stack, deps, sent, i)
+        self.elapsed += time.time() - start
+        self.events.append((action, features))
+        return action
+
+    def next_actions(self, stack, deps, sent, i, conf=None):
+        return [self.next_action(stack, deps, sent, i)]
+
+
+def rss():
+    '''
+    resident memory in MB
+    '''
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 1e6
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def collect():
+    sents = io.transform_conll_sents(FLAGS.train_data)
+    collector = CollectingActionDecider(
+        ArcEagerParsingOracle(pop_when_can=True),
+        extractors.get(FLAGS.feature_extarctor))
+    p = ArcEagerParser(collector)
+    for sent in sents:
+        p.parse(sent)
+    logging.info("extract: %.0f transitions/s", len(collector.events) / collector.elapsed)
+    return collector.events
+
+
+def join_sents(sents, length):
+    '''
+    sentences of at least length tokens, each made of consecutive sentences
+    of sents: their tokens are renumbered, their roots stay on the root.
+    '''
+    joined, cur = [], []
+    for sent in sents:
+        offset = len(cur)
+        for tok in sent:
+            tok = dict(tok)
+            tok['id'] += offset
+            if tok['parent'] > 0:
+                tok['parent'] += offset
+            cur.append(tok)
+        if len(cur) >= length:
+            joined.append(cur)
+            cur = []
+    return joined
+
+
+def bench_scaling():
+    '''
+    oracle parse and extraction time per token, on ever longer sentences:
+    it stays flat when they are linear in the sentence length.
+    '''
+    sents = list(io.transform_conll_sents(FLAGS.train_data))
+    for length in map(int, FLAGS.scaling_lengths):
+        # about the same number of tokens at each length
+        joined = join_sents(sents, length)[:max(1, 20000 // length)]
+        ntoks = sum(len(sent) for sent in joined)
+        collector = CollectingActionDecider(
+            ArcEagerParsingOracle(pop_when_can=True),
+            extractors.get(FLAGS.feature_extarctor))
+        p = ArcEagerParser(collector)
+        start = time.time()
+        for sent in joined:
+            p.parse(sent)
+        elapsed = time.time() - start
+        logging.info("scaling: length %s, %.1f us/token (extract %.1f us/token)",
+                     length, 1e6 * elapsed / ntoks, 1e6 * collector.elapsed / ntoks)
+
+
+def bench_rollouts():
+    '''
+    epochs of the rollout trainers, without and with their memo (see
+    deciders.RolloutMemo), which must train the same weights.
+    '''
+    sents = list(io.transform_conll_sents(FLAGS.train_data))[:FLAGS.rollout_sents]
+    for trainer_class in (MLTrainerActionDecider2, MLTrainerActionDecider3):
+        weights = []
+        for memo in (False, True):
+            params = ml.MultitronParameters(4, FLAGS.hash_bits, FLAGS.hash_signed)
+            trainer = trainer_class(params, ArcEagerParsingOracle(pop_when_can=True),
+                                    extractors.get(FLAGS.feature_extarctor), memo=memo)
+            p = ArcEagerParser(trainer)
+            for x in xrange(FLAGS.epoch):
+                trainer.memo.hits = trainer.memo.misses = 0
+                start = time.time()
+                for sent in sents:
+                    p.parse(sent)
+                logging.info("rollouts: %s, memo %s, epoch %s: %.2fs (features: %s memo hits, %s misses)",
+                             trainer_class.__name__, memo, x + 1, time.time() - start,
+                             trainer.memo.hits, trainer.memo.misses)
+            with tempfile.TemporaryFile() as out:
+                params.dump(out)
+                out.seek(0)
+                weights.append(out.read())
+        logging.info("rollouts: %s, same weights with and without memo: %s",
+                     trainer_class.__name__, weights[0] == weights[1])
+
+
+def bench_train(events):
+    gc.collect()
+    rss0 = rss()
+    params = ml.MultitronParameters(4, FLAGS.hash_bits, FLAGS.hash_signed)
+    start = time.time()
+    for x in xrange(FLAGS.epoch):
+        if FLAGS.update == 'perceptron':
+            for action, features in events:
+                params.update(action, features)
+        else:
+            for action, features in events:
+                params.do_pa_update(features, action, FLAGS.pa_C, FLAGS.update)
+    elapsed = time.time() - start
+    logging.info("update: %s updates in %.2fs, %.0f updates/s",
+                 FLAGS.epoch * len(events), elapsed, FLAGS.epoch * len(events) / elapsed)
+    logging.info("rss: %.1f MB (+%.1f MB)", rss(), rss() - rss0)
+
+    start = time.time()
+    with open(os.devnull, "w") as out:
+        params.dump_fin(out)
+    logging.info("dump_fin: %.2fs", time.time() - start)
+    start = time.time()
+    params.finalize()
+    logging.info("finalize: %.2fs", time.time() - start)
+    return params
+
+
+def bench_predict(events, model):
+    m = ml.MulticlassModel(model)
+    batch = [features for action, features in events]
+    start = time.time()
+    for features in batch:
+        m.predict(features)
+    elapsed = time.time() - start
+    logging.info("predict: %.0f predictions/s", len(batch) / elapsed)
+    start = time.time()
+    for i in xrange(0, len(batch), FLAGS.batch_size):
+        m.predict_batch(batch[i:i + FLAGS.batch_size])
+    elapsed = time.time() - start
+    logging.info("predict_batch: %.0f predictions/s", len(batch) / elapsed)
+
+
+def bench_parse(model):
+    '''
+    parse throughput of threads sharing one model, each parsing a shard
+    '''
+    m = ml.MulticlassModel(model)
+    sents = list(io.transform_conll_sents(FLAGS.parse_data))
+    for nthreads in map(int, FLAGS.parse_threads):
+        parsers = [ArcEagerParser(MLActionDecider(m, extractors.get(FLAGS.feature_extarctor)))
+                   for t in xrange(nthreads)]
+        threads = [threading.Thread(target=lambda p, shard: [p.parse(sent) for sent in shard],
+                                    args=(parsers[t], sents[t::nthreads]))
+                   for t in xrange(nthreads)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        logging.info("parse: %s threads, %.0f sents/s", nthreads, len(sents) / elapsed)
+
+
+def main(argv):
+    global ml
+    ml = get_backend(FLAGS.ml_backend)
+    logging.info("ml backend: %s", ml.__name__)
+    logging.info("collect oracle transitions [%s] ...", FLAGS.train_data)
+    events = collect()
+    logging.info("transitions: %s", len(events))
+    params = bench_train(events)
+    model = tempfile.NamedTemporaryFile(suffix=".model")
+    params.dump_binary(model)
+    model.flush()
+    bench_predict(events, model.name)
+    bench_parse(model.name)
+    bench_scaling()
+    if FLAGS.rollout_sents:
+        bench_rollouts()
+
+
+if __name__ == '__main__':
+    app.run(main)
@@ -23,6 +23,7 @@ from __future__ import division
 
 import os
 import sys
+import copy
 curdir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(curdir, os.path.pardir))
 
@@ -70,7 +71,7 @@ class Configuration:  # {{{
 
     def is_in_finish_state(self):
         logging.debug("is_in_finish_state i: %s, sent len: %s", self.i, len(self.sent))
-        return len(self.stack) == 1 and not self.sent[self.i:]
+        return len(self.stack) == 1 and self.i >= len(self.sent)
 
     def do_action(self, action):
         logging.debug("do action: %s| i: %s | stack: %s", action, self.i, self.stack)
@@ -94,7 +95,7 @@ class ArcStandardConfiguration(Configuration):  # {{{
     def do_shift(self):
         logging.debug("ArcStandardConfiguration do_shift")
         
-        if not (self.sent[self.i:]):
+        if self.i >= len(self.sent):
             logging.debug("ArcStandardConfiguration raising error ")
             raise IllegalActionException()
         self.actions.append(SHIFT)
@@ -134,13 +135,25 @@ class ArcStandardConfiguration(Configuration):  # {{{
 
     def valid_actions(self):
         res = []
-        if self.sent[self.i:]:
+        if self.i < len(self.sent):
             res.append(SHIFT)
         if len(self.stack) >= 2:
             res.append(REDUCE_L)
             res.append(REDUCE_R)
         return res
 
+    def valid_mask(self):
+        """
+        the actions do_action accepts, as a bitmask: bit a is set if action
+        a is legal.
+        """
+        mask = 0
+        if self.i < len(self.sent):
+            mask |= 1 << SHIFT
+        if len(self.stack) >= 2:
+            mask |= (1 << REDUCE_L) | (1 << REDUCE_R)
+        return mask
+
 
 class ArcEagerConfiguration(Configuration):  # {{{
     """
@@ -157,7 +170,7 @@ class ArcEagerConfiguration(Configuration):  # {{{
     """
 
     def is_in_finish_state(self):
-        return not self.sent[self.i:]
+        return self.i >= len(self.sent)
 
     def actions_map(self):
         return {
@@ -168,7 +181,7 @@ class ArcEagerConfiguration(Configuration):  # {{{
 
     def do_shift(self):
         logging.debug("do_shift")
-        if not (self.sent[self.i:]):
+        if self.i >= len(self.sent):
             raise IllegalActionException()
         self.actions.append(SHIFT)
         self._features = []
@@ -235,7 +248,7 @@ class ArcEagerConfiguration(Configuration):  # {{{
     def valid_actions(self):
         res = [SHIFT, REDUCE_R, REDUCE_L, POP]
 
-        if not (self.sent[self.i:]):
+        if self.i >= len(self.sent):
             res.remove(SHIFT)
 
         if len(self.stack) == 0:
@@ -255,4 +268,23 @@ class ArcEagerConfiguration(Configuration):  # {{{
             if self.deps.has_parent(self.sent[self.i]):
                 res.remove(REDUCE_R)
 
-        return res
\ No newline at end of file
+        return res
+
+    def valid_mask(self):
+        """
+        the actions do_action accepts, as a bitmask: bit a is set if action
+        a is legal.
+        unlike valid_actions, POP is legal for a parentless ROOT, as in do_pop.
+        """
+        mask = 0
+        if self.i < len(self.sent):
+            mask |= 1 << SHIFT
+            if self.stack:
+                if not self.deps.has_parent(self.stack[-1]):
+                    mask |= 1 << REDUCE_L
+                if not self.deps.has_parent(self.sent[self.i]):
+                    mask |= 1 << REDUCE_R
+        if self.stack:
+            if self.deps.has_parent(self.stack[-1]) or self.stack[-1]['parent'] == -1:
+                mask |= 1 << POP
+        return mask
@@ -35,7 +35,9 @@ from absl import logging
 from collections import defaultdict
 import copy
 import random
-from ml import ml
+import threading
+import multiprocessing
+import cPickle as pickle
 
 from common import *
 from common.exceptions import *
@@ -49,6 +51,145 @@ def _ids(tok):
     return (tok['id'], tok['tag'])
 
 
+def save_params(params, fout, dtype=None, prune=0.0):
+    '''
+    averages the trained parameters and writes them to fout: as a text
+    model, or as a binary one of the given dtype (see ml.DTYPES), without
+    the features whose weights are all below prune.
+    '''
+    params.finalize()
+    if dtype:
+        params.dump_binary(fout, dtype, prune)
+    else:
+        params.dump(fout)
+
+
+def save_snapshot(params, fname, dtype=None, prune=0.0):
+    '''
+    writes the average of the parameters so far to fname as a binary
+    model, without finalizing them, so training can go on.
+    '''
+    with open(fname, "wb") as fout:
+        params.dump_binary(fout, dtype or "f8", prune, True)
+
+
+def parse_in_threads(parsers, sents):
+    '''
+    parses sents with one thread per parser, each on an interleaved shard.
+    used for "hogwild" training, with trainers sharing their parameters.
+    the first exception of the threads is raised again here.
+    '''
+    errors = []
+
+    def work(p, shard):
+        try:
+            for sent in shard:
+                p.parse(sent)
+        except Exception:
+            errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=work, args=(p, sents[t::len(parsers)]))
+               for t, p in enumerate(parsers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+def mixing_weights(errors, mixing="uniform"):
+    '''
+    the weights of the shard parameters in mix_params: uniform, or
+    proportional to the errors made on each shard ("error").
+    '''
+    total = sum(errors)
+    if mixing == "error" and total > 0:
+        return [e / total for e in errors]
+    return [1.0 / len(errors)] * len(errors)
+
+
+def mix_params(params, shard_params, weights):
+    '''
+    one step of iterative parameter mixing (McDonald et al., 2010): the
+    weights of params become sum(weights[k] * shard_params[k] weights),
+    then params ticks. the average that params keeps is thus the average
+    of the mixed weights over the mixing steps.
+    '''
+    old = pickle.loads(pickle.dumps(params, 2))
+    params.add_params(old, -1.0)
+    for p, mu in zip(shard_params, weights):
+        params.add_params(p, mu)
+    params.tick()
+
+
+class Checkpointer:
+    '''
+    writes training checkpoints to fname without stalling the training:
+    save pickles the state right away (a consistent copy of it), then a
+    thread writes it to fname.tmp and renames it over fname, so fname is
+    always a complete checkpoint.
+    '''
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.thread = None
+        self.errors = []
+
+    def save(self, state):
+        data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(data,))
+        self.thread.start()
+
+    def _write(self, data):
+        try:
+            tmp = self.fname + ".tmp"
+            with open(tmp, "wb") as fout:
+                fout.write(data)
+                fout.flush()
+                os.fsync(fout.fileno())
+            os.rename(tmp, self.fname)
+        except Exception:
+            self.errors.append(sys.exc_info())
+
+    def wait(self):
+        '''
+        waits for the last checkpoint to be written, and raises again its
+        exception if it failed.
+        '''
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.errors:
+            error = self.errors.pop()
+            raise error[0], error[1], error[2]
+
+
+def load_checkpoint(fname):
+    '''
+    the state saved by Checkpointer.save
+    '''
+    with open(fname, "rb") as fin:
+        return pickle.load(fin)
+
+
+def is_real_valued(featExt):
+    '''
+    True if featExt gives real valued features, (f, v) pairs, for the _r
+    methods of the models and parameters.
+    '''
+    return getattr(featExt, "real_valued", False)
+
+
+def has_pairs(featExt):
+    '''
+    True if featExt gives the parts of its conjunctions with extract_pairs,
+    (features, left, right, sep), for the models to conjoin: hashed models
+    do so without making the conjunction strings (see ml.conjunctions).
+    '''
+    return hasattr(featExt, "extract_pairs")
+
 
 class MLActionDecider:
     '''
@@ -58,19 +199,24 @@ class MLActionDecider:
     def __init__(self, model, featExt):
         self.m = model
         self.fs = featExt
+        self.real = is_real_valued(featExt)
+        self.pairs = has_pairs(featExt) and not self.real
+
+    def _predict(self, fs):
+        return self.m.predict_r(fs) if self.real else self.m.predict(fs)
 
     def next_action(self, stack, deps, sent, i):
         if len(stack) < 2:
             return SHIFT
         fs = self.fs.extract(stack, deps, sent, i)
-        action, scores = self.m.predict(fs)
+        action, scores = self._predict(fs)
         if i >= len(sent) and action == SHIFT:
             action = scores.index(max(scores[1:]))
         return action
 
     def next_actions(self, stack, deps, sent, i, conf=None):
         fs = self.fs.extract(stack, deps, sent, i)
-        action, scores = self.m.predict(fs)
+        action, scores = self._predict(fs)
         # [-122, 0.3, 3] -> {0:-122, 1:0.3, 2:3}
         scores = dict(enumerate(scores))
         actions = [
@@ -81,12 +227,37 @@ class MLActionDecider:
                 x[1])]
         return actions
 
+    def _features(self, conf):
+        '''
+        the features of conf, extracted once and kept as the ids the model
+        knows them by (see MulticlassModel.ids): (ids, values), values is
+        None unless the features are real valued (see MulticlassModel.ids_r).
+        every action resets conf._features.
+        '''
+        fs = getattr(conf, "_features", None)
+        if not fs and self.pairs:
+            fs = self.fs.extract_pairs(conf.stack, conf.deps, conf.sent, conf.i)
+            fs = conf._features = (self.m.pair_ids(*fs), None)
+        elif not fs:
+            fs = self.fs.extract(conf.stack, conf.deps, conf.sent, conf.i)
+            fs = conf._features = self.m.ids_r(fs) if self.real else (self.m.ids(fs), None)
+        return fs
+
+    def best_action(self, conf):
+        '''
+        the best scoring action that is legal in conf, the first action of
+        next_actions that conf accepts.
+        '''
+        ids, values = self._features(conf)
+        action, margin = self.m.predict_masked_ids(ids, conf.valid_mask(), values)
+        return action
+
     def scores(self, conf):  # TODO: who uses this??
         if len(conf.stack) < 2:
             return {SHIFT: 1}
 
-        fs = self.fs.extract(conf.stack, conf.deps, conf.sent, conf.i)
-        action, scores = self.m.predict(fs)
+        ids, values = self._features(conf)
+        action, scores = self.m.predict_ids(ids, values)
         # [-122, 0.3, 3] -> {0:-122, 1:0.3, 2:3}
         scores = dict(enumerate(scores))
         if conf.i >= len(conf.sent):
@@ -96,15 +267,15 @@ class MLActionDecider:
     def get_scores(self, conf):
         if len(conf.stack) < 2:
             return {SHIFT: 1}
-        fs = self.fs.extract(conf.stack, conf.deps, conf.sent, conf.i)
-        scores = self.m.get_scores(fs)
+        ids, values = self._features(conf)
+        scores = self.m.get_scores_ids(ids, values)
         return scores
 
     def get_prob_scores(self, conf):
         if len(conf.stack) < 2:
             return [1.0, 0, 0]
-        fs = self.fs.extract(conf.stack, conf.deps, conf.sent, conf.i)
-        besti, scores = self.m.predict(fs)
+        ids, values = self._features(conf)
+        besti, scores = self.m.predict_ids(ids, values)
         return scores
 
     def update(self, stack, deps, sent, i):
@@ -177,24 +348,88 @@ class AuditMLActionDecider:  # {{{
         return action, scores
 
 class LoggingActionDecider:  # {{{
-    def __init__(self, decider, featExt, out=sys.stdout):
+    '''
+    writes the oracle action and the features of each configuration to
+    out. with a vocabulary (ml.FeatureVocabulary), the features are
+    written as their ids, and the vocabulary to vocab_out on save.
+    '''
+
+    def __init__(self, decider, featExt, out=sys.stdout, vocab=None, vocab_out=None):
         self.decider = decider
         self.fs = featExt
         self.out = out
+        self.vocab = vocab
+        self.vocab_out = vocab_out
 
-    def next_action(self, stack, deps, sent, i):
+    def next_action(self, stack, deps, sent, i, conf=None):
         features = self.fs.extract(stack, deps, sent, i)
         logging.debug("features [%s]", features) 
         action = self.decider.next_action(stack, deps, sent, i)
-        self.out.write("%s %s\n" % (action, " ".join(features)))
+        self.out.write("%s %s\n" % (action, " ".join(self._format(features))))
         return action
 
-    def next_actions(self, stack, deps, sent, i):
+    def _format(self, features):
+        '''
+        the features as written: f, or f:v for the real valued ones, with
+        f as its id if there is a vocabulary.
+        '''
+        names = [f[0] if type(f) is tuple else f for f in features]
+        if self.vocab is not None:
+            names = [str(i) for i in self.vocab.ids(names)]
+        return [n if type(f) is not tuple else "%s:%s" % (n, f[1]) for n, f in zip(names, features)]
+
+    def next_actions(self, stack, deps, sent, i, conf=None):
         action = self.next_action(stack, deps, sent, i)
         return [action]
 
     def save(self, param=None):
         self.out.close()
+        if self.vocab is not None:
+            self.vocab.dump(self.vocab_out)
+            self.vocab_out.close()
+
+
+class CountingActionDecider:  # {{{
+    '''
+    follows decider (the static oracle), counting how often each feature
+    fires in counts (the real valued features by their name).
+    '''
+
+    def __init__(self, decider, featExt):
+        self.decider = decider
+        self.fs = featExt
+        self.counts = defaultdict(int)
+
+    def next_action(self, stack, deps, sent, i, conf=None):
+        counts = self.counts
+        for f in self.fs.extract(stack, deps, sent, i):
+            counts[f[0] if type(f) is tuple else f] += 1
+        return self.decider.next_action(stack, deps, sent, i)
+
+    def next_actions(self, stack, deps, sent, i, conf=None):
+        return [self.next_action(stack, deps, sent, i)]
+    #}}}
+
+
+def count_features(count_shard, sents, workers=1):
+    '''
+    the feature counts (feature -> count) of the oracle transitions of
+    sents: count_shard(shard) counts those of a shard (see
+    CountingActionDecider), each in one of a pool of workers processes.
+    '''
+    if workers <= 1:
+        return count_shard(sents)
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(count_shard, [sents[k::workers] for k in xrange(workers)])
+    finally:
+        pool.close()
+        pool.join()
+    counts = results[0]
+    for shard_counts in results[1:]:
+        for f, n in shard_counts.iteritems():
+            counts[f] += n
+    return counts
 
 
 class MLTrainerActionDecider:  # {{{
@@ -203,58 +438,179 @@ class MLTrainerActionDecider:  # {{{
         self.ml = mlAlgo
         self.fs = featExt
         self.earlyUpdate = earlyUpdate
+        self.errors = 0
+        self.real = is_real_valued(featExt)
+        self.pairs = has_pairs(featExt) and not self.real
 
     def next_actions(self, stack, deps, sent, i, conf=None):
         return [self.next_action(stack, deps, sent, i, conf)]
 
     def next_action(self, stack, deps, sent, i, conf=None):
         action = self.decider.next_action(stack, deps, sent, i)
-        mlaction = self.ml.update(
-            action, self.fs.extract(
-                stack, deps, sent, i))
+        if self.pairs:
+            mlaction = self.ml.update_pairs(
+                action, *self.fs.extract_pairs(stack, deps, sent, i))
+        else:
+            update = self.ml.update_r if self.real else self.ml.update
+            mlaction = update(
+                action, self.fs.extract(
+                    stack, deps, sent, i))
         if action != mlaction:
+            self.errors += 1
             if self.earlyUpdate:
                 raise MLTrainerWrongActionException()
         return action
 
-    def save(self, fout):
-        self.ml.finalize()
-        self.ml.dump(fout)
+    def save(self, fout, dtype=None, prune=0.0):
+        save_params(self.ml, fout, dtype, prune)
 
 class MLPassiveAggressiveTrainerActionDecider:  # {{{
-    def __init__(self, mlAlgo, decider, featExt, earlyUpdate=False):
+    """
+    Like MLTrainerActionDecider but with passive-aggressive updates:
+    C is the aggressiveness, variant one of ml.PA_VARIANTS (pa, pa1, pa2)
+    """
+
+    def __init__(self, mlAlgo, decider, featExt, earlyUpdate=False, C=1.0, variant="pa1"):
         self.decider = decider
         self.ml = mlAlgo
         self.fs = featExt
         self.earlyUpdate = earlyUpdate
+        self.C = C
+        self.variant = variant
+        self.errors = 0
+        self.real = is_real_valued(featExt)
+        self.pairs = has_pairs(featExt) and not self.real
 
-    def next_actions(self, stack, deps, sent, i):
+    def next_actions(self, stack, deps, sent, i, conf=None):
         return [self.next_action(stack, deps, sent, i)]
 
     def next_action(self, stack, deps, sent, i):
         action = self.decider.next_action(stack, deps, sent, i)
-        mlaction = self.ml.do_pa_update(
-            self.fs.extract(
-                stack, deps, sent, i), action, C=1.0)
+        if self.pairs:
+            fs, left, right, sep = self.fs.extract_pairs(stack, deps, sent, i)
+            mlaction = self.ml.do_pa_update_pairs(
+                fs, left, right, sep, action, self.C, self.variant)
+        else:
+            update = self.ml.do_pa_update_r if self.real else self.ml.do_pa_update
+            mlaction = update(
+                self.fs.extract(
+                    stack, deps, sent, i), action, self.C, self.variant)
         if action != mlaction:
+            self.errors += 1
             if self.earlyUpdate:
                 raise MLTrainerWrongActionException()
         return action
 
-    def save(self, fout):
-        self.ml.finalize()
-        self.ml.dump(fout)
+    def save(self, fout, dtype=None, prune=0.0):
+        save_params(self.ml, fout, dtype, prune)
+
+class RolloutMemo:  # {{{
+    """
+    what the rollouts of MLTrainerActionDecider2/3 learn about the
+    configurations of a sentence, by configuration (see key): its features,
+    and, with the current weights, its scores and the cost of the rollout
+    from it. the features hold for the whole sentence, the scores and the
+    costs for one version of the weights (see changed and restore).
+    enabled=False computes everything again, for comparison.
+    """
+
+    def __init__(self, ml, featExt, enabled=True):
+        self.ml = ml
+        self.fs = featExt
+        self.enabled = enabled
+        self.sent = None
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, conf):
+        """
+        the state of conf, all its features and its rollout depend on: the
+        ids on its stack, its buffer position and its arcs. a new sentence
+        starts a new memo.
+        """
+        if conf.sent is not self.sent:
+            self.sent = conf.sent
+            self.features = {}
+            self.version = self.versions = 0
+            self.tables = {0: ({}, {})}
+            self.scores, self.costs = self.tables[0]
+        return (tuple([tok['id'] for tok in conf.stack]), conf.i, frozenset(conf.deps.deps))
+
+    def extract(self, conf, key=None):
+        if not self.enabled:
+            return self.fs.extract(conf.stack, conf.deps, conf.sent, conf.i)
+        if key is None:
+            key = self.key(conf)
+        fs = self.features.get(key)
+        if fs is None:
+            self.misses += 1
+            fs = self.features[key] = self.fs.extract(conf.stack, conf.deps, conf.sent, conf.i)
+        else:
+            self.hits += 1
+        return fs
+
+    def get_scores(self, conf, key=None):
+        if not self.enabled:
+            return self.ml.get_scores(self.extract(conf))
+        if key is None:
+            key = self.key(conf)
+        scores = self.scores.get(key)
+        if scores is None:
+            scores = self.scores[key] = self.ml.get_scores(self.extract(conf, key))
+        return scores
+
+    def cost(self, key):
+        """
+        the cost of the rollout from the configuration of key, None if unknown
+        """
+        return self.costs.get(key) if self.enabled else None
+
+    def set_cost(self, keys, cost):
+        """
+        the rollout through the configurations of keys ended with cost
+        """
+        if self.enabled:
+            for key in keys:
+                self.costs[key] = cost
+
+    def changed(self):
+        """
+        the weights were updated: the scores and the costs start again.
+        return: the version of the weights before, see restore.
+        """
+        if not self.enabled or self.sent is None:
+            return None
+        old = self.version
+        self.versions += 1
+        self.version = self.versions
+        self.tables = {old: self.tables[old], self.version: ({}, {})}
+        self.scores, self.costs = self.tables[self.version]
+        return old
+
+    def restore(self, version):
+        """
+        the update that changed returned version for was taken back. the
+        updates add and take back 1.0 to weights that are sums of such
+        updates, so the weights, and their scores, are exactly those of
+        version again.
+        """
+        if version is not None:
+            self.version = version
+            self.scores, self.costs = self.tables[version]
+    #}}}
+
 
 class MLTrainerActionDecider2:  # {{{
     """
     Like MLTrainerActionDecider but does the update itself (a little less efficient, a bit more informative)
     """
 
-    def __init__(self, mlAlgo, decider, featExt, earlyUpdate=False):
+    def __init__(self, mlAlgo, decider, featExt, earlyUpdate=False, memo=True):
         self.decider = decider
         self.ml = mlAlgo
         self.fs = featExt
         self.earlyUpdate = earlyUpdate
+        self.memo = RolloutMemo(mlAlgo, featExt, memo)
 
     def next_actions(self, stack, deps, sent, i, conf=None):
         return [self.next_action(stack, deps, sent, i, conf)]
@@ -277,11 +633,19 @@ class MLTrainerActionDecider2:  # {{{
 
     def cum_score_of_action(self, action, conf, ml=False):
         newconf = conf.newAfter(action)
-        decider = copy.deepcopy(self.decider)
+        decider = None if ml else copy.deepcopy(self.decider)
+        # the configurations of an ml rollout, which all end with its cost
+        keys = []
+        cost = None
         while not newconf.is_in_finish_state():
             try:
                 if ml:
-                    next = self.next_ml_action(newconf)
+                    key = self.memo.key(newconf)
+                    cost = self.memo.cost(key)
+                    if cost is not None:
+                        break
+                    keys.append(key)
+                    next = self.next_ml_action(newconf, key)
                 else:
                     next = decider.next_action(
                         newconf.stack, newconf.deps, newconf.sent, newconf.i)
@@ -289,20 +653,24 @@ class MLTrainerActionDecider2:  # {{{
             except IllegalActionException:
                 assert(len(newconf.sent) == newconf.i)
                 break
-        return self.score_deps(newconf.deps, newconf.sent)
-
-    def next_ml_action(self, conf):
-        features = self.fs.extract(conf.stack, conf.deps, conf.sent, conf.i)
-        act_scores = [(score, act) for act, score in self.ml.get_scores(
-            features).items() if act in conf.valid_actions()]
+        if cost is None:
+            cost = self.score_deps(newconf.deps, newconf.sent)
+        self.memo.set_cost(keys, cost)
+        return cost
+
+    def next_ml_action(self, conf, key=None):
+        valid = conf.valid_actions()
+        act_scores = [(score, act) for act, score in self.memo.get_scores(
+            conf, key).items() if act in valid]
         return max(act_scores)[1]
 
     def next_action(self, stack, deps, sent, i, conf=None):
-        features = self.fs.extract(stack, deps, sent, i)
+        features = self.memo.extract(conf)
         goldaction = self.decider.next_action(stack, deps, sent, i)
 
-        act_scores = [(score, act) for act, score in self.ml.get_scores(
-            features).items() if act in conf.valid_actions()]
+        valid = conf.valid_actions()
+        act_scores = [(score, act) for act, score in self.memo.get_scores(
+            conf).items() if act in valid]
         pred_s, pred_a = max(act_scores)
         self.ml.tick()
         if pred_a != goldaction:
@@ -312,6 +680,7 @@ class MLTrainerActionDecider2:  # {{{
             # now try to update:
             self.ml.add(features, goldaction, 1.0)
             self.ml.add(features, pred_a, -1.0)
+            version = self.memo.changed()
 
             update_cost = self.cum_score_of_action(
                 self.next_ml_action(conf), conf, ml=True)
@@ -320,22 +689,23 @@ class MLTrainerActionDecider2:  # {{{
                 # undo prev update
                 self.ml.add(features, goldaction, -1.0)
                 self.ml.add(features, pred_a, 1.0)
+                self.memo.restore(version)
         return goldaction
 
-    def save(self, fout):
-        self.ml.finalize()
-        self.ml.dump(fout)
+    def save(self, fout, dtype=None, prune=0.0):
+        save_params(self.ml, fout, dtype, prune)
 
 class MLTrainerActionDecider3:  # {{{
     """
     Like MLTrainerActionDecider but does the update itself (a little less efficient, a bit more informative)
     """
 
-    def __init__(self, mlAlgo, decider, featExt, earlyUpdate=False):
+    def __init__(self, mlAlgo, decider, featExt, earlyUpdate=False, memo=True):
         self.decider = decider
         self.ml = mlAlgo
         self.fs = featExt
         self.earlyUpdate = earlyUpdate
+        self.memo = RolloutMemo(mlAlgo, featExt, memo)
 
     def next_actions(self, stack, deps, sent, i, conf=None):
         return [self.next_action(stack, deps, sent, i, conf)]
@@ -358,11 +728,19 @@ class MLTrainerActionDecider3:  # {{{
 
     def cum_score_of_action(self, action, conf, ml=False):
         newconf = conf.newAfter(action)
-        decider = copy.deepcopy(self.decider)
+        decider = None if ml else copy.deepcopy(self.decider)
+        # the configurations of an ml rollout, which all end with its cost
+        keys = []
+        cost = None
         while not newconf.is_in_finish_state():
             try:
                 if ml:
-                    next = self.next_ml_action(newconf)
+                    key = self.memo.key(newconf)
+                    cost = self.memo.cost(key)
+                    if cost is not None:
+                        break
+                    keys.append(key)
+                    next = self.next_ml_action(newconf, key)
                 else:
                     next = decider.next_action(
                         newconf.stack, newconf.deps, newconf.sent, newconf.i)
@@ -371,20 +749,24 @@ class MLTrainerActionDecider3:  # {{{
                 logging.debug("oracle says [%s], but it is illegal, probably at end", next) 
                 assert(len(newconf.sent) == newconf.i)
                 break
-        return self.score_deps(newconf.deps, newconf.sent)
-
-    def next_ml_action(self, conf):
-        features = self.fs.extract(conf.stack, conf.deps, conf.sent, conf.i)
-        act_scores = [(score, act) for act, score in self.ml.get_scores(
-            features).items() if act in conf.valid_actions()]
+        if cost is None:
+            cost = self.score_deps(newconf.deps, newconf.sent)
+        self.memo.set_cost(keys, cost)
+        return cost
+
+    def next_ml_action(self, conf, key=None):
+        valid = conf.valid_actions()
+        act_scores = [(score, act) for act, score in self.memo.get_scores(
+            conf, key).items() if act in valid]
         return max(act_scores)[1]
 
     def next_action(self, stack, deps, sent, i, conf=None):
-        features = self.fs.extract(stack, deps, sent, i)
+        features = self.memo.extract(conf)
         goldaction = self.decider.next_action(stack, deps, sent, i)
 
-        act_scores = [(score, act) for act, score in self.ml.get_scores(
-            features).items() if act in conf.valid_actions()]
+        valid = conf.valid_actions()
+        act_scores = [(score, act) for act, score in self.memo.get_scores(
+            conf).items() if act in valid]
 
         pred_s, pred_a = max(act_scores)
         noupdate_cost = self.cum_score_of_action(pred_a, conf, ml=True)
@@ -392,6 +774,7 @@ class MLTrainerActionDecider3:  # {{{
         if pred_a != SHIFT:
             self.ml.add(features, SHIFT, 1.0)
             self.ml.add(features, pred_a, -1.0)
+            version = self.memo.changed()
             shiftupdate_cost = self.cum_score_of_action(SHIFT, conf, ml=True)
             if shiftupdate_cost < noupdate_cost:
                 self.ml.tick()
@@ -399,6 +782,7 @@ class MLTrainerActionDecider3:  # {{{
             else:  # undo
                 self.ml.add(features, SHIFT, -1.0)
                 self.ml.add(features, pred_a, 1.0)
+                self.memo.restore(version)
                 self.ml.tick()
                 return pred_a
         self.ml.tick()
@@ -428,6 +812,5 @@ class MLTrainerActionDecider3:  # {{{
         self.ml.tick()
         return act
 
-    def save(self, fout):
-        self.ml.finalize()
-        self.ml.dump(fout)
+    def save(self, fout, dtype=None, prune=0.0):
+        save_params(self.ml, fout, dtype, prune)
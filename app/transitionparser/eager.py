@@ -23,6 +23,8 @@ from __future__ import division
 
 import os
 import sys
+import random
+import multiprocessing
 curdir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, os.path.join(curdir, os.path.pardir))
 
@@ -35,7 +37,7 @@ from absl import app
 from absl import flags
 from absl import logging
 
-from ml import ml
+from ml import get_backend, BACKENDS
 from pio import io
 from transitionparser.oracles import *
 from transitionparser.deciders import *
@@ -54,6 +56,7 @@ flags.DEFINE_boolean('lazypop', True, 'Lazy pop.')   # nopep8
 flags.DEFINE_boolean('unlex', False, 'unlex')   # nopep8
 flags.DEFINE_string('feature_extarctor', 'eager.zhang', 'Feature Extarctor')  # nopep8
 flags.DEFINE_string('model', os.path.join(curdir, os.path.pardir, os.path.pardir, "tmp", "eager.model"), 'Transition Parser Model.')  # nopep8
+flags.DEFINE_enum('ml_backend', None, BACKENDS, 'ml backend, defaults to $ML_BACKEND or cython if it is built, else numpy.')  # nopep8
 
 '''
 Train
@@ -62,6 +65,25 @@ flags.DEFINE_boolean('train', False, 'Train model with train data')  # nopep8
 flags.DEFINE_integer('epoch', 1, 'Train Epoch.')  # nopep8
 flags.DEFINE_string('train_data', os.path.join(curdir, os.path.pardir, os.path.pardir, "data", "conll.example"), 'Train Data')  # nopep8
 flags.DEFINE_string('externaltrainfile', None, 'External Train File.')  # nopep8
+flags.DEFINE_string('externalvocab', None, 'With --externaltrainfile: write the features as integer ids, and their vocabulary (one feature per line, in id order) to this file.')  # nopep8
+flags.DEFINE_integer('hash_bits', 0, 'Feature hashing: fold the features into 2**hash_bits rows, 0 to disable.', lower_bound=0, upper_bound=30)  # nopep8
+flags.DEFINE_boolean('hash_signed', False, 'Feature hashing: use signed hashing.')  # nopep8
+flags.DEFINE_enum('update', 'perceptron', ['perceptron', 'pa', 'pa1', 'pa2'], 'Training update: perceptron, or one of the passive-aggressive variants.')  # nopep8
+flags.DEFINE_float('pa_C', 1.0, 'Aggressiveness of the passive-aggressive updates.')  # nopep8
+flags.DEFINE_enum('model_dtype', None, ['f8', 'f4', 'f2', 'i8'], 'Save the model in the binary format with this weight type, instead of as text.')  # nopep8
+flags.DEFINE_float('prune', 0.0, 'With --model_dtype: drop the features whose weights are all below this (absolute) value.')  # nopep8
+flags.DEFINE_integer('threads', 1, 'Training threads, sharing the parameters without locks ("hogwild").', lower_bound=1)  # nopep8
+flags.DEFINE_integer('workers', 1, 'Train with iterative parameter mixing: each epoch, one perceptron per shard of the data in a pool of this many processes, then mix them.', lower_bound=1)  # nopep8
+flags.DEFINE_enum('mixing', 'uniform', ['uniform', 'error'], 'With --workers: average the shard parameters uniformly, or weighted by their number of errors.')  # nopep8
+flags.DEFINE_integer('admit_after', 0, 'Feature admission: a feature gets weights once it took part in this many updates (0: at once).', lower_bound=0, upper_bound=255)  # nopep8
+flags.DEFINE_integer('max_rows', 0, 'Feature admission: keep at most this many features, evicting the ones with the smallest averaged weights (0: no limit).', lower_bound=0)  # nopep8
+flags.DEFINE_float('l1', 0.0, 'L1 truncation: after each epoch, move the weights this much towards zero and drop the features left at zero.', lower_bound=0.0)  # nopep8
+flags.DEFINE_integer('checkpoint', 0, 'Save the whole training state (parameters, epoch, random state) every this many epochs, as <model>.ckpt, in the background (0: never).', lower_bound=0)  # nopep8
+flags.DEFINE_boolean('resume', False, 'Resume the training from <model>.ckpt (see --checkpoint), up to --epoch epochs.')  # nopep8
+flags.DEFINE_string('init_model', None, 'Warm start: start the training from the weights of this model (text or binary) instead of zeros.')  # nopep8
+flags.DEFINE_boolean('snapshot', False, 'Save the averaged model after each epoch, as <model>.epoch<n> (binary).')  # nopep8
+flags.DEFINE_string('whitelist', None, 'Keep only the features listed in this file, one per line, in training and testing (see --min_count).')  # nopep8
+flags.DEFINE_integer('min_count', 0, 'With --train and --whitelist: first count the features of the oracle transitions of --train_data, in --workers processes, and write the ones seen at least this many times to --whitelist.', lower_bound=0)  # nopep8
 # flags.DEFINE_string('modelfile', 'data/weights', 'Model File.')
 
 '''
@@ -78,7 +100,7 @@ def test():
     Test Model
     '''
     logging.info("test ...")
-    featExt = extractors.get(FLAGS.feature_extarctor)
+    featExt = feature_extractor()
     p = ArcEagerParser(
         MLActionDecider(
             ml.MulticlassModel(
@@ -142,6 +164,72 @@ def test():
         logging.info("assigned: %s", len(preds) / float(len(reals)))
 
 
+def feature_extractor():
+    '''
+    the --feature_extarctor, without the features missing from --whitelist
+    '''
+    featExt = extractors.get(FLAGS.feature_extarctor)
+    if FLAGS.whitelist:
+        featExt = extractors.WhitelistFeatureExtractor(
+            featExt, extractors.read_whitelist(FLAGS.whitelist))
+    return featExt
+
+
+def count_shard(sents):
+    '''
+    the feature counts of the oracle transitions of sents, in a --workers
+    process of the --min_count pre-pass.
+    '''
+    counter = CountingActionDecider(None, extractors.get(FLAGS.feature_extarctor))
+    p = ArcEagerParser(counter)
+    for sent in sents:
+        # a new oracle for each sentence: an oracle only resets on a sentence
+        # that differs from its last one, so the counts would depend on the shards
+        counter.decider = ArcEagerParsingOracle(pop_when_can=FLAGS.lazypop)
+        p.parse(sent)
+    return counter.counts
+
+
+def write_whitelist(sents):
+    '''
+    the --min_count pre-pass: writes the features of the oracle transitions
+    of sents seen at least --min_count times to --whitelist.
+    '''
+    if not FLAGS.whitelist:
+        raise app.UsageError("--min_count needs --whitelist")
+    logging.info("count features [%s] ...", FLAGS.train_data)
+    counts = count_features(count_shard, sents, FLAGS.workers)
+    kept = extractors.write_whitelist(counts, FLAGS.min_count, FLAGS.whitelist)
+    logging.info("whitelist [%s]: %s of %s features seen at least %s times",
+                 FLAGS.whitelist, kept, len(counts), FLAGS.min_count)
+
+
+def new_trainer(params, featExt):
+    '''
+    a trainer updating params, with its own oracle: the oracles keep
+    per sentence state.
+    '''
+    oracle = ArcEagerParsingOracle(pop_when_can=FLAGS.lazypop)
+    if FLAGS.update == 'perceptron':
+        return MLTrainerActionDecider(params, oracle, featExt)
+    return MLPassiveAggressiveTrainerActionDecider(
+        params, oracle, featExt, C=FLAGS.pa_C, variant=FLAGS.update)
+
+
+def train_shard(args):
+    '''
+    trains (a copy of) the parameters on a shard of the data, in a --workers
+    process. returns the parameters and the number of errors made.
+    '''
+    params, shard, seed = args
+    random.seed(seed)
+    trainer = new_trainer(params, feature_extractor())
+    p = ArcEagerParser(trainer)
+    for sent in shard:
+        p.parse(sent)
+    return trainer.ml, trainer.errors
+
+
 def train():
     '''
     Train Model
@@ -157,50 +245,113 @@ def train():
         MODE = 'write'
         TRAIN_OUT_FILE = FLAGS.externaltrainfile
 
-    featExt = extractors.get(FLAGS.feature_extarctor)
     sents = io.transform_conll_sents(FLAGS.train_data, FLAGS.only_projective, FLAGS.unlex)
+    if FLAGS.min_count:
+        write_whitelist(sents)
+    featExt = feature_extractor()
 
     if MODE == "write":
         fout = file(TRAIN_OUT_FILE, "w")
+        vocab = vocab_out = None
+        if FLAGS.externalvocab:
+            vocab = ml.FeatureVocabulary()
+            vocab_out = file(FLAGS.externalvocab, "w")
         trainer = LoggingActionDecider(
             ArcEagerParsingOracle(
-                pop_when_can=FLAGS.lazypop), featExt, fout)
+                pop_when_can=FLAGS.lazypop), featExt, fout, vocab, vocab_out)
         p = ArcEagerParser(trainer)
         for i, sent in enumerate(sents):
             sys.stderr.write(". %s " % i)
             sys.stderr.flush()
             d = p.parse(sent)
+        trainer.save()
         sys.exit()
 
     if MODE == "train":
-        fout = file(TRAIN_OUT_FILE, "w")
         nactions = 4
-        trainer = MLTrainerActionDecider(
-            ml.MultitronParameters(nactions), ArcEagerParsingOracle(
-                pop_when_can=FLAGS.lazypop), featExt)
-        p = ArcEagerParser(trainer)
-        import random
+        if FLAGS.threads > 1 and FLAGS.workers > 1:
+            raise app.UsageError("--threads and --workers do not combine")
+        if FLAGS.hash_bits and (FLAGS.admit_after > 1 or FLAGS.max_rows):
+            raise app.UsageError("--admit_after and --max_rows do not combine with --hash_bits")
+        if FLAGS.resume and FLAGS.init_model:
+            raise app.UsageError("--resume and --init_model do not combine")
+        checkpointer = Checkpointer(TRAIN_OUT_FILE + ".ckpt")
+        # the order of the sentences, shuffled every epoch (and checkpointed)
+        order = range(len(sents))
         random.seed("seed")
+        start = 0
+        if FLAGS.resume:
+            logging.info("resume from [%s] ...", checkpointer.fname)
+            state = load_checkpoint(checkpointer.fname)
+            if len(state["order"]) != len(sents):
+                raise app.UsageError("the checkpoint was not trained on --train_data")
+            params, order, start = state["params"], state["order"], state["epoch"]
+            random.setstate(state["random"])
+        else:
+            params = ml.MultitronParameters(nactions, FLAGS.hash_bits, FLAGS.hash_signed)
+            params.limit_features(FLAGS.admit_after, FLAGS.max_rows)
+            if FLAGS.init_model:
+                logging.info("warm start from [%s] ...", FLAGS.init_model)
+                params.warm_start(FLAGS.init_model)
+        params.hogwild = FLAGS.threads > 1
+        trainers = [new_trainer(params, featExt) for t in xrange(FLAGS.threads)]
+        trainer = trainers[0]
+        p = ArcEagerParser(trainer)
+        if FLAGS.workers > 1:
+            pool = multiprocessing.Pool(FLAGS.workers)
         total = len(sents)
-        for x in xrange(FLAGS.epoch):  # epoch
+        train_sents = sents
+        for x in xrange(start, FLAGS.epoch):  # epoch
             logging.info("iter %s/%s", x + 1, FLAGS.epoch)
             logging.info("  shuffle data ...")
-            random.shuffle(sents)
-            for i, sent in enumerate(sents):
-                if i % 500 == 0:
-                    logging.info("  step %s/%s ...", i, total)
-                try:
-                    d = p.parse(sent)
-                except IndexError as e:
-                    logging.info("prob in sent: %s", i)
-                    logging.info("\n".join(
-                        ["%s %s %s %s" % (t['id'], t['form'], t['tag'], t['parent']) for t in sent]))
-                    raise e
+            random.shuffle(order)
+            sents = [train_sents[i] for i in order]
+            if FLAGS.workers > 1:
+                logging.info("  %s workers ...", FLAGS.workers)
+                shards = [(params, sents[k::FLAGS.workers], "seed.%s.%s" % (x, k))
+                          for k in xrange(FLAGS.workers)]
+                results = pool.map(train_shard, shards)
+                errors = [e for _, e in results]
+                logging.info("  errors: %s", errors)
+                mix_params(params, [r for r, _ in results], mixing_weights(errors, FLAGS.mixing))
+            elif FLAGS.threads > 1:
+                logging.info("  %s threads ...", FLAGS.threads)
+                parse_in_threads([ArcEagerParser(t) for t in trainers], sents)
+                params.free_retired()
+            else:
+                for i, sent in enumerate(sents):
+                    if i % 500 == 0:
+                        logging.info("  step %s/%s ...", i, total)
+                    try:
+                        d = p.parse(sent)
+                    except IndexError as e:
+                        logging.info("prob in sent: %s", i)
+                        logging.info("\n".join(
+                            ["%s %s %s %s" % (t['id'], t['form'], t['tag'], t['parent']) for t in sent]))
+                        raise e
+            if FLAGS.l1 > 0:
+                logging.info("  l1 truncation: %s features dropped", params.truncate(FLAGS.l1))
+            if FLAGS.admit_after > 1 or FLAGS.max_rows or FLAGS.l1 > 0:
+                logging.info("  %s features", len(params))
+            if FLAGS.snapshot:
+                logging.info("  save snapshot ...")
+                save_snapshot(trainer.ml, "%s.epoch%s" % (TRAIN_OUT_FILE, x + 1), FLAGS.model_dtype, FLAGS.prune)
+            if FLAGS.checkpoint and (x + 1) % FLAGS.checkpoint == 0:
+                logging.info("  save checkpoint ...")
+                checkpointer.save(dict(params=params, epoch=x + 1, order=order, random=random.getstate()))
+        checkpointer.wait()
+        if FLAGS.workers > 1:
+            pool.close()
+            pool.join()
         logging.info("save model file to disk [%s] ...", TRAIN_OUT_FILE)
-        trainer.save(fout)
+        # opened only now: --init_model may be the model being trained
+        with open(TRAIN_OUT_FILE, "wb" if FLAGS.model_dtype else "w") as fout:
+            trainer.save(fout, FLAGS.model_dtype, FLAGS.prune)
 
 
 def main(argv):
+    global ml
+    ml = get_backend(FLAGS.ml_backend)
     print(
         'Running under Python {0[0]}.{0[1]}.{0[2]}'.format(
             sys.version_info),
@@ -35,7 +35,6 @@ from absl import logging
 from collections import defaultdict
 import copy
 import random
-from ml import ml
 
 from common import *
 from common.exceptions import *
@@ -64,6 +63,13 @@ class TransitionBasedParser:
         sent = [ROOT] + sent
         conf = self.Configuration(sent)
         logging.debug("parse: resolve conf")
+        if (hasattr(self.d, "best_action")
+                and self.decide.im_func is TransitionBasedParser.decide.im_func):
+            # the decider only picks legal actions, no need to try them.
+            # subclasses that override decide keep going through it.
+            while not conf.is_in_finish_state():
+                conf.do_action(self.d.best_action(conf))
+            return conf.deps
         while not conf.is_in_finish_state():
             logging.debug("parse: not finish")
             next_actions = self.decide(conf)
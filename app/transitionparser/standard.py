@@ -45,7 +45,7 @@ from absl import app
 from absl import flags
 from absl import logging
 
-from ml import ml
+from ml import get_backend, BACKENDS
 from pio import io
 from transitionparser.oracles import *
 from transitionparser.deciders import *
@@ -64,6 +64,7 @@ flags.DEFINE_boolean('lazypop', True, 'Lazy pop.')   # nopep8
 flags.DEFINE_boolean('unlex', False, 'unlex')   # nopep8
 flags.DEFINE_string('feature_extarctor', 'standard.wenbin', 'Feature Extarctor')  # nopep8
 flags.DEFINE_string('model', os.path.join(curdir, os.path.pardir, "tmp", "standard.model"), 'Transition Parser Model.')  # nopep8
+flags.DEFINE_enum('ml_backend', None, BACKENDS, 'ml backend, defaults to $ML_BACKEND or cython if it is built, else numpy.')  # nopep8
 
 '''
 Train
@@ -72,6 +73,24 @@ flags.DEFINE_boolean('train', False, 'Train model with train data')  # nopep8
 flags.DEFINE_integer('epoch', 1, 'Train Epoch.')  # nopep8
 flags.DEFINE_string('train_data', os.path.join(curdir, os.path.pardir, "data", "conll.example"), 'Train Data')  # nopep8
 flags.DEFINE_string('externaltrainfile', None, 'External Train File.')  # nopep8
+flags.DEFINE_integer('hash_bits', 0, 'Feature hashing: fold the features into 2**hash_bits rows, 0 to disable.', lower_bound=0, upper_bound=30)  # nopep8
+flags.DEFINE_boolean('hash_signed', False, 'Feature hashing: use signed hashing.')  # nopep8
+flags.DEFINE_enum('update', 'perceptron', ['perceptron', 'pa', 'pa1', 'pa2'], 'Training update: perceptron, or one of the passive-aggressive variants.')  # nopep8
+flags.DEFINE_float('pa_C', 1.0, 'Aggressiveness of the passive-aggressive updates.')  # nopep8
+flags.DEFINE_enum('model_dtype', None, ['f8', 'f4', 'f2', 'i8'], 'Save the model in the binary format with this weight type, instead of as text.')  # nopep8
+flags.DEFINE_float('prune', 0.0, 'With --model_dtype: drop the features whose weights are all below this (absolute) value.')  # nopep8
+flags.DEFINE_integer('threads', 1, 'Training threads, sharing the parameters without locks ("hogwild").', lower_bound=1)  # nopep8
+flags.DEFINE_integer('workers', 1, 'Train with iterative parameter mixing: each epoch, one perceptron per shard of the data in a pool of this many processes, then mix them.', lower_bound=1)  # nopep8
+flags.DEFINE_enum('mixing', 'uniform', ['uniform', 'error'], 'With --workers: average the shard parameters uniformly, or weighted by their number of errors.')  # nopep8
+flags.DEFINE_integer('admit_after', 0, 'Feature admission: a feature gets weights once it took part in this many updates (0: at once).', lower_bound=0, upper_bound=255)  # nopep8
+flags.DEFINE_integer('max_rows', 0, 'Feature admission: keep at most this many features, evicting the ones with the smallest averaged weights (0: no limit).', lower_bound=0)  # nopep8
+flags.DEFINE_float('l1', 0.0, 'L1 truncation: after each epoch, move the weights this much towards zero and drop the features left at zero.', lower_bound=0.0)  # nopep8
+flags.DEFINE_integer('checkpoint', 0, 'Save the whole training state (parameters, epoch, random state) every this many epochs, as <model>.ckpt, in the background (0: never).', lower_bound=0)  # nopep8
+flags.DEFINE_boolean('resume', False, 'Resume the training from <model>.ckpt (see --checkpoint), up to --epoch epochs.')  # nopep8
+flags.DEFINE_string('init_model', None, 'Warm start: start the training from the weights of this model (text or binary) instead of zeros.')  # nopep8
+flags.DEFINE_boolean('snapshot', False, 'Save the averaged model after each epoch, as <model>.epoch<n> (binary).')  # nopep8
+flags.DEFINE_string('whitelist', None, 'Keep only the features listed in this file, one per line, in training and testing (see --min_count).')  # nopep8
+flags.DEFINE_integer('min_count', 0, 'With --train and --whitelist: first count the features of the oracle transitions of --train_data, in --workers processes, and write the ones seen at least this many times to --whitelist.', lower_bound=0)  # nopep8
 # flags.DEFINE_string('modelfile', 'data/weights', 'Model File.')
 
 '''
@@ -86,43 +105,158 @@ from optparse import OptionParser
 from features import extractors
 
 import sys
-import ml
 import random
+import multiprocessing
 from pio import io
 from transitionparser.parsers import *
 
+def feature_extractor():
+    '''
+    the --feature_extarctor, without the features missing from --whitelist
+    '''
+    featExt = extractors.get(FLAGS.feature_extarctor)
+    if FLAGS.whitelist:
+        featExt = extractors.WhitelistFeatureExtractor(
+            featExt, extractors.read_whitelist(FLAGS.whitelist))
+    return featExt
+
+def count_shard(sents):
+    '''
+    the feature counts of the oracle transitions of sents, in a --workers
+    process of the --min_count pre-pass.
+    '''
+    counter = CountingActionDecider(None, extractors.get(FLAGS.feature_extarctor))
+    p = ArcStandardParser2(counter)
+    for sent in sents:
+        # a new oracle for each sentence: an oracle only resets on a sentence
+        # that differs from its last one, so the counts would depend on the shards
+        counter.decider = ArcStandardParsingOracle()
+        p.parse(sent)
+    return counter.counts
+
+def write_whitelist(sents):
+    '''
+    the --min_count pre-pass: writes the features of the oracle transitions
+    of sents seen at least --min_count times to --whitelist.
+    '''
+    if not FLAGS.whitelist:
+        raise app.UsageError("--min_count needs --whitelist")
+    logging.info("count features [%s] ...", FLAGS.train_data)
+    counts = count_features(count_shard, sents, FLAGS.workers)
+    kept = extractors.write_whitelist(counts, FLAGS.min_count, FLAGS.whitelist)
+    logging.info("whitelist [%s]: %s of %s features seen at least %s times",
+                 FLAGS.whitelist, kept, len(counts), FLAGS.min_count)
+
+def new_trainer(params, featExt):
+    '''
+    a trainer updating params, with its own oracle: the oracles keep
+    per sentence state.
+    '''
+    if FLAGS.update == 'perceptron':
+        return MLTrainerActionDecider(params, ArcStandardParsingOracle(), featExt)
+    return MLPassiveAggressiveTrainerActionDecider(
+        params, ArcStandardParsingOracle(), featExt, C=FLAGS.pa_C, variant=FLAGS.update)
+
+def train_shard(args):
+    '''
+    trains (a copy of) the parameters on a shard of the data, in a --workers
+    process. returns the parameters and the number of errors made.
+    '''
+    params, shard, seed = args
+    random.seed(seed)
+    trainer = new_trainer(params, feature_extractor())
+    p = ArcStandardParser2(trainer)
+    for sent in shard:
+        p.parse(sent)
+    return trainer.ml, trainer.errors
+
 def train():
     MODE = 'train'
-    featExt = extractors.get(FLAGS.feature_extarctor)
     sents = io.transform_conll_sents(FLAGS.train_data, FLAGS.only_projective, FLAGS.unlex)
-    trainer = MLTrainerActionDecider(
-        ml.MultitronParameters(3),
-        ArcStandardParsingOracle(),
-        featExt)
+    if FLAGS.min_count:
+        write_whitelist(sents)
+    featExt = feature_extractor()
+    if FLAGS.threads > 1 and FLAGS.workers > 1:
+        raise app.UsageError("--threads and --workers do not combine")
+    if FLAGS.hash_bits and (FLAGS.admit_after > 1 or FLAGS.max_rows):
+        raise app.UsageError("--admit_after and --max_rows do not combine with --hash_bits")
+    if FLAGS.resume and FLAGS.init_model:
+        raise app.UsageError("--resume and --init_model do not combine")
+    checkpointer = Checkpointer(FLAGS.model + ".ckpt")
+    # the order of the sentences, shuffled every epoch (and checkpointed)
+    order = range(len(sents))
+    random.seed("seed")
+    start = 0
+    if FLAGS.resume:
+        logging.info("resume from [%s] ...", checkpointer.fname)
+        state = load_checkpoint(checkpointer.fname)
+        if len(state["order"]) != len(sents):
+            raise app.UsageError("the checkpoint was not trained on --train_data")
+        params, order, start = state["params"], state["order"], state["epoch"]
+        random.setstate(state["random"])
+    else:
+        params = ml.MultitronParameters(3, FLAGS.hash_bits, FLAGS.hash_signed)
+        params.limit_features(FLAGS.admit_after, FLAGS.max_rows)
+        if FLAGS.init_model:
+            logging.info("warm start from [%s] ...", FLAGS.init_model)
+            params.warm_start(FLAGS.init_model)
+    params.hogwild = FLAGS.threads > 1
+    trainers = [new_trainer(params, featExt) for t in xrange(FLAGS.threads)]
+    trainer = trainers[0]
     p = ArcStandardParser2(trainer)
+    if FLAGS.workers > 1:
+        pool = multiprocessing.Pool(FLAGS.workers)
     total = len(sents)
-    random.seed("seed")
-    for x in xrange(FLAGS.epoch):
-        random.shuffle(sents)
+    train_sents = sents
+    for x in xrange(start, FLAGS.epoch):
+        random.shuffle(order)
+        sents = [train_sents[i] for i in order]
         logging.info("iter %s/%s", x + 1, FLAGS.epoch)
         logging.info("  shuffle data ...")
-        for i, sent in enumerate(sents):
-            if i % 500 == 0:
-                logging.info("  step %s/%s ...", i, total)
-            try:
-                d = p.parse(sent)
-            except Exception as e:
-                logging.info("prob in sent: %s", i)
-                logging.info("\n".join(
-                    ["%s %s %s %s" % (t['id'], t['form'], t['tag'], t['parent']) for t in sent]))
-                raise e
-
-    with open(FLAGS.model, "w") as fout:
+        if FLAGS.workers > 1:
+            logging.info("  %s workers ...", FLAGS.workers)
+            shards = [(params, sents[k::FLAGS.workers], "seed.%s.%s" % (x, k))
+                      for k in xrange(FLAGS.workers)]
+            results = pool.map(train_shard, shards)
+            errors = [e for _, e in results]
+            logging.info("  errors: %s", errors)
+            mix_params(params, [r for r, _ in results], mixing_weights(errors, FLAGS.mixing))
+        elif FLAGS.threads > 1:
+            logging.info("  %s threads ...", FLAGS.threads)
+            parse_in_threads([ArcStandardParser2(t) for t in trainers], sents)
+            params.free_retired()
+        else:
+            for i, sent in enumerate(sents):
+                if i % 500 == 0:
+                    logging.info("  step %s/%s ...", i, total)
+                try:
+                    d = p.parse(sent)
+                except Exception as e:
+                    logging.info("prob in sent: %s", i)
+                    logging.info("\n".join(
+                        ["%s %s %s %s" % (t['id'], t['form'], t['tag'], t['parent']) for t in sent]))
+                    raise e
+        if FLAGS.l1 > 0:
+            logging.info("  l1 truncation: %s features dropped", params.truncate(FLAGS.l1))
+        if FLAGS.admit_after > 1 or FLAGS.max_rows or FLAGS.l1 > 0:
+            logging.info("  %s features", len(params))
+        if FLAGS.snapshot:
+            logging.info("  save snapshot ...")
+            save_snapshot(trainer.ml, "%s.epoch%s" % (FLAGS.model, x + 1), FLAGS.model_dtype, FLAGS.prune)
+        if FLAGS.checkpoint and (x + 1) % FLAGS.checkpoint == 0:
+            logging.info("  save checkpoint ...")
+            checkpointer.save(dict(params=params, epoch=x + 1, order=order, random=random.getstate()))
+    checkpointer.wait()
+
+    if FLAGS.workers > 1:
+        pool.close()
+        pool.join()
+    with open(FLAGS.model, "wb" if FLAGS.model_dtype else "w") as fout:
         logging.info("save model file to disk [%s] ...", FLAGS.model)
-        trainer.save(fout)
+        trainer.save(fout, FLAGS.model_dtype, FLAGS.prune)
 
 def test():
-    featExt = extractors.get(FLAGS.feature_extarctor)
+    featExt = feature_extractor()
     sents = io.transform_conll_sents(FLAGS.test_data, FLAGS.only_projective, FLAGS.unlex)
     p = ArcStandardParser2(
                            MLActionDecider(ml.MulticlassModel(FLAGS.model, True),
@@ -160,6 +294,8 @@ def test():
     print("complete:", complete/len(sents))
 
 def main(argv):
+    global ml
+    ml = get_backend(FLAGS.ml_backend)
     print(
         'Running under Python {0[0]}.{0[1]}.{0[2]}'.format(
             sys.version_info),